@@ -0,0 +1,215 @@
+"""Machine-wide cache for large data files"""
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import time
+import uuid
+
+import appdirs
+
+
+#: Name of the file that stores the access times in the cache directory
+ACCESS_INDEX = ".access.json"
+
+
+class FileCache(object):
+    def __init__(self, path, max_size=None):
+        """Size-bounded store of files addressed by a key
+
+        Parameters
+        ----------
+        path: str or pathlib.Path
+            Cache directory
+        max_size: int or None
+            Maximum total size of the cache [B]; the least recently
+            used entries are removed when it is exceeded.
+
+        Notes
+        -----
+        The access times of the entries are stored in the file
+        ".access.json" in the cache directory (and not as file
+        modification times, which would change the modification
+        time of linked session files as well).
+
+        Files are hard-linked into the cache and into sessions if
+        possible (same file system) and copied otherwise. Cached
+        entries that are linked into sessions share the inode with
+        the session files: The permissions of the session files are
+        not changed, but modifying a session file in place also
+        modifies the cached entry. The cache is meant for files that
+        are not modified after they were added (e.g. verified
+        downloads or simulated sinograms).
+        """
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def __contains__(self, key):
+        return self.get_path(key).exists()
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries to satisfy `max_size`
+
+        Parameters
+        ----------
+        keep: str
+            Key of an entry that must not be removed
+        """
+        if self.max_size is None:
+            return
+        access = self.get_access_times()
+        entries = []
+        for pp in self.path.iterdir():
+            if pp.is_file() and not pp.name.startswith("."):
+                st = pp.stat()
+                # entries without access time (e.g. from older
+                # versions) are ranked by their modification time
+                atime = access.get(pp.name, st.st_mtime)
+                entries.append((atime, st.st_size, pp))
+        total = sum(ee[1] for ee in entries)
+        removed = []
+        for _, size, pp in sorted(entries):
+            if total <= self.max_size:
+                break
+            if pp.name == keep:
+                continue
+            pp.unlink()
+            removed.append(pp.name)
+            total -= size
+        if removed:
+            self.set_access_times({key: None for key in removed})
+
+    def get(self, key):
+        """Return the path of a cached file or None if not cached
+
+        Accessing an entry marks it as recently used.
+        """
+        path = self.get_path(key)
+        if path.exists():
+            try:
+                self.set_access_times({key: time.time()})
+            except OSError:
+                # e.g. read-only cache directory
+                pass
+            return path
+        else:
+            return None
+
+    def get_access_times(self):
+        """Return the last access time of each entry
+
+        Returns
+        -------
+        access: dict
+            Access times (see :func:`time.time`) with the keys
+            of the entries as keys
+        """
+        try:
+            with self.get_path(ACCESS_INDEX).open() as fd:
+                access = json.load(fd)
+        except (OSError, ValueError):
+            # missing or corrupt index
+            access = {}
+        return access
+
+    def get_path(self, key):
+        """Return the location of an entry in the cache"""
+        return self.path / key
+
+    def link(self, key, dest):
+        """Hard-link (or copy) a cached file to `dest`
+
+        Returns
+        -------
+        success: bool
+            False if `key` is not in the cache
+        """
+        path = self.get(key)
+        if path is None:
+            return False
+        link_or_copy(path, dest)
+        return True
+
+    def put(self, key, src):
+        """Add a file to the cache
+
+        The file is hard-linked into the cache if possible and
+        copied otherwise (see notes in :class:`FileCache`).
+
+        Returns
+        -------
+        path: pathlib.Path
+            Path of the cached file
+        """
+        path = self.get_path(key)
+        # atomically replace existing entries
+        tmp = self.path / ".{}.{}".format(key, uuid.uuid4().hex)
+        link_or_copy(src, tmp)
+        os.replace(tmp, path)
+        self.set_access_times({key: time.time()})
+        self.evict(keep=key)
+        return path
+
+    def set_access_times(self, times):
+        """Update the access times of entries
+
+        Parameters
+        ----------
+        times: dict
+            New access times; entries with the value None are
+            removed from the index.
+        """
+        access = self.get_access_times()
+        for key, atime in times.items():
+            if atime is None:
+                access.pop(key, None)
+            else:
+                access[key] = atime
+        # atomically replace the index
+        tmp = self.path / ".{}.{}".format(ACCESS_INDEX, uuid.uuid4().hex)
+        with tmp.open("w") as fd:
+            json.dump(access, fd)
+        os.replace(tmp, self.get_path(ACCESS_INDEX))
+
+
+def get_cache(name, max_size=None):
+    """Return a :class:`FileCache` in the user cache directory"""
+    path = pathlib.Path(appdirs.user_cache_dir("CellReel")) / name
+    return FileCache(path, max_size=max_size)
+
+
+def get_file_key(path):
+    """Return a key that identifies the current state of a file
+
+    The key is computed from the resolved path, the size and the
+    modification time of `path`, i.e. it changes when the file
+    is modified.
+    """
+    path = pathlib.Path(path).resolve()
+    st = path.stat()
+    return hash_parameters(path=str(path),
+                           size=st.st_size,
+                           mtime=st.st_mtime)
+
+
+def hash_parameters(**kwargs):
+    """Return a SHA-256 key for JSON-serializable keyword arguments
+
+    Numpy arrays are converted to lists.
+    """
+    def default(obj):
+        if hasattr(obj, "tolist"):
+            return obj.tolist()
+        raise TypeError("Cannot serialize {}".format(obj))
+    data = json.dumps(kwargs, sort_keys=True, default=default)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src, dest):
+    """Hard-link `src` to `dest` or copy it if linking fails"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
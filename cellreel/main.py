@@ -36,6 +36,7 @@ class CellReelMain(QtWidgets.QMainWindow):
         self.tabWidget.currentChanged.connect(self.on_tab_changed)
         self.actionNew_Session.triggered.connect(self.on_session_new)
         self.actionOpen_Session.triggered.connect(self.on_session_open)
+        self.actionLive_Acquisition.toggled.connect(self.on_live_toggled)
         self.tabWidget.setEnabled(False)
         self.has_data = False
         # if "--version" was specified, print the version and exit
@@ -46,6 +47,8 @@ class CellReelMain(QtWidgets.QMainWindow):
             sys.exit(0)
 
     def closeEvent(self, event):
+        # import remaining frames of a live acquisition
+        self.widget_sino.stop_live()
         # remove reference to allow garbage collection
         CellReelMain.instances.remove(self)
         # reduce memory leak by removing circular references
@@ -57,8 +60,32 @@ class CellReelMain(QtWidgets.QMainWindow):
         # force garbage collection
         gc.collect()
 
+    def live_start(self, live):
+        """Keep importing frames of a live acquisition
+
+        Parameters
+        ----------
+        live: cellreel.wiz_init.task_live.LiveImport
+            Live import of the current session
+        """
+        self.widget_sino.start_live(live)
+        self.actionLive_Acquisition.setEnabled(True)
+        self.actionLive_Acquisition.setChecked(True)
+
+    def on_live_toggled(self, checked):
+        """User stopped the live acquisition"""
+        if not checked:
+            self.widget_sino.stop_live()
+            self.actionLive_Acquisition.setEnabled(False)
+
     def session_load(self, path):
-        """Load a session from a path"""
+        """Load a session from a path
+
+        Returns
+        -------
+        window: CellReelMain
+            The window in which the session is shown
+        """
         if not self.has_data:
             self.has_data = True
             self.setWindowTitle("CellReel {} [{}]".format(__version__,
@@ -67,10 +94,12 @@ class CellReelMain(QtWidgets.QMainWindow):
             self.widget_reco.load(path)
             self.widget_info.load(path)
             self.tabWidget.setEnabled(True)
+            return self
         else:
             new = CellReelMain()
             new.session_load(path)
             new.show()
+            return new
 
     def on_session_open(self):
         """Let the user choose a session path and load it"""
@@ -85,7 +114,9 @@ class CellReelMain(QtWidgets.QMainWindow):
         self.init_wizard = InitWizard()
         if self.init_wizard.exec_():
             path = self.init_wizard.path
-            self.session_load(path)
+            window = self.session_load(path)
+            if self.init_wizard.live is not None:
+                window.live_start(self.init_wizard.live)
 
     def on_tab_changed(self):
         """Trigger events that need to be run when the current tab changed"""
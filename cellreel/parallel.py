@@ -0,0 +1,145 @@
+"""Helpers for running pipeline stages in parallel"""
+import collections
+import os
+import time
+
+from PyQt5 import QtCore, QtWidgets
+
+
+class TaskThread(QtCore.QThread):
+    """Run a function in a QThread and keep its result or exception
+
+    Use :func:`wait_for_threads` to re-raise the exception
+    in the GUI thread.
+    """
+    def __init__(self, func, fkw, *args, **kwargs):
+        super(TaskThread, self).__init__(*args, **kwargs)
+        self.func = func
+        self.fkw = fkw
+
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(**self.fkw)
+        except BaseException as e:
+            # re-raised in the GUI thread (see :func:`wait_for_threads`)
+            self.error = e
+
+
+def get_worker_count():
+    """Return the number of workers used for parallel pipeline stages"""
+    return max(1, os.cpu_count() or 1)
+
+
+def imap_ordered(func, iterable, executor, prefetch=None):
+    """Map `func` onto `iterable` using `executor`, yielding in order
+
+    Parameters
+    ----------
+    func: callable
+        Function applied to each item of `iterable`
+    iterable: iterable
+        Work items (e.g. batches of frames)
+    executor: concurrent.futures.Executor
+        Thread or process pool that runs `func`
+    prefetch: int
+        Maximum number of items submitted ahead of the item that
+        is currently consumed; defaults to twice the number of
+        workers (:func:`get_worker_count`).
+
+    Notes
+    -----
+    In contrast to :func:`concurrent.futures.Executor.map`, the
+    number of pending results is bounded. This keeps the memory
+    footprint small when the consumer (e.g. an HDF5 writer) is
+    slower than the workers. If an item fails or the consumer
+    stops early, the remaining items are cancelled.
+    """
+    if prefetch is None:
+        prefetch = 2 * get_worker_count()
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # do not wait for results that are not consumed
+        # (e.g. because a previous item failed)
+        for future in pending:
+            future.cancel()
+
+
+def run_in_thread(func, fkw, bar=None, count=None, max_count=None):
+    """Run `func` in a :class:`TaskThread` and display its progress
+
+    Parameters
+    ----------
+    func: callable
+        Function to run
+    fkw: dict
+        Keyword arguments for `func`
+    bar, count, max_count:
+        See :func:`wait_for_threads`
+
+    Returns
+    -------
+    result:
+        Return value of `func`; Exceptions raised by `func` are
+        re-raised in the calling (GUI) thread.
+    """
+    thread = TaskThread(func=func, fkw=fkw)
+    thread.start()
+    wait_for_threads([thread], bar=bar, count=count, max_count=max_count)
+    return thread.result
+
+
+def wait_for_threads(threads, bar=None, count=None, max_count=None,
+                     per_mille=False):
+    """Process Qt events and display progress until all threads are done
+
+    Parameters
+    ----------
+    threads: list of TaskThread
+        Running threads
+    bar: PyQt5.QtWidgets.QProgressDialog or PyQt5.QtWidgets.QProgressBar
+        Progress bar that displays `count` out of `max_count`; If
+        `count` is not given, the progress bar is not updated (e.g.
+        a busy indicator with a maximum of zero).
+    count, max_count: multiprocessing.Value
+        Progress counters incremented by the threads
+    per_mille: bool
+        Display the progress in per mille (for counters that do
+        not fit into the 32-bit integers of QProgressBar)
+
+    Notes
+    -----
+    The progress is polled until the threads are finished (and not
+    until `count` reaches `max_count`), such that a failing thread
+    cannot block the GUI. The exception of the first failed thread
+    is re-raised and a progress dialog `bar` is closed.
+    """
+    if per_mille and bar is not None:
+        bar.setMaximum(1000)
+    while any([thr.isRunning() for thr in threads]):
+        time.sleep(.05)
+        if bar is not None and count is not None:
+            if not per_mille:
+                bar.setValue(count.value)
+                bar.setMaximum(max_count.value)
+            elif max_count.value:
+                bar.setValue(count.value * 1000 // max_count.value)
+        QtCore.QCoreApplication.instance().processEvents()
+
+    # make sure the threads finish
+    for thr in threads:
+        thr.wait()
+    for thr in threads:
+        if thr.error is not None:
+            if isinstance(bar, QtWidgets.QProgressDialog):
+                bar.cancel()
+            raise thr.error
@@ -57,15 +57,12 @@ class Reconstruction(object):
             times = self.sv.get_times(mode=mode)
             angles = (times[angle_slice] - t_start) / duration * 2*np.pi
         else:
-            ref_ang = rot.compute_angles_from_spacing(path=self.path,
-                                                      spacing=spacing,
-                                                      sv=self.sv,
-                                                      mode="phase")
-
-            angles = rot.compute_angles_from_spacing(path=self.path,
-                                                     spacing=spacing,
-                                                     sv=self.sv,
-                                                     mode=mode) - ref_ang[0]
+            ref_ang, angles = rot.compute_angles_from_spacing(
+                path=self.path,
+                spacing=spacing,
+                sv=self.sv,
+                mode=["phase", mode])
+            angles = angles - ref_ang[0]
 
         return angles, angle_slice
 
@@ -0,0 +1,215 @@
+"""Automatic detection of the rotation period"""
+import numpy as np
+
+from . import rot
+from .roll import estimate_roll
+
+
+def estimate_rotation(sv, mode="phase", size=64, batch_size=64,
+                      min_pairs=3):
+    """Estimate the interval of one full rotation of a sinogram
+
+    The similarity of all pairs of frames is computed from the
+    magnitude of their Fourier transforms (which does not depend
+    on lateral displacements of the cell). The rotation period is
+    the shortest frame lag with a maximum in the average similarity
+    (see :func:`find_period`) and the interval is defined by the
+    most similar pair of frames that are one period apart.
+
+    Parameters
+    ----------
+    sv: cellreel.sino.sino_view.SinoView
+        Sinogram
+    mode: str
+        Imaging modality used (phase, amplitude, or fluorescence)
+    size: int
+        The frames are downsampled to approximately this size [px]
+        (see :func:`get_features`)
+    batch_size: int
+        Number of frames processed at once
+    min_pairs: int
+        Minimum number of frame pairs for a frame lag to be
+        considered as the rotation period
+
+    Returns
+    -------
+    estimate: dict
+        Rotation "period" [s], interval "start" and "end" [s],
+        the corresponding frame indices "idx_start" and "idx_end",
+        and the "similarity" of those frames (1 means identical).
+    """
+    data = sv.get_data(mode=mode)
+    times = sv.get_times(mode=mode)
+    features = get_features(data, size=size, batch_size=batch_size)
+    simil = get_similarity(features)
+    period = find_period(simil, min_pairs=min_pairs)
+    idx_start, idx_end = find_interval(simil, period)
+    frame_rate = sv.get_frame_rate(mode=mode)
+    return {"period": float(period / frame_rate),
+            "start": float(times[idx_start]),
+            "end": float(times[idx_end]),
+            "idx_start": idx_start,
+            "idx_end": idx_end,
+            "similarity": float(simil[idx_start, idx_end]),
+            }
+
+
+def find_interval(simil, period):
+    """Return the most similar pair of frames one period apart
+
+    Parameters
+    ----------
+    simil: 2d ndarray
+        Similarity matrix (see :func:`get_similarity`)
+    period: float
+        Rotation period [frames]
+
+    Returns
+    -------
+    idx_start, idx_end: int
+        Frame indices of the interval
+    """
+    size = simil.shape[0]
+    best = (-np.inf, 0, 0)
+    lag = int(np.round(period))
+    for ll in [lag - 1, lag, lag + 1]:
+        if ll <= 0 or ll >= size:
+            continue
+        diag = np.diagonal(simil, ll)
+        ii = int(np.argmax(diag))
+        best = max(best, (diag[ii], ii, ii + ll))
+    if not np.isfinite(best[0]):
+        raise ValueError("Rotation period too long for the sinogram!")
+    return best[1], best[2]
+
+
+def find_period(simil, min_pairs=3, tolerance=.1):
+    """Return the rotation period from a similarity matrix
+
+    Parameters
+    ----------
+    simil: 2d ndarray
+        Similarity matrix (see :func:`get_similarity`)
+    min_pairs: int
+        Minimum number of frame pairs for a frame lag
+    tolerance: float
+        Similarity peaks that are lower than the highest peak by
+        at most this fraction of the similarity range are
+        considered as equal.
+
+    Returns
+    -------
+    period: float
+        Rotation period [frames] with sub-frame accuracy
+    """
+    size = simil.shape[0]
+    profile = get_lag_profile(simil)[:size - min_pairs + 1]
+    if profile.size < 3:
+        raise ValueError("Not enough frames for detecting the period!")
+    # skip the initial decline of the similarity
+    thresh = (profile[0] + profile.min()) / 2
+    first = np.argmax(profile < thresh)
+    if first == 0:
+        raise ValueError("No rotation detected!")
+    # Multiples of the period are as similar as the period itself;
+    # use the first local maximum that is close to the global one.
+    tail = profile[first:]
+    peak = tail.max()
+    close = tail >= peak - tolerance * (peak - tail.min())
+    rising = np.r_[True, tail[1:] >= tail[:-1]]
+    falling = np.r_[tail[:-1] >= tail[1:], True]
+    local = rising & falling
+    lag = first + int(np.argmax(close & local))
+    # parabolic sub-frame interpolation
+    if 0 < lag < profile.size - 1:
+        ym, y0, yp = profile[lag-1:lag+2]
+        denom = ym - 2*y0 + yp
+        if denom < 0:
+            return lag + (ym - yp) / (2 * denom)
+    return float(lag)
+
+
+def get_features(data, size=64, batch_size=64):
+    """Return displacement-invariant features of sinogram frames
+
+    The frames are downsampled by averaging blocks of pixels
+    and the magnitude of their Fourier transform is normalized
+    to zero mean and unit length.
+
+    Parameters
+    ----------
+    data: 3d ndarray or h5py.Dataset
+        Sinogram frames
+    size: int
+        Approximate size of the downsampled frames [px]
+    batch_size: int
+        Number of frames transformed at once
+
+    Returns
+    -------
+    features: 2d ndarray of shape (N, K)
+        One feature vector per frame
+    """
+    factor = max(1, max(data.shape[1:]) // size)
+    sx = data.shape[1] // factor
+    sy = data.shape[2] // factor
+    features = []
+    for ii in range(0, data.shape[0], batch_size):
+        batch = np.asarray(data[ii:ii+batch_size], dtype=np.float32)
+        batch = batch[:, :sx*factor, :sy*factor].reshape(
+            -1, sx, factor, sy, factor).mean(axis=(2, 4))
+        batch -= batch.mean(axis=(1, 2), keepdims=True)
+        mag = np.abs(np.fft.rfft2(batch)).reshape(batch.shape[0], -1)
+        mag -= mag.mean(axis=1, keepdims=True)
+        norm = np.linalg.norm(mag, axis=1, keepdims=True)
+        norm[norm == 0] = 1
+        features.append((mag / norm).astype(np.float32))
+    return np.concatenate(features)
+
+
+def get_lag_profile(simil):
+    """Return the average similarity of frames as a function of lag"""
+    return np.array([np.diagonal(simil, ll).mean()
+                     for ll in range(simil.shape[0])])
+
+
+def get_similarity(features):
+    """Return the frame-to-frame similarity matrix
+
+    The similarity is the correlation coefficient of the
+    feature vectors (see :func:`get_features`).
+    """
+    return features @ features.T
+
+
+def suggest_rotation_state(sv, mode="phase", roll=None, **kwargs):
+    """Return a rotation state for the estimated rotation interval
+
+    Parameters
+    ----------
+    sv: cellreel.sino.sino_view.SinoView
+        Sinogram
+    mode: str
+        Imaging modality used for the estimate
+    roll: float or None
+        Axis roll of the state [°]; If None, the roll is estimated
+        with :func:`cellreel.sino.roll.estimate_roll`.
+    kwargs:
+        Additional keyword arguments for :func:`estimate_rotation`
+
+    Returns
+    -------
+    state: dict
+        Rotation state that can be saved with
+        :func:`cellreel.sino.rot.save_rotation_states`
+    """
+    est = estimate_rotation(sv, mode=mode, **kwargs)
+    p = rot.get_default_rotation_params()
+    p["Start"] = est["start"]
+    p["End"] = est["end"]
+    if roll is None:
+        roll = estimate_roll(sv, t_start=est["start"], t_end=est["end"],
+                             mode=mode)["roll"]
+    p["Roll"] = roll
+    p["Spacing"] = "2PI uniform"
+    return p.saveState()
@@ -0,0 +1,151 @@
+"""Automatic detection of the in-plane rotation axis roll"""
+import numpy as np
+from scipy import ndimage
+
+
+def estimate_roll(sv, t_start, t_end, mode="phase", num_pairs=16, size=64,
+                  step=2, refine=.1):
+    """Estimate the roll of the rotational axis
+
+    Frames recorded half a rotation apart show the cell from
+    opposite sides, i.e. one frame is the mirror image of the
+    other with respect to the rotational axis. For a set of such
+    frame pairs, the mirror axis is found by maximizing the
+    displacement-invariant (cross-correlation) similarity of the
+    first frame with the mirrored second frame.
+
+    Parameters
+    ----------
+    sv: cellreel.sino.sino_view.SinoView
+        Sinogram
+    t_start, t_end: float
+        Interval of one full rotation [s] (e.g. from
+        :func:`cellreel.sino.period.estimate_rotation`)
+    mode: str
+        Imaging modality used (phase, amplitude, or fluorescence)
+    num_pairs: int
+        Number of frame pairs used
+    size: int
+        The frames are downsampled to approximately this size [px]
+    step: float
+        Step size of the initial search over all angles [°]
+    refine: float
+        Step size of the refined search around the best angle [°]
+
+    Returns
+    -------
+    estimate: dict
+        Axis "roll" [°] in the convention of the rotation parameters
+        (see :data:`cellreel.sino.rot.params`), the "score" (mean
+        correlation of the frames with their mirrored counterparts
+        at that roll) and the "confidence" (0 means that the score
+        does not depend on the roll, 1 means that the frames are
+        perfect mirror images only at that roll).
+    """
+    data = sv.get_data(mode=mode)
+    times = sv.get_times(mode=mode)
+    idx_a, idx_b = get_mirror_pairs(times, t_start, t_end, num_pairs)
+    frames_a = bin_frames(data, idx_a, size=size)
+    frames_b = bin_frames(data, idx_b, size=size)
+    # coarse search over all mirror axes
+    angles = np.arange(-90, 90, step)
+    scores = get_mirror_scores(frames_a, frames_b, angles)
+    best = angles[np.argmax(scores)]
+    # refined search
+    fine = np.arange(best - step, best + step + refine/2, refine)
+    fine_scores = get_mirror_scores(frames_a, frames_b, fine)
+    idx = int(np.argmax(fine_scores))
+    roll = (fine[idx] + 90) % 180 - 90
+    median = np.median(scores)
+    confidence = (fine_scores[idx] - median) / max(1 - median, 1e-12)
+    return {"roll": float(roll),
+            "score": float(fine_scores[idx]),
+            "confidence": float(np.clip(confidence, 0, 1)),
+            }
+
+
+def bin_frames(data, indices, size=64):
+    """Return downsampled frames without background
+
+    The frames are downsampled by averaging blocks of pixels
+    and the mean value of the border pixels is subtracted.
+    """
+    factor = max(1, max(data.shape[1:]) // size)
+    sx = data.shape[1] // factor
+    sy = data.shape[2] // factor
+    frames = np.array([data[ii] for ii in indices], dtype=float)
+    frames = frames[:, :sx*factor, :sy*factor].reshape(
+        -1, sx, factor, sy, factor).mean(axis=(2, 4))
+    border = np.concatenate([frames[:, 0, :], frames[:, -1, :],
+                             frames[:, :, 0], frames[:, :, -1]], axis=1)
+    frames -= border.mean(axis=1).reshape(-1, 1, 1)
+    return frames
+
+
+def get_mirror_pairs(times, t_start, t_end, num_pairs=16):
+    """Return indices of frames recorded half a rotation apart
+
+    Parameters
+    ----------
+    times: 1d ndarray
+        Recording times of all frames [s]
+    t_start, t_end: float
+        Interval of one full rotation [s]
+    num_pairs: int
+        Maximum number of frame pairs
+
+    Returns
+    -------
+    idx_a, idx_b: 1d ndarray
+        Frame indices; frame `idx_b[i]` was recorded half a
+        rotation after frame `idx_a[i]`.
+    """
+    half = (t_end - t_start) / 2
+    cands = np.where((times >= t_start) & (times + half <= times[-1]))[0]
+    if cands.size == 0:
+        raise ValueError("The sinogram does not cover half a rotation!")
+    idx_a = np.unique(cands[np.linspace(0, cands.size - 1,
+                                        num_pairs).astype(int)])
+    idx_b = np.searchsorted(times, times[idx_a] + half)
+    # nearest frame
+    idx_b = np.minimum(idx_b, times.size - 1)
+    prev = np.maximum(idx_b - 1, 0)
+    closer = (np.abs(times[prev] - times[idx_a] - half)
+              < np.abs(times[idx_b] - times[idx_a] - half))
+    idx_b[closer] = prev[closer]
+    return idx_a, idx_b
+
+
+def get_mirror_scores(frames_a, frames_b, angles):
+    """Similarity of frames with mirrored frames for several axes
+
+    Parameters
+    ----------
+    frames_a, frames_b: 3d ndarray
+        Pairs of frames recorded half a rotation apart
+    angles: 1d ndarray
+        Axis roll values [°] to test
+
+    Returns
+    -------
+    scores: 1d ndarray
+        For each axis, the mean of the maximum normalized
+        cross-correlation of the frames in `frames_a` with the
+        frames in `frames_b` mirrored at that axis.
+    """
+    shape = (2*frames_a.shape[1], 2*frames_a.shape[2])
+    fft_a = np.fft.rfft2(frames_a, s=shape)
+    norm_a = np.linalg.norm(frames_a, axis=(1, 2))
+    # A mirror operation at an axis with the angle `a` is a rotation
+    # by `2a` of the frame mirrored at the horizontal axis.
+    flipped = frames_b[:, ::-1, :]
+    scores = np.zeros(len(angles))
+    for ii, ang in enumerate(angles):
+        mirrored = ndimage.rotate(flipped, -2*ang, axes=(2, 1),
+                                  reshape=False, order=1)
+        norm_b = np.linalg.norm(mirrored, axis=(1, 2))
+        fft_b = np.fft.rfft2(mirrored, s=shape)
+        corr = np.fft.irfft2(fft_a * np.conj(fft_b), s=shape)
+        peak = corr.reshape(corr.shape[0], -1).max(axis=1)
+        scores[ii] = np.mean(peak / np.maximum(norm_a * norm_b, 1e-12))
+    return scores
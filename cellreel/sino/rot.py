@@ -1,10 +1,11 @@
 import collections
+import functools
 import hashlib
 import json
 
-import lmfit
 import numpy as np
 from pyqtgraph.parametertree import Parameter
+import scipy.optimize
 from scipy.ndimage import rotate
 
 
@@ -53,23 +54,20 @@ def angle_project_2pi(signal, offset, amplitude):
     The inflection points are assumed to be where the min and the max
     of the input array are.
     """
-    y_values = signal.copy()
-
-    # normalize data
-    y_values = (y_values - offset)/amplitude
+    # normalize data (values beyond the amplitude are at the
+    # inflection points)
+    y_values = np.clip((np.asarray(signal) - offset)/amplitude, -1, 1)
 
     idmax = np.argmax(y_values)
 
     # roll the entire array such that the max value is at the left
     off = np.roll(y_values, -idmax)
 
-    # first halve (all points up to but not including the minimum):
-    angles = []
-    for ii in range(np.argmin(off)):
-        angles.append(np.arccos(off[ii]))
-
-    for ii in range(np.argmin(off), off.size):
-        angles.append(np.arccos(-off[ii])+np.pi)
+    # first halve (all points up to but not including the minimum)
+    # and second halve
+    imin = np.argmin(off)
+    angles = np.concatenate([np.arccos(off[:imin]),
+                             np.arccos(-off[imin:]) + np.pi])
 
     retangles = np.roll(angles, idmax)
     retangles = np.unwrap(retangles)
@@ -81,29 +79,55 @@ def compute_angles_from_spacing(path, spacing, sv, mode):
 
     This is a convenience function that wraps around
     :func:`load_spacing_states`,  :func:`fit_skewed_periodic`
-    and :func:`angle_project_2pi`.
+    and :func:`angle_project_2pi`. The fit is only computed once
+    for each spacing (see :func:`fit_spacing`).
+
+    Parameters
+    ----------
+    path: pathlib.Path
+        Session path
+    spacing: str
+        Name of the user-defined spacing
+    sv: cellreel.sino.sino_view.SinoView
+        Sinogram
+    mode: str or list of str
+        Imaging modality (phase, amplitude, or fluorescence) or
+        list of modalities
 
-    The parameters are identical to that of :func:`fit_main_periodic`.
+    Returns
+    -------
+    angles: 1d ndarray or list of 1d ndarray
+        Rotation angles of the frames in the spacing interval;
+        a list of arrays if `mode` is a list
     """
     sp = load_spacing_states(path)[spacing]
+    func, params = fit_spacing(json.dumps(sp, sort_keys=True))
 
-    data = np.array(sp["points"])
-    func, params = fit_skewed_periodic(x=data[:, 1],
-                                       y=data[:, 0],
-                                       period=sp["period"],
-                                       num_skw=sp["num_skw"],
-                                       y0=sp["y0"])
-    tslice = sv.get_time_slice(sp["t_start"], sp["t_end"], mode=mode)
-    xp = sv.get_times(mode=mode)[tslice] - sp["t0"]
-    yp = func(xp)
-
-    offset = params["y0"]
-    ampltidue = params["a"]
-    angles = angle_project_2pi(signal=yp, offset=offset, amplitude=ampltidue)
-    return angles
-
-
-def fit_skewed_periodic(x, y, period, num_skw=2, y0=None):
+    if isinstance(mode, str):
+        modes = [mode]
+    else:
+        modes = mode
+    xps = []
+    for mm in modes:
+        tslice = sv.get_time_slice(sp["t_start"], sp["t_end"], mode=mm)
+        xps.append(sv.get_times(mode=mm)[tslice] - sp["t0"])
+    # evaluate all modalities at once
+    yp = func(np.concatenate(xps))
+
+    angles = []
+    start = 0
+    for xp in xps:
+        angles.append(angle_project_2pi(signal=yp[start:start+xp.size],
+                                        offset=params["y0"],
+                                        amplitude=params["a"]))
+        start += xp.size
+    if isinstance(mode, str):
+        return angles[0]
+    else:
+        return angles
+
+
+def fit_skewed_periodic(x, y, period, num_skw=2, y0=None, p0=None):
     """Fit a skewed periodic function
 
     Parameters
@@ -120,6 +144,10 @@ def fit_skewed_periodic(x, y, period, num_skw=2, y0=None):
     y0: float
         Initial offset in y-direction. Defaults to the
         average of the y coordinates if not set!
+    p0: dict
+        Fit results of a previous call (e.g. with slightly
+        different points) used as initial parameters; Missing
+        skewing coefficients are initialized with zero.
 
     Returns
     -------
@@ -129,31 +157,78 @@ def fit_skewed_periodic(x, y, period, num_skw=2, y0=None):
     params: dict
         Dictionary holding the fit results.
     """
-    params = lmfit.Parameters()
-
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
     if y0 is None:
         y0 = np.average(y)
+    f = 1 / period
 
-    params.add("f", value=1/period, vary=False)
-
+    # bounds for x0, y0, a, and the skewing coefficients
     yamp = y.max() - y0
-    params.add("x0", value=0, min=-2*np.pi, max=2*np.pi)
-    params.add("y0", value=y0, vary=True)
-    params.add("a", value=yamp, max=yamp*1.2, min=yamp*.8)
+    amin, amax = sorted([yamp*.8, yamp*1.2])
+    if amin == amax:
+        raise ValueError("Cannot fit a periodic without amplitude!")
+    lower = [-2*np.pi, -np.inf, amin]
+    upper = [2*np.pi, np.inf, amax]
+
+    if p0 is None:
+        # Initial fit to get better starting parameters
+        pinit = np.array([0, y0, yamp])
+        outi = scipy.optimize.least_squares(
+            _skewed_periodic_residual, pinit,
+            jac=_skewed_periodic_jacobian,
+            bounds=(lower, upper),
+            args=(f, x, y))
+        pinit = np.concatenate([outi.x, np.zeros(2*num_skw)])
+    else:
+        b0 = [p0.get("b{}".format(ii), 0) for ii in range(num_skw)]
+        c0 = [p0.get("c{}".format(ii), 0) for ii in range(num_skw)]
+        pinit = np.array([p0["x0"], p0["y0"], p0["a"]] + b0 + c0)
+        # initial parameters must be within the bounds
+        pinit[:3] = np.clip(pinit[:3], lower, upper)
+
+    out = scipy.optimize.least_squares(
+        _skewed_periodic_residual, pinit,
+        jac=_skewed_periodic_jacobian,
+        bounds=(lower + [-np.inf]*2*num_skw, upper + [np.inf]*2*num_skw),
+        args=(f, x, y))
+
+    params = collections.OrderedDict()
+    params["f"] = float(f)
+    names = (["x0", "y0", "a"]
+             + ["b{}".format(ii) for ii in range(num_skw)]
+             + ["c{}".format(ii) for ii in range(num_skw)])
+    for name, value in zip(names, out.x):
+        params[name] = float(value)
+
+    def func(x): return skewed_periodic_model(params, x)
+
+    return func, params
+
+
+def fit_spacing(spacing_json):
+    """Fit the skewed periodic of a user-defined spacing
 
-    # Initial fit to get better starting parameters
-    outi = lmfit.minimize(skewed_periodic_residual, params, args=(x, y))
-    params = outi.params
+    The results are cached, i.e. the fit is only repeated if
+    the spacing changes. Each call returns a new `params`
+    dictionary, so callers may modify it.
 
-    for ii in range(num_skw):
-        params.add("b{}".format(ii), value=0)
-        params.add("c{}".format(ii), value=0)
+    Parameters
+    ----------
+    spacing_json: str
+        JSON representation of a spacing state (see
+        :func:`save_spacing_state`)
 
-    out = lmfit.minimize(skewed_periodic_residual, params, args=(x, y))
+    Returns
+    -------
+    func, params:
+        See :func:`fit_skewed_periodic`
+    """
+    params = _fit_spacing(spacing_json).copy()
 
-    def func(x): return skewed_periodic_model(out.params, x)
+    def func(x): return skewed_periodic_model(params, x)
 
-    return func, out.params.valuesdict()
+    return func, params
 
 
 def get_default_rotation_params():
@@ -273,7 +348,7 @@ def save_spacing_states(path, save_dict):
 
 
 def skewed_periodic_model(params, x):
-    """Fit model for a skewed periodic function for lmfit
+    """Fit model for a skewed periodic function
 
     A periodic function that is modulated by sine functions
 
@@ -281,7 +356,7 @@ def skewed_periodic_model(params, x):
 
     Parameters
     ----------
-    params: lmfit.Parameters
+    params: dict or lmfit.Parameters
         At least the Parameters Amplitude "a", frequency "f", and
         initial position in x "x0" and y "y0" must be given. For
         a skewed periodic, add the parameters "bn" and "cn" with
@@ -295,34 +370,85 @@ def skewed_periodic_model(params, x):
         evaluated periodic function
 
     """
-    a = params["a"].value
-    f = params["f"].value
-    x0 = params["x0"].value
-    y0 = params["y0"].value
-
-    bn = []
-    b_keys = [k for k in list(params.keys()) if k.startswith("b")]
-    b_keys.sort()
-    for b in b_keys:
-        bn.append(params[b].value)
-
-    on = []
-    o_keys = [k for k in list(params.keys()) if k.startswith("c")]
-    o_keys.sort()
-    for o in o_keys:
-        on.append(params[o].value)
-
-    w = 2*np.pi*f
-
-    modulation = np.zeros_like(x)
-    for ii in range(len(bn)):
-        modulation += bn[ii]*np.sin((ii+1)*w*x - on[ii])
-    mdl = y0 + a*np.sin(w*x - x0 + modulation)
-
-    return mdl
+    values = {}
+    for key in params:
+        val = params[key]
+        values[key] = getattr(val, "value", val)
+    num_skw = len([k for k in values if k.startswith("b")])
+    pars = np.array(
+        [values["x0"], values["y0"], values["a"]]
+        + [values["b{}".format(ii)] for ii in range(num_skw)]
+        + [values["c{}".format(ii)] for ii in range(num_skw)])
+    return _skewed_periodic_model(pars, values["f"], np.asarray(x))
 
 
 def skewed_periodic_residual(params, x, data):
-    """Fit residuals of skewed periodic function for lmfit"""
+    """Fit residuals of skewed periodic function"""
     mdl = skewed_periodic_model(params, x)
     return mdl-data
+
+
+@functools.lru_cache(maxsize=32)
+def _fit_spacing(spacing_json):
+    """Cached fit parameters of :func:`fit_spacing`
+
+    Do not modify the returned dictionary.
+    """
+    sp = json.loads(spacing_json)
+    data = np.array(sp["points"])
+    return fit_skewed_periodic(x=data[:, 1],
+                               y=data[:, 0],
+                               period=sp["period"],
+                               num_skw=sp["num_skw"],
+                               y0=sp["y0"])[1]
+
+
+def _skewed_periodic_model(pars, f, x, full_output=False):
+    """Vectorized version of :func:`skewed_periodic_model`
+
+    Parameters
+    ----------
+    pars: 1d ndarray
+        Parameters x0, y0, a, b0, ..., bn, c0, ..., cn
+    f: float
+        Frequency of the periodic
+    x: 1D ndarray
+        x - values of the periodic
+    full_output: bool
+        Also return intermediate results for computing the
+        Jacobian (see :func:`_skewed_periodic_jacobian`)
+    """
+    x0, y0, a = pars[:3]
+    num_skw = (pars.size - 3) // 2
+    bn = pars[3:3+num_skw]
+    cn = pars[3+num_skw:]
+    w = 2*np.pi*f
+    # modulation terms (shape (x.size, num_skw))
+    phase = np.outer(w*x, np.arange(1, num_skw+1)) - cn
+    modulation = np.sin(phase) @ bn
+    arg = w*x - x0 + modulation
+    mdl = y0 + a*np.sin(arg)
+    if full_output:
+        return mdl, arg, phase
+    else:
+        return mdl
+
+
+def _skewed_periodic_residual(pars, f, x, data):
+    return _skewed_periodic_model(pars, f, x) - data
+
+
+def _skewed_periodic_jacobian(pars, f, x, data):
+    """Analytic Jacobian of :func:`_skewed_periodic_residual`"""
+    a = pars[2]
+    num_skw = (pars.size - 3) // 2
+    bn = pars[3:3+num_skw]
+    _, arg, phase = _skewed_periodic_model(pars, f, x, full_output=True)
+    acos = a*np.cos(arg)
+    jac = np.empty((x.size, pars.size))
+    jac[:, 0] = -acos
+    jac[:, 1] = 1
+    jac[:, 2] = np.sin(arg)
+    jac[:, 3:3+num_skw] = acos[:, np.newaxis] * np.sin(phase)
+    jac[:, 3+num_skw:] = -acos[:, np.newaxis] * bn * np.cos(phase)
+    return jac
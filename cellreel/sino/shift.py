@@ -0,0 +1,208 @@
+"""Sub-pixel shifting of sinogram image stacks"""
+import collections
+import numbers
+import threading
+
+import numpy as np
+import scipy.ndimage as ndi
+
+
+class ShiftedStack(object):
+    #: Number of equidistant frames used for :func:`ShiftedStack.min`
+    #: and :func:`ShiftedStack.max`
+    level_frames = 60
+
+    def __init__(self, images, shifts, method="spline", cval=0,
+                 cache_size=64):
+        """Image stack with per-frame shifts applied lazily on read
+
+        Parameters
+        ----------
+        images: 3d ndarray of shape (N, X, Y)
+            Original (unshifted) images
+        shifts: 2d ndarray of shape (N, 2)
+            Shift for each image
+        method: str
+            Resampling method (see :func:`shift_images`)
+        cval: float
+            Background value of the images
+        cache_size: int
+            Maximum number of resampled frames kept in memory
+            when accessing individual frames
+
+        Notes
+        -----
+        Accessing frames via indexing only resamples the requested
+        frames. Converting the stack to an array (e.g. with
+        :func:`numpy.asarray`) resamples all frames once and keeps
+        the result for subsequent access.
+
+        Unless all frames have been resampled already, :func:`min`
+        and :func:`max` (e.g. for the display levels) are computed
+        from a subset of `level_frames` frames.
+
+        The frame cache is thread-safe.
+        """
+        if len(shifts) != len(images):
+            raise ValueError("Number of shifts ({}) does not match number "
+                             "of images ({})!".format(len(shifts),
+                                                      len(images)))
+        self.images = images
+        self.shifts = np.asarray(shifts, dtype=float).reshape(-1, 2)
+        self.method = method
+        self.cval = cval
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._full = None
+        self._levels = None
+        self._lock = threading.Lock()
+
+    def __array__(self, dtype=None, copy=None):
+        with self._lock:
+            if self._full is None:
+                self._full = shift_images(images=self.images,
+                                          shifts=self.shifts,
+                                          method=self.method,
+                                          cval=self.cval)
+                self._cache.clear()
+        if dtype is None:
+            return self._full
+        else:
+            return self._full.astype(dtype)
+
+    def __getitem__(self, index):
+        if self._full is not None:
+            return self._full[index]
+        if isinstance(index, tuple):
+            frames = self[index[0]]
+            if isinstance(index[0], numbers.Integral):
+                return frames[index[1:]]
+            else:
+                return frames[(slice(None),) + index[1:]]
+        elif isinstance(index, numbers.Integral):
+            if index < 0:
+                index += len(self)
+            return self._get_frames([index])[0]
+        else:
+            indices = np.arange(len(self))[index]
+            return self._get_frames(indices)
+
+    def __len__(self):
+        return len(self.images)
+
+    def _get_frames(self, indices):
+        """Return the resampled frames at `indices` (uses the cache)"""
+        if len(indices) > self.cache_size:
+            # do not flush the cache for large requests
+            return shift_images(images=self.images[indices],
+                                shifts=self.shifts[indices],
+                                method=self.method,
+                                cval=self.cval)
+        with self._lock:
+            missing = [ii for ii in indices if ii not in self._cache]
+            if missing:
+                shifted = shift_images(images=self.images[missing],
+                                       shifts=self.shifts[missing],
+                                       method=self.method,
+                                       cval=self.cval)
+                for ii, image in zip(missing, shifted):
+                    self._cache[ii] = image
+            for ii in indices:
+                self._cache.move_to_end(ii)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            if len(indices):
+                return np.stack([self._cache[ii] for ii in indices])
+        return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+
+    def _get_levels(self):
+        """Return minimum and maximum of the resampled frames
+
+        If not all frames have been resampled, only `level_frames`
+        equidistant frames are resampled (the result is cached).
+        """
+        if self._full is not None:
+            return self._full.min(), self._full.max()
+        if self._levels is None:
+            num = len(self)
+            indices = np.unique(np.linspace(
+                0, num - 1, min(num, self.level_frames), dtype=int))
+            frames = shift_images(images=self.images[indices],
+                                  shifts=self.shifts[indices],
+                                  method=self.method,
+                                  cval=self.cval)
+            self._levels = frames.min(), frames.max()
+        return self._levels
+
+    @property
+    def dtype(self):
+        return self.images.dtype
+
+    @property
+    def ndim(self):
+        return self.images.ndim
+
+    @property
+    def shape(self):
+        return self.images.shape
+
+    def max(self, *args, **kwargs):
+        if args or kwargs:
+            return np.asarray(self).max(*args, **kwargs)
+        return self._get_levels()[1]
+
+    def min(self, *args, **kwargs):
+        if args or kwargs:
+            return np.asarray(self).min(*args, **kwargs)
+        return self._get_levels()[0]
+
+
+def shift_images(images, shifts, method="spline", cval=0):
+    """Shift a stack of images with sub-pixel accuracy
+
+    Parameters
+    ----------
+    images: 3d ndarray of shape (N, X, Y)
+        Input images
+    shifts: 2d ndarray of shape (N, 2)
+        Shift for each image (see :func:`scipy.ndimage.shift`)
+    method: str
+        Resampling method
+
+        - "spline": cubic spline interpolation; pixels shifted in
+          from outside the image are set to `cval`
+        - "fourier": multiplication with a phase ramp in Fourier
+          space; all images of the stack are transformed at once
+          and the image boundaries are periodic
+    cval: float
+        Background value of the images; for "fourier", `cval` is
+        subtracted before and added after shifting, such that
+        content wrapped around the image border is background.
+
+    Returns
+    -------
+    shifted: 3d ndarray
+        Shifted images with the same dtype as `images`
+    """
+    images = np.asarray(images)
+    shifts = np.asarray(shifts, dtype=float).reshape(-1, 2)
+    if method == "spline":
+        shifted = np.empty_like(images)
+        for ii in range(images.shape[0]):
+            shifted[ii] = ndi.shift(input=images[ii],
+                                    shift=shifts[ii],
+                                    order=3,
+                                    mode="constant",
+                                    cval=cval)
+    elif method == "fourier":
+        sx, sy = images.shape[1:]
+        fx = np.fft.fftfreq(sx).reshape(1, -1, 1)
+        fy = np.fft.rfftfreq(sy).reshape(1, 1, -1)
+        ramp = np.exp(-2j*np.pi * (shifts[:, 0].reshape(-1, 1, 1) * fx
+                                   + shifts[:, 1].reshape(-1, 1, 1) * fy))
+        ft = np.fft.rfft2(images - cval, axes=(1, 2))
+        shifted = np.fft.irfft2(ft * ramp, s=(sx, sy), axes=(1, 2)) + cval
+        shifted = shifted.astype(images.dtype, copy=False)
+    else:
+        raise ValueError("Unknown shift method: {}".format(method))
+    return shifted
@@ -1,6 +1,8 @@
 from functools import lru_cache
 import hashlib
 import numbers
+import os
+import pathlib
 
 import flimage
 import h5py
@@ -8,6 +10,8 @@ import numpy as np
 from pyqtgraph.functions import affineSlice
 import qpimage
 
+from .shift import ShiftedStack
+
 
 class SinoView(object):
     def __init__(self, path=None):
@@ -179,9 +183,30 @@ class SinoView(object):
     def is_aligned(self):
         pass
 
+    @lru_cache(maxsize=None)
+    def is_virtual(self):
+        """Whether the sinogram only stores alignment shifts
+
+        Virtual sinograms reference the image data of their parent
+        sinogram and store the shift of each frame in the
+        "virtual alignment" group. The shifts are applied when the
+        data are accessed (see :class:`.shift.ShiftedStack`).
+        """
+        with h5py.File(self.path, "r") as h5:
+            return "virtual alignment" in h5
+
     def is_colocalized(self):
         pass
 
+    @lru_cache(maxsize=None)
+    def is_live(self):
+        """Whether frames are still being appended to the sinogram
+
+        See :class:`cellreel.wiz_init.task_live.LiveImport`.
+        """
+        with h5py.File(self.path, "r") as h5:
+            return bool(h5.attrs.get("live acquisition", False))
+
     def load(self, count=None, max_count=None):
         """Load sinogram data into memory"""
         # set maximum count value for progress tracking
@@ -194,6 +219,7 @@ class SinoView(object):
         self.meta = {}
         self.meta_qpi = []
         self.meta_fli = []
+        self._buffers = {}
         with h5py.File(self.path, mode="r") as h5:
             if self.has_qpi():
                 qps = qpimage.QPSeries(h5file=h5["qpseries"])
@@ -228,12 +254,87 @@ class SinoView(object):
                         count.value += 1
             else:
                 self.fl = None
-        # clear lru_caches
+            # apply shifts of virtual sinograms lazily
+            if "virtual alignment" in h5:
+                vag = h5["virtual alignment"]
+                method = vag.attrs["resampling"]
+                if self.pha is not None and "qpseries" in vag:
+                    shifts = vag["qpseries"][:]
+                    self.pha = ShiftedStack(self.pha, shifts, method, cval=0)
+                    self.amp = ShiftedStack(self.amp, shifts, method, cval=1)
+                if self.fl is not None and "flseries" in vag:
+                    shifts = vag["flseries"][:]
+                    self.fl = ShiftedStack(self.fl, shifts, method, cval=0)
+        self.clear_caches()
+        return self
+
+    def clear_caches(self):
+        """Clear all lru_caches"""
         for key in dir(self):
             obj = getattr(self, key)
             if callable(obj) and hasattr(obj, "cache_clear"):
                 obj.cache_clear()
-        return self
+
+    def update(self):
+        """Load frames that were appended since the last (up)load
+
+        This is used for sinograms that are still being recorded
+        (see :func:`SinoView.is_live`). Only the new frames are
+        read from the file. Virtual sinograms are not supported.
+
+        Returns
+        -------
+        num: int
+            Number of new frames (all modalities)
+        """
+        num = 0
+        with h5py.File(self.path, mode="r") as h5:
+            if "virtual alignment" in h5:
+                raise ValueError("Cannot update virtual sinograms!")
+            if "qpseries" in h5:
+                qps = qpimage.QPSeries(h5file=h5["qpseries"])
+                qpis = [qps[ii] for ii in range(len(self.meta_qpi),
+                                                len(qps))]
+                if qpis:
+                    if not self.meta:
+                        for key in ["wavelength", "pixel size",
+                                    "medium index"]:
+                            self.meta[key] = qpis[0][key]
+                    self.meta_qpi += [qpi.meta for qpi in qpis]
+                    self._append("pha", [qpi.pha for qpi in qpis])
+                    self._append("amp", [qpi.amp for qpi in qpis])
+                    num += len(qpis)
+            if "flseries" in h5:
+                fls = flimage.FLSeries(h5file=h5["flseries"])
+                flis = [fls[jj] for jj in range(len(self.meta_fli),
+                                                len(fls))]
+                if flis:
+                    self.meta_fli += [fli.meta for fli in flis]
+                    self._append("fl", [fli.fl for fli in flis])
+                    num += len(flis)
+        if num:
+            self.clear_caches()
+        return num
+
+    def _append(self, name, frames):
+        """Append frames to the image stack attribute `name`
+
+        The stack is a view of a buffer whose capacity is doubled
+        when necessary, such that frequent updates do not copy
+        the entire stack.
+        """
+        stack = getattr(self, name)
+        if stack is None:
+            stack = np.zeros((0,) + frames[0].shape, dtype=frames[0].dtype)
+        size = len(stack) + len(frames)
+        buf = self._buffers.get(name)
+        if buf is None or len(buf) < size:
+            buf = np.zeros((max(size, 2 * len(stack)),) + stack.shape[1:],
+                           dtype=stack.dtype)
+            buf[:len(stack)] = stack
+            self._buffers[name] = buf
+        buf[len(stack):size] = frames
+        setattr(self, name, buf[:size])
 
     def verify(self, nest=True):
         """Verify the analysis steps leading to this sinogram
@@ -248,3 +349,74 @@ class SinoView(object):
             current sinogram is derived from.
         """
         pass
+
+
+def get_broken_links(path):
+    """Return the names of external links with missing targets
+
+    Derived sinograms reference unchanged image data of their
+    parent sinogram via external links (see :func:`link_group`).
+    If the parent file was removed or moved, these groups are
+    not accessible anymore.
+    """
+    path = pathlib.Path(path)
+    broken = []
+    with h5py.File(path, "r") as h5:
+        for name in h5:
+            link = h5.get(name, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                try:
+                    get_group_source(path, name)
+                except (OSError, KeyError):
+                    broken.append(name)
+    return broken
+
+
+def get_group_source(path, name):
+    """Return the file and object path that actually store a group
+
+    Groups in derived sinograms may be external links to the
+    sinogram they were derived from. This function follows
+    these links.
+
+    Returns
+    -------
+    path_source: pathlib.Path
+        Path to the HDF5 file containing the data
+    name_source: str
+        Name of the group in `path_source`
+    """
+    path = pathlib.Path(path)
+    with h5py.File(path, "r") as h5:
+        link = h5.get(name, getlink=True)
+        if link is None:
+            raise KeyError("'{}' not found in '{}'!".format(name, path))
+    if isinstance(link, h5py.ExternalLink):
+        return get_group_source(path.parent / link.filename, link.path)
+    else:
+        return path.resolve(), name
+
+
+def link_group(h5out, name, path_parent):
+    """Create an external link to a group of a parent sinogram
+
+    Parameters
+    ----------
+    h5out: h5py.File
+        Derived sinogram file
+    name: str
+        Name of the group (e.g. "qpseries")
+    path_parent: str or pathlib.Path
+        Sinogram file that contains the group (possibly as
+        an external link itself, see :func:`get_group_source`)
+
+    Notes
+    -----
+    The link is stored relative to the location of `h5out`,
+    such that CellReel sessions may be moved.
+    """
+    source, source_name = get_group_source(path_parent, name)
+    relpath = os.path.relpath(source,
+                              pathlib.Path(h5out.filename).resolve().parent)
+    h5out[name] = h5py.ExternalLink(pathlib.Path(relpath).as_posix(),
+                                    source_name)
@@ -1,10 +1,11 @@
 import pkg_resources
 
 import numpy as np
-from PyQt5 import uic, QtWidgets
+from PyQt5 import uic, QtCore, QtWidgets
 import pyqtgraph as pg
 
 from . import helper
+from .parallel import TaskThread
 from .sino import rot
 
 
@@ -35,6 +36,16 @@ class Spacing(QtWidgets.QDialog):
         # plot for line plotting
         self.fit = pg.PlotDataItem()
         self.imageView.addItem(self.fit)
+        # fit (computed in a background thread after the points
+        # did not change for a short time)
+        self.fit_params = None  # previous result for warm starts
+        self.title = self.windowTitle()  # fit errors are shown in title
+        self.fit_thread = None
+        self.fit_pending = False
+        self.fit_timer = QtCore.QTimer(self)
+        self.fit_timer.setSingleShot(True)
+        self.fit_timer.setInterval(100)
+        self.fit_timer.timeout.connect(self.on_fit)
         # signals
         self.horizontalSlider.valueChanged.connect(self.plot_image)
         self.radioButton_pha.clicked.connect(self.on_mode)
@@ -52,6 +63,13 @@ class Spacing(QtWidgets.QDialog):
         self.plot_image()
         self.update_spacing_list()
 
+    def done(self, *args, **kwargs):
+        self.fit_timer.stop()
+        self.fit_pending = False
+        if self.fit_thread is not None:
+            self.fit_thread.wait()
+        super(Spacing, self).done(*args, **kwargs)
+
     @property
     def current_mode(self):
         """Current imaging modality (phase, amplitude, or fluorescence)"""
@@ -100,9 +118,58 @@ class Spacing(QtWidgets.QDialog):
         self.set_points(points)
         self.update_fit()
 
+    def on_fit(self):
+        """Fit the current points in the background"""
+        if self.fit_thread is not None and self.fit_thread.isRunning():
+            # fit again when the current fit is done
+            self.fit_pending = True
+            return
+        points = np.array(self.get_points(correct_scale=True))
+        if points.shape[0] == 0:
+            return
+        length = self.current_sino.shape[0]/self.frame_rate
+        image = self.sv.get_slice(data=self.current_sino, **self.slicekw)
+        fkw = {"x": points[:, 1],
+               "y": points[:, 0],
+               "period": length,
+               "y0": image.shape[1]/2,
+               "num_skw": self.spinBox.value(),
+               "p0": self.fit_params,
+               }
+        self.fit_thread = TaskThread(func=rot.fit_skewed_periodic, fkw=fkw)
+        self.fit_thread.finished.connect(self.on_fit_done)
+        self.fit_thread.start()
+
+    def on_fit_done(self):
+        """Plot the fit computed in :func:`Spacing.on_fit`"""
+        if self.fit_pending:
+            self.fit_pending = False
+            self.on_fit()
+        elif self.fit_thread.error is not None:
+            if not isinstance(self.fit_thread.error,
+                              (TypeError, ValueError, IndexError)):
+                raise self.fit_thread.error
+            # the points cannot be fitted (e.g. too few points);
+            # do not show the previous fit
+            self.fit_params = None
+            self.fit.setData([], [])
+            self.setWindowTitle("{} - fit failed: {}".format(
+                self.title, self.fit_thread.error))
+        elif self.fit_thread.result is not None:
+            self.setWindowTitle(self.title)
+            func, self.fit_params = self.fit_thread.result
+            tslice = self.sv.get_time_slice(self.t_start, self.t_end,
+                                            mode=self.current_mode)
+            xp = self.sv.get_times(mode=self.current_mode)[tslice] - self.t0
+            yp = func(xp)
+            self.fit.setData(yp*self.scale, xp*self.frame_rate)
+            # call plot again (workaround b/c image is drawn incorrectly)
+            self.plot_image()
+
     def on_load(self):
         """Load a user spacing and update all controls"""
         # TODO: check for matching t_start and t_end
+        self.fit_params = None
         key = self.comboBox.currentText()
         sp = rot.load_spacing_states(path=self.sv.path.parent)
         if key in sp:
@@ -130,6 +197,7 @@ class Spacing(QtWidgets.QDialog):
     def on_mode(self):
         """Update the image because the user changed the mode"""
         points = np.array(self.get_points(correct_scale=True))
+        self.fit_params = None
         self.plot_image()
         if points.size:
             self.set_points(points, apply_scale=True)
@@ -199,26 +267,12 @@ class Spacing(QtWidgets.QDialog):
         self.line.blockSignals(False)
 
     def update_fit(self):
-        """Update the plot of the fit (`self.fit`)"""
-        points = np.array(self.get_points(correct_scale=True))
-        length = self.current_sino.shape[0]/self.frame_rate
-        image = self.sv.get_slice(data=self.current_sino, **self.slicekw)
-        try:
-            func, _ = rot.fit_skewed_periodic(x=points[:, 1],
-                                              y=points[:, 0],
-                                              period=length,
-                                              y0=image.shape[1]/2,
-                                              num_skw=self.spinBox.value())
-        except (TypeError, ValueError, IndexError):
-            pass
-        else:
-            tslice = self.sv.get_time_slice(self.t_start, self.t_end,
-                                            mode=self.current_mode)
-            xp = self.sv.get_times(mode=self.current_mode)[tslice] - self.t0
-            yp = func(xp)
-            self.fit.setData(yp*self.scale, xp*self.frame_rate)
-            # call plot again (workaround b/c image is drawn incorrectly)
-            self.plot_image()
+        """Update the plot of the fit (`self.fit`)
+
+        The fit is computed in the background after the points did
+        not change for 100 ms (see :func:`Spacing.on_fit`).
+        """
+        self.fit_timer.start()
 
     def update_spacing_list(self):
         self.comboBox.blockSignals(True)
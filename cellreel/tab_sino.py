@@ -2,6 +2,7 @@ import collections
 import multiprocessing as mp
 import pkg_resources
 import time
+import warnings
 
 import h5py
 import numpy as np
@@ -10,11 +11,13 @@ import pyqtgraph as pg
 from pyqtgraph.parametertree import ParameterTree
 
 from . import helper
-from .sino import rot
+from .parallel import run_in_thread
+from .sino import period, roll, rot
 from . import spacing
-from .sino.sino_view import SinoView
-from .wiz_align import AlignWizard
+from .sino.sino_view import SinoView, get_broken_links
+from .wiz_align import AlignWizard, task_align
 from .wiz_flcorr import FluorescenceWizard
+from .wiz_init import task_live
 
 
 class LoadThread(QtCore.QThread):
@@ -92,12 +95,24 @@ class SinoWidget(QtWidgets.QWidget):
         # fluorescence correction button
         self.pushButton_flcorr.clicked.connect(self.on_fluorescence_correction)
 
+        # materialization of virtual sinograms
+        self.pushButton_materialize.clicked.connect(self.on_materialize)
+
         # spacing-construction button
         self.pushButton_new_spacing.clicked.connect(self.on_spacing)
 
         # rotation buttons
         self.pushButton_rot.clicked.connect(self.on_rotation_save)
         self.pushButton_rot_rm.clicked.connect(self.on_rotation_remove)
+        self.pushButton_rot_detect.clicked.connect(self.on_rotation_detect)
+        self.pushButton_roll_detect.clicked.connect(self.on_roll_detect)
+
+        # live acquisition
+        self.live = None
+        self.live_thread = None
+        self.live_timer = QtCore.QTimer(self)
+        self.live_timer.setInterval(1000)
+        self.live_timer.timeout.connect(self.on_live_poll)
 
         # default properties
         self.imkw = {}
@@ -119,7 +134,7 @@ class SinoWidget(QtWidgets.QWidget):
 
         tr = ParameterTree(showHeader=False)
         tr.setParameters(self.params_rot, showTop=False)
-        self.verticalLayout_rotation.insertWidget(3, tr)
+        self.verticalLayout_rotation.insertWidget(5, tr)
         tr.setMaximumSize(184, 16777215)
 
         # state comboboxes
@@ -141,13 +156,49 @@ class SinoWidget(QtWidgets.QWidget):
         data = self.data.get_data(mode=self.current_mode)
         return data
 
+    def get_new_sinogram(self, name):
+        """Return a new sinogram name and path in the current session
+
+        Parameters
+        ----------
+        name: str
+            Name pattern of the new sinogram containing "{}", which
+            is replaced with the lowest available integer.
+        """
+        pname = "sinogram_{}.h5"
+        ii = 0
+        while True:
+            ii += 1
+            sino_name = name.format(ii)
+            sino_path = self.path / pname.format(ii)
+            if sino_name in self.sinogram_paths:
+                continue
+            elif sino_path.exists():
+                continue
+            else:
+                break
+        return sino_name, sino_path
+
     def load(self, path=None):
         """Load session data"""
         if path is not None:
             self.path = path
 
         # load sinogram
-        self.sinogram_paths = get_sinograms(self.path)
+        missing = {}
+        with warnings.catch_warnings():
+            # shown in a message box
+            warnings.simplefilter("ignore")
+            self.sinogram_paths = get_sinograms(self.path, missing=missing)
+        if missing:
+            lines = ["- {} (missing: {})".format(pp.name, ", ".join(files))
+                     for pp, files in sorted(missing.items())]
+            QtWidgets.QMessageBox.warning(
+                self,
+                "Sinograms skipped",
+                "The following sinograms could not be loaded, because the "
+                + "data they were derived from are missing:\n\n"
+                + "\n".join(lines))
         for cb in [self.comboBox_align, self.comboBox_sino]:
             cb.blockSignals(True)
             cb.clear()
@@ -167,13 +218,7 @@ class SinoWidget(QtWidgets.QWidget):
         self.update_lines()
         self.update_image_mode()
 
-        # hide/disable unused widgets
-        if self.data.has_fli():
-            self.radioButton_fl.show()
-            self.pushButton_flcorr.show()
-        else:
-            self.radioButton_fl.hide()
-            self.pushButton_flcorr.hide()
+        self.update_modality_widgets()
 
     def load_sinogram(self):
         """Load sinogram data as defined in `self.comboBox_sino`"""
@@ -208,22 +253,12 @@ class SinoWidget(QtWidgets.QWidget):
         # make sure the thread finishes
         loadthread.wait()
 
+        self.pushButton_materialize.setVisible(self.data.is_virtual())
+
     def on_align(self):
         """Let user perform sinogram displacement alignment"""
         self.setEnabled(False)
-        name = "Aligned {}"
-        pname = "sinogram_{}.h5"
-        ii = 0
-        while True:
-            ii += 1
-            sino_name = name.format(ii)
-            sino_path = self.path / pname.format(ii)
-            if sino_name in self.sinogram_paths:
-                continue
-            elif sino_path.exists():
-                continue
-            else:
-                break
+        sino_name, sino_path = self.get_new_sinogram("Aligned {}")
         self.align_wizard = AlignWizard(name=sino_name,
                                         data=self.data,
                                         path_out=sino_path)
@@ -234,19 +269,8 @@ class SinoWidget(QtWidgets.QWidget):
     def on_fluorescence_correction(self):
         """Let user perform fluorescence correction"""
         self.setEnabled(False)
-        name = self.comboBox_align.currentText() + " B {}"
-        pname = "sinogram_{}.h5"
-        ii = 0
-        while True:
-            ii += 1
-            sino_name = name.format(ii)
-            sino_path = self.path / pname.format(ii)
-            if sino_name in self.sinogram_paths:
-                continue
-            elif sino_path.exists():
-                continue
-            else:
-                break
+        sino_name, sino_path = self.get_new_sinogram(
+            self.comboBox_align.currentText() + " B {}")
         self.flcorr_wizard = FluorescenceWizard(name=sino_name,
                                                 data=self.data,
                                                 path_out=sino_path)
@@ -254,6 +278,60 @@ class SinoWidget(QtWidgets.QWidget):
             self.load(self.path)
         self.setEnabled(True)
 
+    def on_live_poll(self):
+        """Import new frames of the live acquisition in the background"""
+        if self.live_thread is not None and self.live_thread.isRunning():
+            return
+        self.live_thread = task_live.LiveThread(self.live)
+        self.live_thread.error.connect(self.on_live_error)
+        self.live_thread.finished.connect(self.on_live_update)
+        self.live_thread.start()
+
+    def on_live_error(self, message):
+        """Pause the live acquisition when importing new frames failed"""
+        self.live_timer.stop()
+        QtWidgets.QMessageBox.warning(
+            self,
+            "Live acquisition paused",
+            "Importing new frames failed. Uncheck 'Live Acquisition' to "
+            + "import the remaining frames and stop the acquisition."
+            + "\n\n{}".format(message))
+
+    def on_live_update(self):
+        """Show the frames imported by :func:`SinoWidget.on_live_poll`"""
+        if (self.live is None
+                or self.data.path.resolve() != self.live.path_sino.resolve()):
+            # live acquisition stopped or the user is looking at a
+            # different sinogram
+            return
+        # follow the acquisition if the last frame is displayed
+        at_end = (int(self.vLine_angle.value())
+                  >= self.current_sino.shape[0] - 1)
+        if not self.live.lock.acquire(blocking=False):
+            # the sinogram is being written; update after the next poll
+            return
+        try:
+            num = self.data.update()
+        finally:
+            self.live.lock.release()
+        if num:
+            self.pushButton_play.setChecked(False)
+            self.update_modality_widgets()
+            self.update_image_mode()
+            if at_end:
+                self.vLine_angle.setValue(self.current_sino.shape[0] - 1)
+
+    def on_materialize(self):
+        """Write a full copy of the current virtual sinogram"""
+        self.setEnabled(False)
+        sino_name, sino_path = self.get_new_sinogram(
+            self.comboBox_sino.currentText() + " M {}")
+        task_align.materialize(data=self.data,
+                               name=sino_name,
+                               path_out=sino_path)
+        self.load(self.path)
+        self.setEnabled(True)
+
     def on_interval_line(self):
         """User changed rotation interval lines; update self.params_rot"""
         start, end = self.LinearRegion_angle.getRegion()
@@ -306,6 +384,55 @@ class SinoWidget(QtWidgets.QWidget):
             self.comboBox_rot.setCurrentIndex(0)
             self.comboBox_rot.blockSignals(False)
 
+    def on_roll_detect(self):
+        """Estimate the axis roll and offer to use it"""
+        self.setEnabled(False)
+        bar = get_busy_dialog("Estimating axis roll...",
+                              "Axis Roll Detection")
+        try:
+            est = run_in_thread(func=roll.estimate_roll,
+                                fkw={"sv": self.data,
+                                     "t_start": self.params_rot["Start"],
+                                     "t_end": self.params_rot["End"],
+                                     "mode": self.current_mode},
+                                bar=bar)
+        except ValueError as e:
+            QtWidgets.QMessageBox.warning(self, "Axis roll detection failed",
+                                          str(e))
+            return
+        finally:
+            bar.reset()
+            self.setEnabled(True)
+        answer = QtWidgets.QMessageBox.question(
+            self,
+            "Axis roll",
+            "Estimated axis roll: {:.1f}° (confidence {:.2f})\n\n".format(
+                est["roll"], est["confidence"])
+            + "Set the axis roll to this value?")
+        if answer == QtWidgets.QMessageBox.Yes:
+            self.params_rot["Roll"] = est["roll"]
+
+    def on_rotation_detect(self):
+        """Estimate the rotation interval and save it as a new state"""
+        self.setEnabled(False)
+        bar = get_busy_dialog("Detecting rotation...", "Rotation Detection")
+        try:
+            state = run_in_thread(func=period.suggest_rotation_state,
+                                  fkw={"sv": self.data,
+                                       "mode": self.current_mode,
+                                       "roll": self.params_rot["Roll"]},
+                                  bar=bar)
+        except ValueError as e:
+            QtWidgets.QMessageBox.warning(self, "Rotation detection failed",
+                                          str(e))
+            return
+        finally:
+            bar.reset()
+            self.setEnabled(True)
+        self.params_rot.restoreState(state)
+        self.lineEdit_rot.setText("Automatic")
+        self.on_rotation_save()
+
     def on_rotation_remove(self):
         """User pressed "Save Rotation" button"""
         name = self.lineEdit_rot.text()
@@ -360,6 +487,32 @@ class SinoWidget(QtWidgets.QWidget):
             self.LinearRegion_angle.hide()
         self.update_play_pause_thread_data()
 
+    def start_live(self, live):
+        """Periodically append new frames to the session sinogram
+
+        Parameters
+        ----------
+        live: cellreel.wiz_init.task_live.LiveImport
+            Live import of the current session
+        """
+        self.live = live
+        self.live_timer.start()
+
+    def stop_live(self):
+        """Stop the live acquisition, importing all remaining frames"""
+        self.live_timer.stop()
+        if self.live_thread is not None:
+            self.live_thread.wait()
+        if self.live is not None:
+            try:
+                self.live.poll(stable_only=False)
+            except task_live.LiveImportError as e:
+                QtWidgets.QMessageBox.warning(self, "Live acquisition",
+                                              str(e))
+            self.live.stop()
+            self.on_live_update()
+            self.live = None
+
     def update_image_angle(self):
         """Display the sinogram image defined by `self.vLine_angle`"""
         idx = int(self.vLine_angle.value())
@@ -440,6 +593,15 @@ class SinoWidget(QtWidgets.QWidget):
                            self.data.pha.shape[1]//2])
         self.vLine_angle.setValue(0)
 
+    def update_modality_widgets(self):
+        """Hide/disable widgets of modalities not in the sinogram"""
+        if self.data.has_fli():
+            self.radioButton_fl.show()
+            self.pushButton_flcorr.show()
+        else:
+            self.radioButton_fl.hide()
+            self.pushButton_flcorr.hide()
+
     def update_play_pause_thread_data(self):
         times = self.data.get_times(mode=self.current_mode)
         frame_rate = self.data.get_frame_rate(mode=self.current_mode)
@@ -494,14 +656,53 @@ class PlayPauseThread(QtCore.QThread):
                 break
 
 
-def get_sinograms(path):
+def get_busy_dialog(label, title):
+    """Return a progress dialog with a busy indicator
+
+    Use this for tasks that do not report their progress (e.g.
+    the estimators in :mod:`cellreel.sino`).
+    """
+    bar = QtWidgets.QProgressDialog(label,
+                                    "This button does nothing",
+                                    0,
+                                    0)
+    bar.setCancelButton(None)
+    bar.setMinimumDuration(0)
+    bar.setAutoClose(True)
+    bar.setWindowTitle(title)
+    return bar
+
+
+def get_sinograms(path, missing=None):
     """Return a dictionary of sinogram paths for a CellReel session
 
     Format: {name: path, ...}
+
+    Derived sinograms whose external links to their parent
+    sinogram are broken (see :func:`get_broken_links`) are
+    skipped with a warning.
+
+    Parameters
+    ----------
+    path: pathlib.Path
+        Session directory
+    missing: dict
+        If given, the missing source files of the skipped
+        sinograms are stored in this dictionary
+        (format: {sinogram path: [missing file, ...], ...})
     """
     data = [["Raw Sinogram", path / "sinogram.h5", 0]]
 
     for pp in path.glob("sinogram_*.h5"):
+        broken = get_broken_links(pp)
+        if broken:
+            warnings.warn("Skipping sinogram '{}', because the data of "
+                          "{} are missing!".format(pp, ", ".join(broken)))
+            if missing is not None:
+                with h5py.File(pp, mode="r") as h5:
+                    missing[pp] = sorted(
+                        {h5.get(gn, getlink=True).filename for gn in broken})
+            continue
         with h5py.File(pp, mode="r") as h5:
             name = h5.attrs["name"]
             ptime = pp.stat().st_mtime
@@ -1,8 +1,10 @@
 import pkg_resources
 
-from PyQt5 import uic, QtWidgets
+from PyQt5 import uic, QtCore, QtWidgets
+import pyqtgraph as pg
 
 from . import task_align
+from ..parallel import TaskThread
 
 
 ui_pages = ["scheme.ui",
@@ -27,6 +29,8 @@ class AlignPageScheme(AlignPage):
     def initializePage(self):
         self.comboBox.clear()
         self.comboBox.addItems(sorted(task_align.ALIGN_METHODS.keys()))
+        self.comboBox_shift.clear()
+        self.comboBox_shift.addItems(list(task_align.SHIFT_METHODS.keys()))
 
 
 class AlignPageThresh(AlignPage):
@@ -44,6 +48,28 @@ class AlignPageThresh(AlignPage):
         self.horizontalSlider.valueChanged.connect(self.on_slider)
         # connect manual spinbox
         self.doubleSpinBox.valueChanged.connect(self.on_slider)
+        # shift preview (computed in a background thread after the
+        # threshold did not change for a short time)
+        self.preview_thread = None
+        self.preview_pending = False
+        self.preview_timer = QtCore.QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(300)
+        self.preview_timer.timeout.connect(self.on_preview)
+        self.doubleSpinBox.valueChanged.connect(self.preview_timer.start)
+        self.comboBox.currentIndexChanged.connect(self.preview_timer.start)
+        self.checkBox_preview.toggled.connect(self.preview_timer.start)
+        self.plotWidget.setLabel("left", "shift [px]")
+        self.plotWidget.setLabel("bottom", "frame")
+        self.plotWidget.addLegend(offset=(-10, 10))
+        self.curve_x = self.plotWidget.plot(pen="r", symbol="o",
+                                            symbolSize=4, symbolPen="r",
+                                            name="x")
+        self.curve_y = self.plotWidget.plot(pen="b", symbol="o",
+                                            symbolSize=4, symbolPen="b",
+                                            name="y")
+        self.frame_line = pg.InfiniteLine(angle=90, pen="k")
+        self.plotWidget.addItem(self.frame_line)
 
     def get_threshold_kw(self):
         """Return the currently selected threshold"""
@@ -69,7 +95,45 @@ class AlignPageThresh(AlignPage):
         data = wiz.data.get_data(self.data_name)
         self.horizontalSlider.setMaximum(data.shape[0]-1)
         self.horizontalSlider.setValue(0)
+        self.curve_x.setData([], [])
+        self.curve_y.setData([], [])
         self.on_slider()
+        self.preview_timer.start()
+
+    def cleanupPage(self):
+        self.preview_timer.stop()
+        self.wait_preview()
+
+    def on_preview(self):
+        """Compute the shifts for a subset of frames in the background"""
+        if not self.checkBox_preview.isChecked():
+            return
+        if (self.preview_thread is not None
+                and self.preview_thread.isRunning()):
+            # update again when the current preview is done
+            self.preview_pending = True
+            return
+        wiz = self.wizard()
+        pscheme = wiz.page(ui_pages.index("scheme.ui"))
+        fkw = {"method": pscheme.comboBox.currentText(),
+               "preproc_kw": self.get_threshold_kw(),
+               "image_data": wiz.data.get_data(self.data_name),
+               }
+        self.preview_thread = TaskThread(
+            func=task_align.preview_shifts, fkw=fkw)
+        self.preview_thread.finished.connect(self.on_preview_done)
+        self.preview_thread.start()
+
+    def on_preview_done(self):
+        """Plot the shifts computed in :func:`AlignPageThresh.on_preview`"""
+        if self.preview_pending:
+            self.preview_pending = False
+            self.on_preview()
+        elif self.preview_thread.result is not None:
+            indices, shiftx, shifty = self.preview_thread.result
+            # nan values (failed alignment) are not connected
+            self.curve_x.setData(indices, shiftx, connect="finite")
+            self.curve_y.setData(indices, shifty, connect="finite")
 
     def on_slider(self):
         """Display the threshold image selected by self.horizontalSlider"""
@@ -79,6 +143,13 @@ class AlignPageThresh(AlignPage):
         image = data[idx]
         kw = self.get_threshold_kw()
         self.ImageView.setImage(task_align.threshold(image, **kw))
+        self.frame_line.setValue(idx)
+
+    def wait_preview(self):
+        """Wait for a running preview computation to finish"""
+        self.preview_pending = False
+        if self.preview_thread is not None:
+            self.preview_thread.wait()
 
 
 class AlignWizard(QtWidgets.QWizard):
@@ -113,10 +184,15 @@ class AlignWizard(QtWidgets.QWizard):
         # Get sinogram
         pscheme = self.page(ui_pages.index("scheme.ui"))
         pthresh = self.page(ui_pages.index("thresh.ui"))
+        pthresh.preview_timer.stop()
+        pthresh.wait_preview()
         task_align.align(
             method=pscheme.comboBox.currentText(),
             mode=pthresh.data_name,
             preproc_kw=pthresh.get_threshold_kw(),
+            shift_method=task_align.SHIFT_METHODS[
+                pscheme.comboBox_shift.currentText()],
+            virtual=pscheme.checkBox_virtual.isChecked(),
             data=self.data,
             name=self.name,
             path_out=self.path_out)
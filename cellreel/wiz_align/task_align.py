@@ -1,18 +1,24 @@
+import concurrent.futures
+import multiprocessing as mp
+
 import flimage
 import h5py
 import numpy as np
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtWidgets
 import qpimage
-import scipy.ndimage.interpolation as intp
 from skimage.segmentation import clear_border
 from skimage.measure import regionprops
 from skimage.morphology import closing, square
 
 
 from .._version import version
+from ..parallel import get_worker_count, imap_ordered, run_in_thread
+from ..sino.shift import ShiftedStack, shift_images
+from ..sino.sino_view import link_group
 
 
-def align(method, mode, preproc_kw, data, name, path_out):
+def align(method, mode, preproc_kw, data, name, path_out,
+          shift_method="spline", batch_size=16, virtual=False):
     """Alignment sinogram data
 
     Parameters
@@ -31,93 +37,65 @@ def align(method, mode, preproc_kw, data, name, path_out):
         Name of the aligned sinogram (stored in HDF5 file)
     path_out: str or pathlib.Path
         Path to output sinogram HDF5 file
+    shift_method: str
+        Resampling method for shifting the images;
+        See :func:`cellreel.sino.shift.shift_images`
+    batch_size: int
+        Number of frames that are resampled in one batch by
+        a worker thread
+    virtual: bool
+        If True, only the shifts of each frame are stored in
+        `path_out` together with external links to the image
+        data of `data` (see :func:`write_virtual`). The shifts
+        are then applied when the sinogram is loaded.
 
     Notes
     -----
     Uses linear interpolation on time axis to correct shift
     for complementary imaging modality.
-    """
-    pfunc, mfunc = ALIGN_METHODS[method]
 
+    The frames are resampled in batches on a thread pool while
+    a single thread writes the resampled frames to `path_out`
+    in order.
+    """
     with h5py.File(path_out, "w") as h5out:
         h5out.attrs["name"] = name
         h5out.attrs["CellReel version"] = version
         h5out.attrs["origin hash"] = data.get_hash()
         h5out.attrs["alignment method"] = method
         h5out.attrs["alignment modality"] = mode
+        h5out.attrs["alignment resampling"] = shift_method
         for key in preproc_kw:
             kk = "alignment preprocessing {}".format(key)
             h5out.attrs[kk] = preproc_kw[key]
 
-        image_data = data.get_data(mode)
-
-        lendat = 0
-        if data.has_fli():
-            lendat += data.fl.shape[0]
-        if data.has_qpi():
-            # counts twice
-            lendat += 2*data.pha.shape[0]
-
-        bar = QtWidgets.QProgressDialog("Transforming data...",
-                                        "This button does nothing",
-                                        0,
-                                        lendat)
-        bar.setCancelButton(None)
-        bar.setMinimumDuration(0)
-        bar.setAutoClose(True)
-        bar.setWindowTitle("Sinogram Alignment")
-
-        shiftx = np.zeros(len(image_data))
-        shifty = np.zeros(len(image_data))
-
-        for ii in range(len(image_data)):
-            image = image_data[ii]
-            # run pipeline
-            preproc = pfunc(image, **preproc_kw)
-            shift = mfunc(preproc)
-            shiftx[ii] = shift[0]
-            shifty[ii] = shift[1]
+        shiftx, shifty = compute_shifts(method=method,
+                                        image_data=data.get_data(mode),
+                                        preproc_kw=preproc_kw)
 
-        times = data.get_times(mode=mode)
+        tfkw = {"data": data,
+                "times": data.get_times(mode=mode),
+                "shiftx": shiftx,
+                "shifty": shifty,
+                "h5out": h5out,
+                "shift_method": shift_method,
+                }
+        if virtual:
+            write_virtual(**tfkw)
+        else:
+            run_transform(batch_size=batch_size, **tfkw)
 
-        skw = {"mode": "constant",
-               "order": 3,
-               }
 
-        if data.has_qpi():
-            qps_group = h5out.require_group("qpseries")
-            times_qp = data.get_times("phase")
-            shiftx_qp = np.interp(x=times_qp, xp=times, fp=shiftx)
-            shifty_qp = np.interp(x=times_qp, xp=times, fp=shifty)
-            with qpimage.QPSeries(h5file=qps_group) as qps:
-                for ii in range(data.pha.shape[0]):
-                    sh = (shiftx_qp[ii], shifty_qp[ii])
-                    phai = intp.shift(
-                        input=data.pha[ii], cval=0, shift=sh, **skw)
-                    ampi = intp.shift(
-                        input=data.amp[ii], cval=1, shift=sh, **skw)
-                    qpio = qpimage.QPImage(data=(phai, ampi),
-                                           which_data="phase,amplitude",
-                                           meta_data=data.meta_qpi[ii])
-                    qps.add_qpimage(qpi=qpio)
-                    bar.setValue(bar.value() + 2)
-                    QtCore.QCoreApplication.instance().processEvents()
+def bin_image(image, binning):
+    """Downsample an image by averaging `binning` x `binning` pixels
 
-        if data.has_fli():
-            fls_group = h5out.require_group("flseries")
-            times_fl = data.get_times("fluorescence")
-            shiftx_fl = np.interp(x=times_fl, xp=times, fp=shiftx)
-            shifty_fl = np.interp(x=times_fl, xp=times, fp=shifty)
-            with flimage.FLSeries(h5file=fls_group) as fls:
-                for ii in range(data.fl.shape[0]):
-                    sh = (shiftx_fl[ii], shifty_fl[ii])
-                    fli = intp.shift(
-                        input=data.fl[ii], cval=0, shift=sh, **skw)
-                    flio = flimage.FLImage(data=fli,
-                                           meta_data=data.meta_fli[ii])
-                    fls.add_flimage(fli=flio)
-                    bar.setValue(bar.value() + 1)
-                    QtCore.QCoreApplication.instance().processEvents()
+    Rows and columns that do not fill a complete bin are discarded.
+    """
+    if binning == 1:
+        return image
+    sx, sy = np.array(image.shape) // binning
+    image = image[:sx*binning, :sy*binning]
+    return image.reshape(sx, binning, sy, binning).mean(axis=(1, 3))
 
 
 def bbox(binary):
@@ -135,6 +113,227 @@ def centroid(binary):
     return shift
 
 
+def iter_batches(shifts, stacks, batch_size, shift_method):
+    """Yield resampling jobs for :func:`shift_batch`
+
+    Parameters
+    ----------
+    shifts: 2d ndarray of shape (N, 2)
+        Shift for each frame
+    stacks: list of tuples (3d ndarray, float)
+        Image stacks of length N and their background value `cval`
+    batch_size: int
+        Number of frames per job
+    shift_method: str
+        Resampling method (see :func:`shift_images`)
+    """
+    for start in range(0, len(shifts), batch_size):
+        sl = slice(start, start + batch_size)
+        yield (shifts[sl],
+               [(stack[sl], cval) for stack, cval in stacks],
+               shift_method)
+
+
+def shift_batch(job):
+    """Resample one job generated by :func:`iter_batches`"""
+    shifts, stacks, shift_method = job
+    return [shift_images(images=stack, shifts=shifts, method=shift_method,
+                         cval=cval)
+            for stack, cval in stacks]
+
+
+def compute_shifts(method, image_data, preproc_kw, indices=None, binning=1,
+                   ignore_errors=False):
+    """Compute the alignment shifts of an image stack
+
+    Parameters
+    ----------
+    method: str
+        Alignment method key; See :data:`ALIGN_METHODS`
+    image_data: 3d ndarray
+        Image stack of the alignment modality
+    preproc_kw: dict
+        Keyword arguments for preprocessing
+    indices: 1d ndarray of int
+        Only compute the shifts for these frames (defaults to all)
+    binning: int
+        Downsample the images before preprocessing (see
+        :func:`bin_image`); the shifts are given in pixels of
+        the original images.
+    ignore_errors: bool
+        If True, the shifts of frames for which the alignment
+        method fails (e.g. no object in the threshold image)
+        are set to nan.
+
+    Returns
+    -------
+    shiftx, shifty: 1d ndarrays
+        Shifts of the frames
+    """
+    pfunc, mfunc = ALIGN_METHODS[method]
+    if indices is None:
+        indices = np.arange(len(image_data))
+
+    shiftx = np.zeros(len(indices))
+    shifty = np.zeros(len(indices))
+
+    for ii, idx in enumerate(indices):
+        image = bin_image(image_data[idx], binning)
+        # run pipeline
+        try:
+            preproc = pfunc(image, **preproc_kw)
+            shift = mfunc(preproc)
+        except IndexError:
+            if ignore_errors:
+                shift = (np.nan, np.nan)
+            else:
+                raise
+        shiftx[ii] = shift[0] * binning
+        shifty[ii] = shift[1] * binning
+    return shiftx, shifty
+
+
+def get_modality_shifts(data, times, shiftx, shifty, mode):
+    """Interpolate alignment shifts for an imaging modality
+
+    If the data of `mode` are already shifted (virtual sinogram),
+    the shifts of `data` are added, such that the returned shifts
+    apply to the original image data.
+
+    Returns
+    -------
+    images: 3d ndarray or list of 3d ndarray
+        Original image data (phase and amplitude for QPI)
+    shifts: 2d ndarray of shape (N, 2)
+        Total shift for each frame
+    """
+    times_mode = data.get_times(mode)
+    shifts = np.stack([np.interp(x=times_mode, xp=times, fp=shiftx),
+                       np.interp(x=times_mode, xp=times, fp=shifty)],
+                      axis=1)
+    if mode == "fluorescence":
+        stacks = [data.fl]
+    else:
+        stacks = [data.pha, data.amp]
+    images = []
+    for stack in stacks:
+        if isinstance(stack, ShiftedStack):
+            images.append(stack.images)
+            stack_shifts = stack.shifts
+        else:
+            images.append(stack)
+            stack_shifts = 0
+    return images, shifts + stack_shifts
+
+
+def materialize(data, name, path_out, batch_size=16):
+    """Write a virtual sinogram with resampled image data
+
+    Parameters
+    ----------
+    data: cellreel.sino.sino_view.SinoView
+        Virtual sinogram data (see :func:`write_virtual`)
+    name: str
+        Name of the new sinogram
+    path_out: str or pathlib.Path
+        Path to output sinogram HDF5 file
+    batch_size: int
+        Number of frames that are resampled in one batch
+    """
+    with h5py.File(data.path, "r") as h5in, \
+            h5py.File(path_out, "w") as h5out:
+        for key in h5in.attrs:
+            if key.startswith("alignment"):
+                h5out.attrs[key] = h5in.attrs[key]
+        method = h5in["virtual alignment"].attrs["resampling"]
+        h5out.attrs["name"] = name
+        h5out.attrs["CellReel version"] = version
+        h5out.attrs["origin hash"] = data.get_hash()
+        times = data.get_times("phase" if data.has_qpi() else "fluorescence")
+        run_transform(data=data,
+                      times=times,
+                      shiftx=np.zeros(times.size),
+                      shifty=np.zeros(times.size),
+                      h5out=h5out,
+                      shift_method=method,
+                      batch_size=batch_size)
+
+
+def preview_shifts(method, preproc_kw, image_data, num_frames=60,
+                   max_size=128):
+    """Compute the alignment shifts for a subset of frames
+
+    This is a fast approximation of the shifts computed in
+    :func:`align` that is used to tune the alignment parameters.
+
+    Parameters
+    ----------
+    method: str
+        Alignment method key; See :data:`ALIGN_METHODS`
+    preproc_kw: dict
+        Keyword arguments for preprocessing
+    image_data: 3d ndarray
+        Image stack of the alignment modality
+    num_frames: int
+        Number of equidistant frames to use
+    max_size: int
+        The images are binned such that they are not larger
+        than `max_size` (see :func:`bin_image`).
+
+    Returns
+    -------
+    indices: 1d ndarray of int
+        Frame indices
+    shiftx, shifty: 1d ndarrays
+        Shifts of the frames (nan if the alignment failed)
+    """
+    num = len(image_data)
+    indices = np.unique(np.linspace(0, num - 1, min(num, num_frames),
+                                    dtype=int))
+    binning = max(1, int(np.ceil(max(image_data.shape[1:]) / max_size)))
+    shiftx, shifty = compute_shifts(method=method,
+                                    image_data=image_data,
+                                    preproc_kw=preproc_kw,
+                                    indices=indices,
+                                    binning=binning,
+                                    ignore_errors=True)
+    return indices, shiftx, shifty
+
+
+def run_transform(data, times, shiftx, shifty, h5out, shift_method="spline",
+                  batch_size=16):
+    """Run :func:`transform` in a thread and display its progress"""
+    count = mp.Value('I', 0, lock=True)
+    max_count = mp.Value('I', 0, lock=True)
+    if data.has_fli():
+        max_count.value += data.fl.shape[0]
+    if data.has_qpi():
+        # counts twice
+        max_count.value += 2*data.pha.shape[0]
+
+    bar = QtWidgets.QProgressDialog("Transforming data...",
+                                    "This button does nothing",
+                                    count.value,
+                                    max_count.value)
+    bar.setCancelButton(None)
+    bar.setMinimumDuration(0)
+    bar.setAutoClose(True)
+    bar.setWindowTitle("Sinogram Alignment")
+
+    tfkw = {"data": data,
+            "times": times,
+            "shiftx": shiftx,
+            "shifty": shifty,
+            "h5out": h5out,
+            "shift_method": shift_method,
+            "batch_size": batch_size,
+            "count": count,
+            }
+    run_in_thread(func=transform, fkw=tfkw, bar=bar, count=count,
+                  max_count=max_count)
+    bar.reset()
+
+
 def threshold(image, thresh):
     """Compute the threshold of an image"""
     if isinstance(thresh, float):
@@ -147,7 +346,102 @@ def threshold(image, thresh):
     return cleared
 
 
+def transform(data, times, shiftx, shifty, h5out, shift_method="spline",
+              batch_size=16, count=None):
+    """Write shifted sinogram data to an HDF5 file
+
+    Parameters
+    ----------
+    data: cellreel.sino.sino_view.SinoView
+        Full sinogram data
+    times: 1d ndarray
+        Recording times corresponding to `shiftx` and `shifty`
+    shiftx, shifty: 1d ndarray
+        Shifts determined for the alignment modality; they are
+        linearly interpolated for the other modalities.
+    h5out: h5py.File
+        Output sinogram file
+    shift_method: str
+        Resampling method (see :func:`shift_images`)
+    batch_size: int
+        Number of frames that are resampled in one batch
+    count: multiprocessing.Value
+        Incremented by two for each phase/amplitude image pair and
+        by one for each fluorescence image written
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=get_worker_count()) as pool:
+        if data.has_qpi():
+            qps_group = h5out.require_group("qpseries")
+            (pha, amp), shifts_qp = get_modality_shifts(
+                data, times, shiftx, shifty, mode="phase")
+            jobs = iter_batches(shifts=shifts_qp,
+                                stacks=[(pha, 0), (amp, 1)],
+                                batch_size=batch_size,
+                                shift_method=shift_method)
+            with qpimage.QPSeries(h5file=qps_group) as qps:
+                ii = 0
+                for phab, ampb in imap_ordered(shift_batch, jobs, pool):
+                    for phai, ampi in zip(phab, ampb):
+                        qpio = qpimage.QPImage(data=(phai, ampi),
+                                               which_data="phase,amplitude",
+                                               meta_data=data.meta_qpi[ii])
+                        qps.add_qpimage(qpi=qpio)
+                        ii += 1
+                        if count is not None:
+                            count.value += 2
+
+        if data.has_fli():
+            fls_group = h5out.require_group("flseries")
+            (fl,), shifts_fl = get_modality_shifts(
+                data, times, shiftx, shifty, mode="fluorescence")
+            jobs = iter_batches(shifts=shifts_fl,
+                                stacks=[(fl, 0)],
+                                batch_size=batch_size,
+                                shift_method=shift_method)
+            with flimage.FLSeries(h5file=fls_group) as fls:
+                jj = 0
+                for (flb,) in imap_ordered(shift_batch, jobs, pool):
+                    for fli in flb:
+                        flio = flimage.FLImage(data=fli,
+                                               meta_data=data.meta_fli[jj])
+                        fls.add_flimage(fli=flio)
+                        jj += 1
+                        if count is not None:
+                            count.value += 1
+
+
+def write_virtual(data, times, shiftx, shifty, h5out, shift_method="spline"):
+    """Write a virtual sinogram that only stores alignment shifts
+
+    The image data groups of `h5out` are external links to the
+    files that hold the original image data of `data` (see
+    :func:`cellreel.sino.sino_view.link_group`). The shift of
+    each frame is stored in the group "virtual alignment" and
+    applied when the sinogram is loaded.
+
+    Parameters are the same as in :func:`transform`.
+    """
+    vag = h5out.require_group("virtual alignment")
+    vag.attrs["resampling"] = shift_method
+    if data.has_qpi():
+        link_group(h5out, "qpseries", data.path)
+        _, shifts_qp = get_modality_shifts(
+            data, times, shiftx, shifty, mode="phase")
+        vag.create_dataset("qpseries", data=shifts_qp)
+    if data.has_fli():
+        link_group(h5out, "flseries", data.path)
+        _, shifts_fl = get_modality_shifts(
+            data, times, shiftx, shifty, mode="fluorescence")
+        vag.create_dataset("flseries", data=shifts_fl)
+
+
 #: Valid alignment methods
 ALIGN_METHODS = {"Center of bounding box (threshold image)": (threshold, bbox),
                  "Center of mass (threshold image)": (threshold, centroid),
                  }
+
+#: Valid resampling methods for shifting images (see :func:`shift_images`)
+SHIFT_METHODS = {"Cubic spline (default)": "spline",
+                 "Fourier shift (periodic, fast)": "fourier",
+                 }
@@ -1,27 +1,20 @@
+import concurrent.futures
 import multiprocessing as mp
-import os
-import tempfile
-import time
 
 import flimage
+from flimage.series import fit_exponential
 import h5py
 import numpy as np
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtWidgets
+from skimage.restoration import denoise_tv_chambolle
 
 from .._version import version
+from ..parallel import get_worker_count, imap_ordered, run_in_thread
+from ..sino.sino_view import link_group
 
 
-class BGThread(QtCore.QThread):
-    def __init__(self, func, fkw, *args, **kwargs):
-        super(BGThread, self).__init__(*args, **kwargs)
-        self.func = func
-        self.fkw = fkw
-
-    def run(self):
-        self.result = self.func(**self.fkw)
-
-
-def bleach_correction(denoise, border_px, data, name, path_out):
+def bleach_correction(denoise, border_px, data, name, path_out,
+                      chunk_size=32, keep_denoised=False):
     """Perform bleach correction
 
     Parameters
@@ -38,101 +31,230 @@ def bleach_correction(denoise, border_px, data, name, path_out):
         Name of the new sinogram
     path_out: pathlib.Path
         Output sinogram HDF5 file
+    chunk_size: int
+        Number of frames processed at once for determining the
+        fluorescence intensity trace
+    keep_denoised: bool
+        If True and `denoise` is set, the denoised (but not bleach
+        corrected) fluorescence data are additionally written to
+        the group "denoised flseries" in `path_out`.
 
     Notes
     -----
     The fluorescence sinogram is also background corrected
     (background offset signal).
+
+    The correction is computed in two passes over the fluorescence
+    data (see :func:`compute_bleach_correction`), such that no
+    temporary copy of the (denoised) data is written to disk.
     """
     count = mp.Value('I', 0, lock=True)
     max_count = mp.Value('I', 0, lock=True)
 
-    bar = QtWidgets.QProgressDialog("Preprocessing data...",
+    bar = QtWidgets.QProgressDialog("Performing bleach correction...",
                                     "This button does nothing",
                                     count.value,
                                     max_count.value)
     bar.setCancelButton(None)
-    bar.setAutoClose(False)
+    bar.setAutoClose(True)
     bar.setMinimumDuration(0)
     bar.setWindowTitle("Bleach correction")
 
-    # temporary path for all operations
-    path_temp = tempfile.mktemp(suffix=".h5",
-                                prefix=".bleach",
-                                dir=path_out.parent)
-
     with h5py.File(data.path, "r") as h5in, \
-        h5py.File(path_temp, "w") as h5temp, \
             h5py.File(path_out, "w") as h5out:
-        flsin = flimage.FLSeries(h5file=h5in["flseries"])
-        # denoise
-        dnkw = {"h5file": h5temp.require_group("flseries"),
-                "count": count,
-                "max_count": max_count,
-                }
-        denthread = BGThread(func=flsin.denoise, fkw=dnkw)
-        denthread.start()
-        # Show a progress until computation is done
-        while count.value == 0 or count.value < max_count.value:
-            time.sleep(.05)
-            bar.setValue(count.value)
-            bar.setMaximum(max_count.value)
-            QtCore.QCoreApplication.instance().processEvents()
-        # make sure the thread finishes
-        denthread.wait()
-
-        # bleach correction
-        count.value = 0
-        max_count.value = 0
-        bar.setLabelText("Performing bleach correction...")
-        bar.setValue(0)
-        bar.setAutoClose(True)
-        flstemp = flimage.FLSeries(h5file=h5temp["flseries"])
-        if denoise:
-            flscorr = flstemp
-        else:
-            flscorr = flsin
-        bckw = {"flscorr": flscorr,
+        bckw = {"fl": data.fl,
+                "meta_fli": data.meta_fli,
+                "times": data.get_times("fluorescence"),
                 "h5out": h5out.require_group("flseries"),
                 "border_px": border_px,
+                "denoise": denoise,
+                "chunk_size": chunk_size,
                 "count": count,
                 "max_count": max_count,
                 }
-        blthread = BGThread(func=flsin.bleach_correction, fkw=bckw)
-        blthread.start()
+        if denoise and keep_denoised:
+            bckw["h5denoised"] = h5out.require_group("denoised flseries")
         # Show a progress until computation is done
-        while count.value == 0 or count.value < max_count.value:
-            time.sleep(.05)
-            bar.setValue(count.value)
-            bar.setMaximum(max_count.value)
-            QtCore.QCoreApplication.instance().processEvents()
-        # make sure the thread finishes
-        blthread.wait()
+        bg, flint, decay, times = run_in_thread(
+            func=compute_bleach_correction,
+            fkw=bckw,
+            bar=bar,
+            count=count,
+            max_count=max_count)
         # write bleach correction data
-        bg, flint, decay, times = blthread.result
-        bdata = np.zeros(times.size, np.dtype([("time", np.float),
-                                               ("signal", np.float),
-                                               ("fit", np.float)]))
-        bdata["time"] = times
-        bdata["signal"] = flint
-        bdata["fit"] = decay
-        blc = h5out.create_group("bleach correction")
-        blc.attrs["background signal"] = bg
-        blcds = blc.create_dataset(name="fit", data=bdata)
-        blcds.attrs["CLASS"] = np.string_("TABLE")
-        blcds.attrs["TITLE"] = np.string_("Bleach correction")
-        blcds.attrs["VERSION"] = np.string_("0.2")
-        blcds.attrs["FIELD_0_NAME"] = np.string_("time")
-        blcds.attrs["FIELD_1_NAME"] = np.string_("signal")
-        blcds.attrs["FIELD_2_NAME"] = np.string_("fit")
+        write_bleach_data(h5out, bg=bg, flint=flint, decay=decay,
+                          times=times)
         # set meta data
         h5out.attrs["bleach correction border_px"] = border_px
         h5out.attrs["bleach correction denoise"] = denoise
         h5out.attrs["CellReel version"] = version
         h5out.attrs["name"] = name
         h5out.attrs["origin hash"] = data.get_hash()
-        # copy qpi data
-        h5in.copy("qpseries", h5out)
+        # link unchanged qpi data
+        if data.has_qpi():
+            link_group(h5out, "qpseries", data.path)
+        if "virtual alignment" in h5in and "qpseries" in h5in[
+                "virtual alignment"]:
+            # keep the alignment shifts of virtual sinograms
+            vag = h5out.require_group("virtual alignment")
+            vag.attrs.update(h5in["virtual alignment"].attrs)
+            h5in.copy("virtual alignment/qpseries", vag)
+
+
+def compute_bleach_correction(fl, meta_fli, times, h5out, border_px=20,
+                              denoise=True, chunk_size=32,
+                              denoise_chunk_size=8, h5denoised=None,
+                              count=None, max_count=None):
+    """Bleach-correct fluorescence data in two passes
+
+    Parameters
+    ----------
+    fl: 3d ndarray
+        Fluorescence image stack (may also be a
+        :class:`cellreel.sino.shift.ShiftedStack` or an
+        h5py dataset)
+    meta_fli: list of dict
+        Meta data of each fluorescence image
+    times: 1d ndarray
+        Recording times of the fluorescence images
+    h5out: h5py.Group
+        The bleach-corrected FLSeries is written to this group
+    border_px: int
+        Number of border pixels to include for background
+        estimation.
+    denoise: bool
+        Apply the correction to the denoised images
+        (:func:`skimage.restoration.denoise_tv_chambolle`)
+    chunk_size: int
+        Number of frames that are loaded at once in the first pass
+    denoise_chunk_size: int
+        Number of frames that are denoised at once by a worker
+        process in the second pass
+    h5denoised: h5py.Group
+        If given, the denoised fluorescence images are also written
+        to this group as an FLSeries.
+
+    Returns
+    -------
+    bg: float
+        Background value subtracted from each image
+    flint: 1d ndarray
+        Fluorescence intensity trace extracted from the series
+    decay: 1d ndarray
+        Exponential fit to `flint`
+    times: 1d ndarray
+        Recording times corresponding to `flint` and `decay`
+
+    Notes
+    -----
+    This is a streaming version of
+    :func:`flimage.series.FLSeries.bleach_correction`. The first pass
+    determines the background signal and the fluorescence intensity
+    trace from the raw data in chunks of `chunk_size` frames. The
+    second pass denoises chunks of `denoise_chunk_size` frames in a
+    process pool and corrects and writes each frame to `h5out` in
+    the original order.
+    """
+    num = len(fl)
+    if max_count is not None:
+        max_count.value += 3*num
+    # first pass: background signal and intensity trace
+    border = np.ones(fl.shape[1:], dtype=bool)
+    border[border_px:-border_px, border_px:-border_px] = False
+    bgavg = np.zeros(num)
+    for start, chunk in iter_chunks(fl, chunk_size):
+        bgavg[start:start+len(chunk)] = chunk[:, border].mean(axis=1)
+        if count is not None:
+            count.value += len(chunk)
+    bg = np.mean(bgavg)
+    flint = np.zeros(num)
+    for start, chunk in iter_chunks(fl, chunk_size):
+        chunk -= bg
+        chunk[chunk < 0] = 0
+        flint[start:start+len(chunk)] = chunk.sum(axis=(1, 2))
+        if count is not None:
+            count.value += len(chunk)
+
+    # fit exponential
+    decay = fit_exponential(times, flint)
+    corr = decay[0] / decay
+
+    # second pass: denoise and correct
+    if h5denoised is not None:
+        fldn = flimage.FLSeries(h5file=h5denoised)
+    if denoise:
+        # denoising is CPU-bound; use a process pool
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=get_worker_count(),
+            mp_context=mp.get_context("spawn"))
+        chunks = imap_ordered(denoise_chunk,
+                              iter_chunks(fl, denoise_chunk_size),
+                              pool)
+    else:
+        pool = None
+        chunks = iter_chunks(fl, chunk_size)
+    try:
+        with flimage.FLSeries(h5file=h5out) as fls:
+            for start, chunk in chunks:
+                for ii, image in enumerate(chunk, start):
+                    if h5denoised is not None:
+                        fldn.add_flimage(flimage.FLImage(
+                            data=image, meta_data=meta_fli[ii]))
+                    fld = (image - bg) * corr[ii]
+                    fls.add_flimage(flimage.FLImage(data=fld,
+                                                    meta_data=meta_fli[ii]))
+                    if count is not None:
+                        count.value += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return bg, flint, decay, times
+
+
+def denoise_chunk(job):
+    """Denoise a chunk of fluorescence images
+
+    Parameters
+    ----------
+    job: tuple (int, 3d ndarray)
+        Index of the first frame and fluorescence images
+        (see :func:`iter_chunks`)
+
+    Returns
+    -------
+    start: int
+        Index of the first frame
+    denoised: 3d ndarray
+        Denoised images
+    """
+    start, chunk = job
+    denoised = np.zeros_like(chunk)
+    for ii in range(len(chunk)):
+        denoised[ii] = denoise_tv_chambolle(chunk[ii], weight=2)
+    return start, denoised
+
+
+def iter_chunks(fl, chunk_size):
+    """Yield start index and float copy of consecutive frames of `fl`"""
+    for start in range(0, len(fl), chunk_size):
+        yield start, np.array(fl[start:start+chunk_size], dtype=float)
+
 
-    # cleanup
-    os.remove(path_temp)
+def write_bleach_data(h5out, bg, flint, decay, times):
+    """Store the bleach correction trace in the group "bleach correction\""""
+    bdata = np.zeros(times.size, np.dtype([("time", float),
+                                           ("signal", float),
+                                           ("fit", float)]))
+    bdata["time"] = times
+    bdata["signal"] = flint
+    bdata["fit"] = decay
+    blc = h5out.create_group("bleach correction")
+    blc.attrs["background signal"] = bg
+    blcds = blc.create_dataset(name="fit", data=bdata)
+    blcds.attrs["CLASS"] = np.bytes_("TABLE")
+    blcds.attrs["TITLE"] = np.bytes_("Bleach correction")
+    blcds.attrs["VERSION"] = np.bytes_("0.2")
+    blcds.attrs["FIELD_0_NAME"] = np.bytes_("time")
+    blcds.attrs["FIELD_1_NAME"] = np.bytes_("signal")
+    blcds.attrs["FIELD_2_NAME"] = np.bytes_("fit")
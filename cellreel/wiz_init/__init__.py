@@ -17,6 +17,7 @@ from . import task_simulate
 from . import meta_hints
 from . import coloc
 from . import task_download
+from . import task_live
 
 # register file formats
 from .formats import flformat
@@ -129,12 +130,15 @@ class InitPageDownloadData(InitPage):
         self.pushButton.setEnabled(False)
         self.dldir.mkdir(exist_ok=True)
         key = self.comboBox.currentText()
-        task_download.download_dataset_qt5(key=key,
-                                           path=self.dldir,
-                                           progressbar=self.progressBar)
-        self.comboBox.setEnabled(True)
-        self.pushButton.setEnabled(True)
-        self.completeChanged.emit()
+        try:
+            task_download.download_dataset_qt5(key=key,
+                                               path=self.dldir,
+                                               progressbar=self.progressBar)
+        finally:
+            # allow the user to try again
+            self.comboBox.setEnabled(True)
+            self.pushButton.setEnabled(True)
+            self.completeChanged.emit()
 
     def validatePage(self):
         """Set all paths in relevant pages"""
@@ -486,6 +490,8 @@ class InitWizard(QtWidgets.QWizard):
 
         self.button(QtWidgets.QWizard.FinishButton).clicked.connect(
             self._finalize)
+        #: live import (see :mod:`.task_live`), if selected by the user
+        self.live = None
 
     def _init_pages(self):
         """Initializes all pages with their dedicated logic"""
@@ -582,9 +588,7 @@ class InitWizard(QtWidgets.QWizard):
                      "interval end": end,
                      }
             meta_hints.save_hints(path_qpi=pown.path_data_qpi, hints=hints)
-            # perform conversion
-            task_convert.convert(
-                path_out=path,
+            convkw = dict(
                 path_qpi=pown.path_data_qpi,
                 path_qpi_bg=pown.path_data_qpi_bg,
                 path_fl=pown.path_data_fl,
@@ -593,10 +597,20 @@ class InitWizard(QtWidgets.QWizard):
                 medium_index=pown.params_meta_qp["medium index"],
                 slice_qpi=(slice(int(px), int(px+sx)),
                            slice(int(py), int(py+sy))),
-                interval_qpi=(start, end),
                 bgkw_qpi=bgkw_qpi,
                 colockw=self.get_coloc_kwargs(),
             )
+            if pown.checkBox_live.isChecked():
+                # import the frames recorded so far; the remaining
+                # frames are imported by the main window
+                self.live = task_live.LiveImport(
+                    path_sino=path / "sinogram.h5", **convkw)
+                self.live.poll(stable_only=False)
+            else:
+                # perform conversion
+                task_convert.convert(path_out=path,
+                                     interval_qpi=(start, end),
+                                     **convkw)
 
         self.path = path
 
@@ -0,0 +1,164 @@
+"""Vectorized QPI background estimation for batches of images"""
+import numpy as np
+import qpimage
+from qpimage import bg_estimate
+from qpimage.image_data import Amplitude, Phase
+
+
+#: Background keyword arguments supported by :func:`estimate`
+BATCH_KEYS = ["fit_offset", "fit_profile", "border_px"]
+
+#: Oldest qpimage version supported by :func:`set_bg_fit`
+QPIMAGE_MIN_VERSION = (0, 6)
+
+
+def can_batch(bgkw):
+    """Whether the background keyword arguments support batch estimation
+
+    Batch estimation is possible if the background mask is the
+    same for all images, i.e. if it is defined by `border_px`
+    only (see :func:`qpimage.QPImage.compute_bg`), and if the
+    installed qpimage version is supported by :func:`set_bg_fit`.
+    """
+    return (set(bgkw).issubset(BATCH_KEYS)
+            and bgkw.get("border_px", 0) > 0
+            and get_qpimage_version() >= QPIMAGE_MIN_VERSION)
+
+
+def estimate(data, fit_offset="mean", fit_profile="tilt", border_px=0):
+    """Estimate the background of a stack of images
+
+    This is a vectorized version of :func:`qpimage.bg_estimate.estimate`
+    for a mask defined by `border_px`. The profile is fitted to all
+    images with a single linear least-squares solve.
+
+    Parameters
+    ----------
+    data: 3d ndarray of shape (N, X, Y)
+        Images from which to compute the background
+    fit_offset: str
+        The method for computing the profile offset
+        (see :data:`qpimage.bg_estimate.VALID_FIT_OFFSETS`)
+    fit_profile: str
+        The type of background profile to fit
+        (see :data:`qpimage.bg_estimate.VALID_FIT_PROFILES`)
+    border_px: float
+        A frame of `border_px` pixels around each image is
+        used for background estimation.
+
+    Returns
+    -------
+    bgimg: 3d ndarray of shape (N, X, Y)
+        Background images
+    """
+    if fit_profile not in bg_estimate.VALID_FIT_PROFILES:
+        msg = "`fit_profile` must be one of {}, got '{}'".format(
+            bg_estimate.VALID_FIT_PROFILES,
+            fit_profile)
+        raise ValueError(msg)
+    if fit_offset not in bg_estimate.VALID_FIT_OFFSETS:
+        msg = "`fit_offset` must be one of {}, got '{}'".format(
+            bg_estimate.VALID_FIT_OFFSETS,
+            fit_offset)
+        raise ValueError(msg)
+    if fit_offset == "fit" and fit_profile == "offset":
+        msg = "`fit_offset=='fit'` only valid when `fit_profile!='offset`"
+        raise ValueError(msg)
+    data = np.asarray(data, dtype=float)
+    shape = data.shape[1:]
+    mask = get_border_mask(shape, border_px)
+    # values in the mask (one column per image)
+    values = data[:, mask].T
+    # compute background images
+    basis = get_profile_basis(shape, fit_profile)
+    if len(basis):
+        design = basis[:, mask].T
+        coeffs = np.linalg.lstsq(design, values, rcond=None)[0]
+        bgimg = np.tensordot(coeffs.T, basis, axes=1)
+    else:
+        bgimg = np.zeros_like(data)
+    # add offsets
+    if fit_offset == "fit":
+        # nothing else to do here, using offset from fit
+        pass
+    elif fit_offset == "mean":
+        residual = data[:, mask] - bgimg[:, mask]
+        bgimg += residual.mean(axis=1).reshape(-1, 1, 1)
+    else:
+        if fit_offset == "gauss":
+            offset_func = bg_estimate.offset_gaussian
+        else:
+            offset_func = bg_estimate.offset_mode
+        for ii in range(len(data)):
+            bgimg[ii] += offset_func((data[ii] - bgimg[ii])[mask])
+    return bgimg
+
+
+def get_border_mask(shape, border_px):
+    """Return the background mask for a frame of `border_px` pixels"""
+    border_px = int(np.round(border_px))
+    mask = np.zeros(shape, dtype=bool)
+    mask[:border_px, :] = True
+    mask[-border_px:, :] = True
+    mask[:, :border_px] = True
+    mask[:, -border_px:] = True
+    return mask
+
+
+def get_qpimage_version():
+    """Return the major and minor version of qpimage as a tuple"""
+    parts = qpimage.__version__.split(".")[:2]
+    return tuple(int("".join(c for c in pp if c.isdigit()) or 0)
+                 for pp in parts)
+
+
+def get_profile_basis(shape, fit_profile):
+    """Return the basis images of a background profile
+
+    The coordinates are defined as in
+    :func:`qpimage.bg_estimate.tilt_model` and
+    :func:`qpimage.bg_estimate.poly2o_model`.
+
+    Returns
+    -------
+    basis: 3d ndarray of shape (K, X, Y)
+        Basis images; K is zero for the "offset" profile.
+    """
+    x = np.arange(shape[0]).reshape(-1, 1) - shape[0] // 2
+    y = np.arange(shape[1]).reshape(1, -1) - shape[1] // 2
+    one = np.ones(shape)
+    if fit_profile == "tilt":
+        terms = [one, x * one, y * one]
+    elif fit_profile == "poly2o":
+        terms = [one, x * one, y * one, x * y, x**2 * one, y**2 * one]
+    else:
+        terms = []
+    return np.array(terms, dtype=float).reshape(len(terms), *shape)
+
+
+def set_bg_fit(qpi, bg_pha, bg_amp, attrs=None):
+    """Set the "fit" background of a QPImage
+
+    This is the equivalent of :func:`qpimage.QPImage.compute_bg`
+    for backgrounds computed with :func:`estimate`. QPImage does
+    not offer a method for setting a fitted background, so the
+    public image data classes of :mod:`qpimage.image_data` are
+    used on the HDF5 groups of `qpi`.
+
+    Parameters
+    ----------
+    qpi: qpimage.QPImage
+        QPImage to modify (must be opened in write mode)
+    bg_pha, bg_amp: 2d ndarray or None
+        Phase and amplitude background images; If None, the
+        "fit" background is removed.
+    attrs: dict
+        Background attributes (e.g. the keyword arguments of
+        :func:`estimate`)
+    """
+    if attrs is None:
+        attrs = {}
+    for cls, key, bg in [(Phase, "phase", bg_pha),
+                         (Amplitude, "amplitude", bg_amp)]:
+        imdat = cls(qpi.h5[key], h5dtype=qpi.h5dtype)
+        imdat.set_bg(bg=bg, key="fit", attrs=attrs)
@@ -1,5 +1,7 @@
 """Fluorescence to QPI colocalization"""
-from skimage.transform import warp
+import numpy as np
+import scipy.ndimage as ndi
+from skimage.util import img_as_float
 
 
 # field_x,216.48
@@ -39,14 +41,72 @@ def transform_function(output_coords,
     return input_coords
 
 
+def get_affine(p_qp=(0, 0), p_fl=(0, 0), res_qp=1, res_fl=1):
+    """Return the affine transform equivalent to :func:`transform_function`
+
+    Returns
+    -------
+    matrix: 2d ndarray of shape (2, 2)
+        Transformation matrix in array index (row, col) coordinates
+    offset: 1d ndarray of shape (2,)
+        Offset in array index coordinates
+
+    Notes
+    -----
+    The output is meant to be used with
+    :func:`scipy.ndimage.affine_transform`. The coordinate
+    order is reversed with respect to :func:`transform_function`.
+    """
+    scale = res_qp / res_fl
+    matrix = np.diag([scale, scale])
+    offset = np.array([p_fl[1] - scale * p_qp[1],
+                       p_fl[0] - scale * p_qp[0]])
+    return matrix, offset
+
+
 def warp_fl(fl, p_qp, p_fl, res_qp, res_fl, output_shape):
-    flc = warp(image=fl,
-               inverse_map=transform_function,
-               map_args={"p_qp": p_qp,
-                         "p_fl": p_fl,
-                         "res_qp": res_qp,
-                         "res_fl": res_fl
-                         },
-               output_shape=output_shape,
-               )
+    """Warp a fluorescence image to the QPI sensor coordinates
+
+    This is equivalent to :func:`skimage.transform.warp` with
+    :func:`transform_function` as the inverse map, but uses the
+    precomputed affine transform from :func:`get_affine`.
+    """
+    return warp_fl_batch(fls=[fl],
+                         p_qp=p_qp,
+                         p_fl=p_fl,
+                         res_qp=res_qp,
+                         res_fl=res_fl,
+                         output_shape=output_shape)[0]
+
+
+def warp_fl_batch(fls, p_qp, p_fl, res_qp, res_fl, output_shape):
+    """Warp a stack of fluorescence images (see :func:`warp_fl`)
+
+    Parameters
+    ----------
+    fls: 3d ndarray or list of 2d ndarrays
+        Fluorescence images of the same shape
+    p_qp, p_fl, res_qp, res_fl:
+        Colocalization parameters (see :func:`transform_function`)
+    output_shape: tuple of ints
+        Shape of the warped images
+
+    Returns
+    -------
+    flc: 3d ndarray
+        Warped images (float, with the same value scaling
+        as :func:`skimage.util.img_as_float`)
+    """
+    matrix, offset = get_affine(p_qp=p_qp, p_fl=p_fl, res_qp=res_qp,
+                                res_fl=res_fl)
+    flc = np.zeros((len(fls),) + tuple(output_shape))
+    for ii, fl in enumerate(fls):
+        ndi.affine_transform(input=img_as_float(fl),
+                             matrix=matrix,
+                             offset=offset,
+                             output_shape=output_shape,
+                             output=flc[ii],
+                             order=1,
+                             mode="grid-constant",
+                             cval=0)
     return flc
@@ -1,5 +1,8 @@
+import collections
+import json
 import pathlib
 import sys
+import uuid
 import warnings
 
 import flimage
@@ -8,18 +11,30 @@ import imageio
 import numpy as np
 import tifffile
 
+from .... import cache as fcache
 from .dataset import DataSet
 
 
 ISWIN = sys.platform.startswith("win")
 
+#: Maximum size of the cache for video seek indices [B]
+SEEK_INDEX_CACHE_SIZE = 16 * 1024**2
+
 
 class SeriesAvi(DataSet):
+    #: Number of decoded frames kept in memory for random access
+    cache_size = 8
+    #: Maximum distance of frames for which imageio decodes forward
+    #: instead of seeking (see :func:`SeriesAvi._get_image_workaround_seek`)
+    seek_step = 50
+
     def __init__(self, *args, **kwargs):
         super(SeriesAvi, self).__init__(*args, **kwargs)
         self._cap = None
         self._length = None
         self._frame_times = None
+        self._cache = collections.OrderedDict()
+        self._seek_index = None
 
     def __del__(self):
         if self._cap is not None:
@@ -41,32 +56,78 @@ class SeriesAvi(DataSet):
         if self._length is None:
             cap = self.video_handle
             length = len(cap)
+            if length == sys.maxsize or length == float("inf"):
+                # newer versions of imageio do not estimate the length
+                length = cap.count_frames()
             self._length = length
         return self._length
 
+    @staticmethod
+    def _convert_frame(frame):
+        """Flip a video frame and convert it to gray scale"""
+        cellimg = frame[::-1, :]
+        if len(cellimg.shape) == 3:
+            cellimg = np.array(cellimg[:, :, 0])
+        return cellimg
+
     def _get_frame(self, idx):
         """Returns the requested frame from the video in gray scale"""
+        if idx in self._cache:
+            self._cache.move_to_end(idx)
+            return self._cache[idx]
         cap = self.video_handle
-        cellimg = cap.get_data(idx)[::-1, :]
+        cellimg = cap.get_data(idx)
         if np.all(cellimg == 0):
             cellimg = self._get_image_workaround_seek(idx)
-        # Convert to grayscale
-        if len(cellimg.shape) == 3:
-            cellimg = np.array(cellimg[:, :, 0])
+        else:
+            self._add_seek_point(idx)
+        cellimg = self._convert_frame(cellimg)
+        self._cache[idx] = cellimg
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
         return cellimg
 
     def _get_image_workaround_seek(self, idx):
         """Same as __getitem__ but seek through the video beforehand
         This is a workaround for an all-zero image returned by `imageio`.
+
+        Instead of seeking, the frames are decoded forward in steps of
+        :const:`SeriesAvi.seek_step` starting at the closest frame for
+        which seeking is known to work (see :func:`SeriesAvi.seek_index`).
         """
         warnings.warn("imageio workaround used!")
         cap = self.video_handle
-        mult = 50
-        for ii in range(idx//mult):
-            cap.get_data(ii*mult)
-        final = cap.get_data(idx)[::-1, :]
+        start = max([ii for ii in self.seek_index if ii <= idx], default=0)
+        for ii in range(start, idx, self.seek_step):
+            cap.get_data(ii)
+        final = cap.get_data(idx)
+        if not np.all(final == 0):
+            self._add_seek_point(idx)
         return final
 
+    def _add_seek_point(self, idx):
+        """Remember that seeking to frame `idx` works"""
+        index = self.seek_index
+        if idx not in index:
+            # only keep points that are sufficiently far apart
+            if all(abs(idx - ii) >= self.seek_step for ii in index):
+                index.append(idx)
+                index.sort()
+                self._save_seek_index()
+
+    def _save_seek_index(self):
+        """Store the seek index in the user cache directory"""
+        try:
+            path = self.path_seek_index
+            tmp = path.with_name(".{}.json".format(uuid.uuid4().hex))
+            with tmp.open("w") as fd:
+                json.dump({"seek points": self._seek_index}, fd)
+            get_seek_index_cache().put(path.name, tmp)
+            tmp.unlink()
+        except OSError:
+            # e.g. read-only cache directory
+            pass
+
     @property
     def frame_times(self):
         if self._frame_times is None:
@@ -80,6 +141,36 @@ class SeriesAvi(DataSet):
             assert len(times) == len(self)
         return self._frame_times
 
+    @property
+    def path_seek_index(self):
+        """Path to the persisted seek index of the video
+
+        The index is stored in the "seekindex" cache in the user
+        cache directory with a file name derived from the location,
+        size, and modification time of the video
+        (see :func:`cellreel.cache.get_file_key`).
+        """
+        key = fcache.get_file_key(self.path) + ".json"
+        return get_seek_index_cache().get_path(key)
+
+    @property
+    def seek_index(self):
+        """Sorted list of frames for which seeking in the video works
+
+        The index is persisted (see :func:`SeriesAvi.path_seek_index`)
+        and extended whenever a frame is successfully accessed via
+        seeking.
+        """
+        if self._seek_index is None:
+            index = [0]
+            try:
+                with self.path_seek_index.open() as fd:
+                    index = json.load(fd)["seek points"]
+            except (OSError, ValueError, KeyError):
+                pass
+            self._seek_index = index
+        return self._seek_index
+
     @property
     def video_handle(self):
         if self._cap is None:
@@ -88,6 +179,9 @@ class SeriesAvi(DataSet):
 
     def get_flimage(self, idx=0):
         fl = self._get_frame(idx)
+        return self._make_flimage(fl, idx)
+
+    def _make_flimage(self, fl, idx):
         fli = flimage.FLImage(data=fl, meta_data=self.meta_data)
         fli["time"] = self.get_time(idx)
         fli["identifier"] = self.get_identifier(idx)
@@ -96,18 +190,47 @@ class SeriesAvi(DataSet):
     def get_time(self, idx):
         return self.frame_times[idx]
 
+    def get_times(self):
+        return np.array(self.frame_times, dtype=float)
+
+    def iter_flimages(self, indices=None):
+        """Iterate over the FLImages by decoding the video sequentially
+
+        Each frame of the video (up to the last requested index)
+        is decoded exactly once.
+        """
+        if indices is None:
+            indices = range(len(self))
+        wanted = set(indices)
+        if not wanted:
+            return
+        last = max(wanted)
+        with imageio.get_reader(self.path) as reader:
+            for idx, frame in enumerate(reader):
+                if idx in wanted:
+                    yield self._make_flimage(self._convert_frame(frame), idx)
+                if idx == last:
+                    break
+
 
 class SeriesH5(DataSet):
     def __init__(self, *args, **kwargs):
         super(SeriesH5, self).__init__(*args, **kwargs)
+        self._h5 = None
+        self._times = None
         self._init_meta()
 
+    def __del__(self):
+        self.close()
+
     def __len__(self):
-        with self._flseries() as fls:
-            return len(fls)
+        return len(self.get_times())
 
     def _flseries(self):
-        return flimage.FLSeries(h5file=self.path, h5mode="r")
+        """Return the FLSeries using a persistent read-only file handle"""
+        if self._h5 is None:
+            self._h5 = h5py.File(self.path, mode="r")
+        return flimage.FLSeries(h5file=self._h5, h5mode="r")
 
     def _init_meta(self):
         # update meta data
@@ -119,15 +242,37 @@ class SeriesH5(DataSet):
                     and key in attrs):
                 self.meta_data[key] = attrs[key]
 
+    def close(self):
+        """Close the HDF5 file handle"""
+        if getattr(self, "_h5", None) is not None:
+            self._h5.close()
+            self._h5 = None
+
     def get_flimage(self, idx=0):
         with self._flseries() as fls:
             fli = fls[idx].copy()
         return fli
 
     def get_time(self, idx):
+        return self.get_times()[idx]
+
+    def get_times(self):
+        """Return the recording times of all frames (read once)"""
+        if self._times is None:
+            with self._flseries() as fls:
+                h5 = fls.h5
+                self._times = np.array(
+                    [h5["fli_{}".format(ii)].attrs["time"]
+                     for ii in range(len(fls))], dtype=float)
+        return self._times
+
+    def iter_flimages(self, indices=None):
+        """Iterate over the FLImages using the persistent file handle"""
+        if indices is None:
+            indices = range(len(self))
         with self._flseries() as fls:
-            time = fls[idx].meta["time"]
-        return time
+            for idx in indices:
+                yield fls[idx].copy()
 
 
 class SingleH5(DataSet):
@@ -141,6 +286,9 @@ class SingleH5(DataSet):
                     and key in attrs):
                 self.meta_data[key] = attrs[key]
 
+    def __len__(self):
+        return 1
+
     def get_flimage(self, idx=0):
         """Return background-corrected QPImage"""
         # We can use the background data stored in the qpimage hdf5 file
@@ -178,3 +326,8 @@ def load_data(path, meta_data={}):
             return SeriesH5(path, meta_data=meta_data)
         except KeyError:
             return SingleH5(path, meta_data=meta_data)
+
+
+def get_seek_index_cache():
+    """Return the cache for video seek indices (see :class:`SeriesAvi`)"""
+    return fcache.get_cache("seekindex", max_size=SEEK_INDEX_CACHE_SIZE)
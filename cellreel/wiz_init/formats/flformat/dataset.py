@@ -54,6 +54,30 @@ class DataSet(object):
         """
         return "{}:{}".format(self.identifier, idx + 1)
 
+    def get_times(self):
+        """Return the recording times of all frames"""
+        return np.array([self.get_time(ii) for ii in range(len(self))],
+                        dtype=float)
+
+    def iter_flimages(self, indices=None):
+        """Iterate over the FLImages of the data set
+
+        Parameters
+        ----------
+        indices: list of int
+            Indices of the frames to return in ascending order;
+            defaults to all frames.
+
+        Notes
+        -----
+        Subclasses may override this method with a more efficient
+        implementation for sequential access (e.g. video files).
+        """
+        if indices is None:
+            indices = range(len(self))
+        for idx in indices:
+            yield self.get_flimage(idx)
+
     def saveh5(self, h5file):
         """Save the data set as an hdf5 file (flimage.FLSeries format)
 
@@ -69,8 +93,7 @@ class DataSet(object):
                  }
 
         with flimage.FLSeries(**qpskw) as fls:
-            for ii in range(len(self)):
-                fli = self.get_flimage(ii)
+            for fli in self.iter_flimages():
                 fls.add_flimage(fli)
 
 
@@ -1,9 +1,11 @@
 """Importing this module will register a custom formats in qpformat"""
+import concurrent.futures
 import copy
 import functools
+import io
 import pathlib
-import tempfile
-import shutil
+import threading
+import uuid
 import warnings
 import zipfile
 
@@ -13,23 +15,27 @@ import qpimage
 import qpformat.file_formats
 from qpformat.file_formats.single_tif_phasics import INTENSITY_BASELINE_CLAMP
 
+from ... import cache as fcache
+
+
+#: Maximum size of the cache for parsed txt data [B] (see :func:`load_file`)
+CACHE_SIZE = 5 * 1024**3
+
 
 class SingleGuck(qpformat.file_formats.SingleData):
     """Single txt-based phase/intensity files
     """
     storage_type = "phase,intensity"
+    #: Cache the parsed data in the user cache directory
+    #: (see :func:`load_file`)
+    cache = False
 
     def get_qpimage_raw(self, idx=0):
         """Return QPImage without background correction"""
         # Load experimental data
-        if "wavelength" in self.meta_data:
-            wlnm = self.meta_data["wavelength"] * 1e9
-        else:
-            wlnm = 550
-            warnings.warn("Guessing wavelength of 550nm for '{}'!".format(
-                self.path))
-        phase, inten = load_phase_intensity(self.path, wavelength_nm=wlnm)
-        inten[inten < 0] = 0
+        wlnm = get_wavelength_nm(self.meta_data, self.path)
+        phase, inten = load_phase_intensity(self.path, wavelength_nm=wlnm,
+                                            cache=self.cache)
         meta_data = copy.copy(self.meta_data)
         qpi = qpimage.QPImage(data=(phase, inten),
                               which_data="phase,intensity",
@@ -55,28 +61,36 @@ class SingleGuck(qpformat.file_formats.SingleData):
 class SeriesZipGuck(qpformat.file_formats.SeriesData):
     """Custom Guck-lab zip file with phase and intensity txt files
 
-    The data are stored as text files in a zip file.
+    The data are stored as text files in a zip file. The zip file
+    is kept open and the files are parsed from memory. The next
+    `readahead` frames are loaded in background threads.
     """
     storage_type = "phase,intensity"
+    #: Number of frames loaded ahead of the requested frame
+    readahead = 2
 
     def __init__(self, *args, **kwargs):
         super(SeriesZipGuck, self).__init__(*args, **kwargs)
         self._files = None
-        self._dataset = None
+        self._times = None
+        self._zf = None
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __del__(self):
+        if hasattr(self, "_pending"):
+            self.close()
 
     def __len__(self):
         return len(self.files)
 
-    def _get_dataset(self, idx):
-        # Use ``zipfile.ZipFile.open`` to return an open file
-        zf = zipfile.ZipFile(self.path)
-        tdir = tempfile.mkdtemp()
-        zf.extract(self.files[idx], tdir)
-        zf.extract(self.files[idx][:-5]+"intensity", tdir)
-        path = pathlib.Path(tdir) / self.files[idx]
-        ds = SingleGuck(path=path,
-                        meta_data=self.meta_data)
-        return ds, tdir
+    def _get_zipfile(self):
+        """Return the open zip file (`zipfile.ZipFile` is thread-safe)"""
+        with self._lock:
+            if self._zf is None:
+                self._zf = zipfile.ZipFile(self.path)
+            return self._zf
 
     @staticmethod
     @functools.lru_cache(maxsize=32)
@@ -88,6 +102,35 @@ class SeriesZipGuck(qpformat.file_formats.SeriesData):
             names = [nn for nn in names if nn.startswith("SID")]
             return names
 
+    def _load_frame(self, idx):
+        """Parse the phase and intensity data of frame `idx`"""
+        zf = self._get_zipfile()
+        name = self.files[idx]
+        return phase_intensity_from_txt(
+            phase_txt=zf.read(name),
+            inten_txt=zf.read(name[:-5] + "intensity"),
+            wavelength_nm=get_wavelength_nm(self.meta_data, self.path))
+
+    def _get_frame(self, idx):
+        """Return phase and intensity of frame `idx` and read ahead"""
+        if self.readahead:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.readahead)
+            future = self._pending.pop(idx, None)
+            # discard frames that were not requested in order
+            for key in list(self._pending):
+                if not idx < key <= idx + self.readahead:
+                    self._pending.pop(key).cancel()
+            for key in range(idx + 1, min(idx + self.readahead + 1,
+                                          len(self))):
+                if key not in self._pending:
+                    self._pending[key] = self._pool.submit(
+                        self._load_frame, key)
+            if future is not None:
+                return future.result()
+        return self._load_frame(idx)
+
     @property
     def files(self):
         """List of Phasics tif file names in the input zip file"""
@@ -95,23 +138,34 @@ class SeriesZipGuck(qpformat.file_formats.SeriesData):
             self._files = SeriesZipGuck._index_files(self.path)
         return self._files
 
+    def close(self):
+        """Close the zip file and stop reading ahead"""
+        for future in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+
     def get_qpimage_raw(self, idx):
         """Return QPImage without background correction"""
-        ds, tdir = self._get_dataset(idx)
-        qpi = ds.get_qpimage_raw()
+        phase, inten = self._get_frame(idx)
+        qpi = qpimage.QPImage(data=(phase, inten),
+                              which_data="phase,intensity",
+                              meta_data=copy.copy(self.meta_data),
+                              h5dtype=self.as_type)
         qpi["identifier"] = self.get_identifier(idx)
         qpi["time"] = self.get_time(idx)
-        shutil.rmtree(tdir, ignore_errors=True)
         return qpi
 
     def get_time(self, idx):
         # Obtain the time from the text file name
-        name = self.files[idx]
-        _, _, t1 = name.split()
-        t2, t3, _ = t1.split(".")
-        h, m, s = t2.strip("-").split("_")
-        us = t3
-        return int(h)*60*60 + int(m) * 60 + int(s) + int(us)*1e-5
+        if self._times is None:
+            self._times = [get_time_from_name(nn) for nn in self.files]
+        return self._times[idx]
 
     @staticmethod
     def verify(path):
@@ -132,29 +186,136 @@ class SeriesZipGuck(qpformat.file_formats.SeriesData):
         return valid
 
 
-def load_file(path):
-    """Load a txt data file"""
+def get_time_from_name(name):
+    """Return the recording time [s] encoded in a Guck-lab file name"""
+    _, _, t1 = name.split()
+    t2, t3, _ = t1.split(".")
+    h, m, s = t2.strip("-").split("_")
+    us = t3
+    return int(h)*60*60 + int(m) * 60 + int(s) + int(us)*1e-5
+
+
+def get_wavelength_nm(meta_data, path):
+    """Return the wavelength [nm] from `meta_data` (default 550nm)"""
+    if "wavelength" in meta_data:
+        wlnm = meta_data["wavelength"] * 1e9
+    else:
+        wlnm = 550
+        warnings.warn("Guessing wavelength of 550nm for '{}'!".format(path))
+    return wlnm
+
+
+def load_file(path, cache=False):
+    """Load a txt data file
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        Path to the txt file; Comma and point decimal separators
+        are supported and lines starting with "#" are ignored.
+    cache: bool
+        If True, the parsed data are stored as a binary ".npy" file
+        in the "guck-txt" cache in the user cache directory (see
+        :func:`get_cache_path`) that is used instead of parsing
+        `path` as long as `path` is not modified.
+
+    Returns
+    -------
+    data: 2d ndarray
+        The data with the row order reversed
+    """
     path = pathlib.Path(path)
-    data = path.open().readlines()
-    # remove comments and empty lines
-    data = [ll for ll in data if len(ll.strip()) and not ll.startswith("#")]
-    # determine data shape
-    n = len(data)
-    m = len(data[0].strip().split())
-    res = np.zeros((n, m), dtype=np.dtype(float))
-    # write data to array, replacing comma with point decimal separator
-    for ii in range(n):
-        res[ii] = np.array(data[ii].strip().replace(",", ".").split(),
-                           dtype=float)
+    if cache:
+        try:
+            txt_cache = get_txt_cache()
+            key = get_cache_path(path).name
+        except OSError:
+            # e.g. no user cache directory
+            cache = False
+        else:
+            path_cache = txt_cache.get(key)
+            if path_cache is not None:
+                try:
+                    return np.load(path_cache)
+                except (OSError, ValueError):
+                    # corrupt cache file
+                    pass
+    with path.open("rb") as fd:
+        res = parse_txt(fd.read())
+    if cache:
+        tmp = txt_cache.path / ".{}.npy".format(uuid.uuid4().hex)
+        try:
+            np.save(tmp, res)
+            txt_cache.put(key, tmp)
+        except OSError:
+            # e.g. disk full
+            pass
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+    return res
+
+
+def get_cache_path(path):
+    """Return the path of the ".npy" cache file of a txt data file
+
+    The file name is derived from the location, size, and
+    modification time of `path` (see :func:`cellreel.cache.get_file_key`).
+    """
+    key = fcache.get_file_key(path) + ".npy"
+    return get_txt_cache().get_path(key)
+
+
+def get_txt_cache():
+    """Return the cache for parsed txt data (see :func:`load_file`)"""
+    return fcache.get_cache("guck-txt", max_size=CACHE_SIZE)
+
+
+def parse_txt(text):
+    """Parse the contents of a txt data file
+
+    Parameters
+    ----------
+    text: bytes or str
+        Whitespace-separated data with one row per line
+
+    Returns
+    -------
+    data: 2d ndarray
+        The data with the row order reversed
+    """
+    if isinstance(text, str):
+        text = text.encode()
+    # Replace comma with point decimal separator and convert all
+    # values at once (comments and empty lines are skipped).
+    res = np.loadtxt(io.BytesIO(text.replace(b",", b".")),
+                     dtype=float,
+                     comments="#",
+                     ndmin=2)
     return res[::-1, :]
 
 
-def load_phase_intensity(path, wavelength_nm):
+def load_phase_intensity(path, wavelength_nm, cache=False):
     """Load QPI data using *tif_phase files"""
     path = pathlib.Path(path)
-    phase = load_file(path)*550/wavelength_nm*2*np.pi
-    inten = load_file(path.with_suffix(".tif_intensity"))
-    return phase, inten - INTENSITY_BASELINE_CLAMP
+    phase = load_file(path, cache=cache)
+    inten = load_file(path.with_suffix(".tif_intensity"), cache=cache)
+    return convert_phase_intensity(phase, inten, wavelength_nm)
+
+
+def convert_phase_intensity(phase, inten, wavelength_nm):
+    """Convert the txt file data to phase [rad] and intensity"""
+    phase = phase*550/wavelength_nm*2*np.pi
+    inten = inten - INTENSITY_BASELINE_CLAMP
+    inten[inten < 0] = 0
+    return phase, inten
+
+
+def phase_intensity_from_txt(phase_txt, inten_txt, wavelength_nm):
+    """Parse phase and intensity txt data from memory"""
+    return convert_phase_intensity(phase=parse_txt(phase_txt),
+                                   inten=parse_txt(inten_txt),
+                                   wavelength_nm=wavelength_nm)
 
 
 def register_custom_formats():
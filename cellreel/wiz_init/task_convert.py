@@ -1,30 +1,37 @@
+import concurrent.futures
+import functools
+import hashlib
+import itertools
+import json
 import multiprocessing as mp
+import os
+import pathlib
+import shutil
 import time
 
+import appdirs
 import flimage
 import h5py
+import numpy as np
 from PyQt5 import QtCore, QtWidgets
 import qpformat
 import qpimage
 
 
+from . import bg_batch
 from . import coloc
 from .formats import flformat
 from .._version import version
+from ..parallel import get_worker_count, imap_ordered, run_in_thread
 
 
-class ConvertThread(QtCore.QThread):
-    def __init__(self, ds, dskw, *args, **kwargs):
-        super(ConvertThread, self).__init__(*args, **kwargs)
-        self.ds = ds
-        self.dskw = dskw
-
-    def run(self):
-        self.ds.saveh5(**self.dskw)
+#: Staging files of other imports older than this are removed [s]
+STAGING_MAX_AGE = 30 * 24 * 60**2
 
 
 def convert(path_out, path_qpi, path_qpi_bg, path_fl, wavelength, pixel_size,
-            medium_index, slice_qpi, interval_qpi, bgkw_qpi, colockw):
+            medium_index, slice_qpi, interval_qpi, bgkw_qpi, colockw,
+            fl_batch_size=16):
     """Convert experimental data to the subjoined QPSeries/FLSeries format
 
     Parameters
@@ -52,6 +59,23 @@ def convert(path_out, path_qpi, path_qpi_bg, path_fl, wavelength, pixel_size,
     bgkw_qpi: dict
         Additional background keyword arguments
         (see :class:`qpimage.QPImage`)
+    colockw: dict
+        Colocalization parameters (see :func:`coloc.warp_fl`)
+    fl_batch_size: int
+        Number of fluorescence frames warped at once by a
+        worker thread
+
+    Notes
+    -----
+    The import is performed in a staging file in the user cache
+    directory (see :func:`prepare_staging`) which is moved to
+    "sinogram.h5" in `path_out` when all steps are complete (see
+    :func:`finish_staging`). Each step (QPI import, background
+    correction, fluorescence colocalization) records its progress
+    in the staging file. If the import is interrupted, calling this
+    function with the same parameters (but possibly a different
+    `path_out`) continues with the first frame that was not
+    completed.
     """
     count = mp.Value('I', 0, lock=True)
     max_count = mp.Value('I', 0, lock=True)
@@ -72,52 +96,72 @@ def convert(path_out, path_qpi, path_qpi_bg, path_fl, wavelength, pixel_size,
 
     path_sino = path_out / "sinogram.h5"
 
-    with h5py.File(path_sino, mode="w") as h5:
+    # The data are written to a staging file which is renamed when
+    # the import is complete. An interrupted import with the same
+    # parameters continues from the last checkpoint.
+    import_key = get_import_key(path_qpi=path_qpi,
+                                path_qpi_bg=path_qpi_bg,
+                                path_fl=path_fl,
+                                wavelength=wavelength,
+                                pixel_size=pixel_size,
+                                medium_index=medium_index,
+                                slice_qpi=slice_qpi,
+                                interval_qpi=interval_qpi,
+                                bgkw_qpi=bgkw_qpi,
+                                colockw=colockw)
+    path_stage = prepare_staging(get_staging_dir(), import_key)
+
+    bar = QtWidgets.QProgressDialog("Converting QPI data...",
+                                    "This button does nothing",
+                                    count.value,
+                                    max_count.value)
+    bar.setCancelButton(None)
+    bar.setAutoClose(False)
+    bar.setMinimumDuration(0)
+    bar.setWindowTitle("Measurement import")
+
+    with h5py.File(path_stage, mode="a") as h5:
         h5.attrs["CellReel version"] = version
+        h5.attrs["import key"] = import_key
         h5qps = h5.require_group("qpseries")
-        dskw = {"count": count,
-                "max_count": max_count,
-                "h5file": h5qps,
-                "qpi_slice": slice_qpi,
-                "time_interval": (ta, tb),
-                }
-        convthread = ConvertThread(ds=ds_qp, dskw=dskw)
-        convthread.start()
-
-        bar = QtWidgets.QProgressDialog("Converting QPI data...",
-                                        "This button does nothing",
-                                        count.value,
-                                        max_count.value)
-        bar.setCancelButton(None)
-        bar.setAutoClose(False)
-        bar.setMinimumDuration(0)
-        bar.setWindowTitle("Measurement import")
-
-        # Show a progress until computation is done
-        while count.value == 0 or count.value < max_count.value:
-            time.sleep(.05)
-            bar.setValue(count.value)
-            bar.setMaximum(max_count.value)
-            QtCore.QCoreApplication.instance().processEvents()
-
-        # make sure the thread finishes
-        convthread.wait()
+        if not h5qps.attrs.get("import complete", False):
+            # continue after the last completed frame
+            start, size = h5qps.attrs.get("import checkpoint", (0, 0))
+            truncate_series(h5qps, size)
+            dskw = {"ds": ds_qp,
+                    "load_kw": {"path": path_qpi,
+                                "bg_data": path_qpi_bg,
+                                "meta_data": {"wavelength": wavelength,
+                                              "pixel size": pixel_size,
+                                              "medium index": medium_index}},
+                    "h5file": h5qps,
+                    "qpi_slice": slice_qpi,
+                    "time_interval": (ta, tb),
+                    "t0": ta,
+                    "start": int(start),
+                    "count": count,
+                    "max_count": max_count,
+                    }
+            # Show a progress until computation is done
+            run_in_thread(func=import_qpi, fkw=dskw, bar=bar, count=count,
+                          max_count=max_count)
+            h5qps.attrs["import complete"] = True
 
         # Perform background correction
-        with qpimage.QPSeries(h5file=h5qps) as qps:
-            bar.setLabelText("Performing QPI background correction...")
-            bar.setValue(0)
-            bar.setMaximum(len(qps))
-            if path_fl is None:
-                bar.setAutoClose(True)
-
-            for qpi in qps:
-                # initial time
-                qpi["time"] = qpi["time"] - ta
-                # background correction
-                qpi.compute_bg(which_data=["phase", "amplitude"], **bgkw_qpi)
-                bar.setValue(bar.value() + 1)
-                QtCore.QCoreApplication.instance().processEvents()
+        count.value = 0
+        max_count.value = 0
+        bar.setLabelText("Performing QPI background correction...")
+        bar.setValue(0)
+        if path_fl is None:
+            bar.setAutoClose(True)
+        bgkw = {"h5file": h5qps,
+                "bgkw": bgkw_qpi,
+                "start": int(h5qps.attrs.get("bg checkpoint", 0)),
+                "count": count,
+                "max_count": max_count,
+                }
+        run_in_thread(func=correct_bg, fkw=bgkw, bar=bar, count=count,
+                      max_count=max_count)
 
         if path_fl:
             # load fluorescence data
@@ -127,17 +171,30 @@ def convert(path_out, path_qpi, path_qpi_bg, path_fl, wavelength, pixel_size,
             bar.setAutoClose(True)
 
             h5fls = h5.require_group("flseries")
+            # continue after the last completed frame
+            done = int(h5fls.attrs.get("import checkpoint", 0))
+            truncate_series(h5fls, done)
             qpi_shape = ds_qp.get_qpimage(0).shape
-            with flimage.FLSeries(h5file=h5fls) as fls:
-                for ii in range(len(ds_fl)):
-                    ti = ds_fl.get_time(ii)
-                    if ti >= ta and ti <= tb:
-                        # get original data
-                        fli = ds_fl.get_flimage(ii)
-                        # warp data to qps sensor image
-                        flw = coloc.warp_fl(fl=fli.fl,
-                                            output_shape=qpi_shape,
-                                            **colockw)
+            times_fl = ds_fl.get_times()
+            indices = np.where((times_fl >= ta) & (times_fl <= tb))[0]
+            bar.setValue(len(ds_fl) - len(indices) + done)
+            # warp batches of frames to the qps sensor image
+            flichunks = iter_chunks(ds_fl.iter_flimages(indices[done:]),
+                                    fl_batch_size)
+            jobs = ((flis, [fli.fl for fli in flis]) for flis in flichunks)
+
+            def warp_job(job):
+                flis, images = job
+                flws = coloc.warp_fl_batch(fls=images,
+                                           output_shape=qpi_shape,
+                                           **colockw)
+                return flis, flws
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=get_worker_count()) as pool, \
+                    flimage.FLSeries(h5file=h5fls) as fls:
+                for flis, flws in imap_ordered(warp_job, jobs, pool):
+                    for fli, flw in zip(flis, flws):
                         # create new FLImage using given ROI
                         meta_data = fli.meta.copy()
                         meta_data["pixel size"] = pixel_size
@@ -146,6 +203,343 @@ def convert(path_out, path_qpi, path_qpi_bg, path_fl, wavelength, pixel_size,
                                               meta_data=meta_data
                                               )
                         fls.add_flimage(fln)
+                        h5fls.attrs["import checkpoint"] = len(fls)
+
+                        bar.setValue(bar.value() + 1)
+                        QtCore.QCoreApplication.instance().processEvents()
+                    h5.flush()
+
+        # remove checkpoints
+        for group in h5.values():
+            for key in ["import checkpoint", "import complete",
+                        "bg checkpoint"]:
+                if key in group.attrs:
+                    del group.attrs[key]
+        del h5.attrs["import key"]
+
+    finish_staging(path_stage, path_sino)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_dataset(path, bg_data, meta_items):
+    """Load a QPI data set once per worker process"""
+    return qpformat.load_data(path=path,
+                              bg_data=bg_data,
+                              meta_data=dict(meta_items))
+
+
+def correct_bg(h5file, bgkw, batch_size=16, start=0, count=None,
+               max_count=None):
+    """Perform QPI background correction
+
+    Parameters
+    ----------
+    h5file: h5py.Group
+        QPSeries group
+    bgkw: dict
+        Background keyword arguments
+        (see :func:`qpimage.QPImage.compute_bg`)
+    batch_size: int
+        Number of frames processed at once by a worker thread
+    start: int
+        Index of the first frame to process; the number of
+        processed frames is stored in the "bg checkpoint"
+        attribute of `h5file`.
+    count, max_count: multiprocessing.Value
+        Progress monitoring (incremented for every frame)
+
+    Notes
+    -----
+    If the background mask is the same for all frames (see
+    :func:`bg_batch.can_batch`), the background of batches of
+    frames is estimated with :func:`bg_batch.estimate` on a
+    thread pool. Otherwise, :func:`qpimage.QPImage.compute_bg`
+    is called for each frame.
+    """
+    with qpimage.QPSeries(h5file=h5file) as qps:
+        num = len(qps)
+        if max_count is not None:
+            max_count.value += num
+        if count is not None:
+            count.value += start
+        if bg_batch.can_batch(bgkw):
+            attrs = {"fit_offset": bgkw.get("fit_offset", "mean"),
+                     "fit_profile": bgkw.get("fit_profile", "tilt"),
+                     "border_px": int(np.round(bgkw["border_px"]))}
+
+            def iter_jobs():
+                for ia in range(start, num, batch_size):
+                    qpis = [qps[ii] for ii in
+                            range(ia, min(ia + batch_size, num))]
+                    for qpi in qpis:
+                        # remove existing bg before accessing the images
+                        bg_batch.set_bg_fit(qpi, bg_pha=None, bg_amp=None)
+                    yield (np.array([qpi.pha for qpi in qpis]),
+                           np.array([qpi.amp for qpi in qpis]))
+
+            def estimate_job(job):
+                return [bg_batch.estimate(data=data, **attrs)
+                        for data in job]
+
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=get_worker_count()) as pool:
+                ii = start
+                for bgpha, bgamp in imap_ordered(estimate_job, iter_jobs(),
+                                                 pool):
+                    for bgp, bga in zip(bgpha, bgamp):
+                        qpi = qps[ii]
+                        bg_batch.set_bg_fit(qpi, bg_pha=bgp, bg_amp=bga,
+                                            attrs=attrs)
+                        ii += 1
+                        h5file.attrs["bg checkpoint"] = ii
+                        if count is not None:
+                            count.value += 1
+                    h5file.file.flush()
+        else:
+            for ii in range(start, num):
+                qpi = qps[ii]
+                # background correction
+                qpi.compute_bg(which_data=["phase", "amplitude"], **bgkw)
+                h5file.attrs["bg checkpoint"] = ii + 1
+                if count is not None:
+                    count.value += 1
+
+
+def iter_chunks(iterable, size):
+    """Yield lists of `size` consecutive items of `iterable`"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def finish_staging(path_stage, path_sino):
+    """Move a completed staging file to its final location
+
+    If `path_stage` and `path_sino` are on different file systems,
+    the staging file is copied to a temporary file next to
+    `path_sino` first, such that `path_sino` is replaced
+    atomically in both cases.
+    """
+    path_sino = pathlib.Path(path_sino)
+    try:
+        os.replace(path_stage, path_sino)
+    except OSError:
+        path_tmp = path_sino.with_name(path_sino.name + ".partial")
+        shutil.copyfile(path_stage, path_tmp)
+        os.replace(path_tmp, path_sino)
+        os.remove(path_stage)
 
-                    bar.setValue(bar.value() + 1)
-                    QtCore.QCoreApplication.instance().processEvents()
+
+def get_import_key(**kwargs):
+    """Return a key that identifies an import with :func:`convert`
+
+    The key is computed from the keyword arguments of
+    :func:`convert` and the size and modification time of
+    the data files.
+    """
+    items = []
+    for key in sorted(kwargs):
+        value = kwargs[key]
+        if key.startswith("path") and value:
+            path = pathlib.Path(value).resolve()
+            stat = path.stat()
+            value = [str(path), stat.st_size, stat.st_mtime]
+        items.append([key, value])
+    data = json.dumps(items, default=repr).encode("utf-8")
+    return hashlib.md5(data).hexdigest()
+
+
+def get_staging_dir():
+    """Return the directory for staging files of imports
+
+    The directory is located in the user cache directory
+    and created if it does not exist.
+    """
+    path = pathlib.Path(appdirs.user_cache_dir("CellReel")) / "staging"
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def has_bg_per_frame(bg_data):
+    """Whether each frame of a QPI data set has its own background
+
+    Parameters
+    ----------
+    bg_data: str, pathlib.Path, or None
+        Background data as passed to :func:`qpformat.load_data`
+
+    Returns
+    -------
+    per_frame: bool
+        If False, there is either no background data or a
+        single background image that applies to all frames.
+    """
+    if bg_data is None:
+        return False
+    return len(qpformat.load_data(path=bg_data)) > 1
+
+
+def import_qpi(ds, load_kw, h5file, qpi_slice, time_interval, t0=0,
+               chunk_size=8, start=0, count=None, max_count=None):
+    """Import QPI data with a process pool
+
+    This is equivalent to :func:`qpformat.file_formats.SeriesData.saveh5`.
+    Chunks of frames are loaded and cropped by worker processes
+    (see :func:`load_qpi_chunk`) and written to `h5file` in
+    order by the calling thread.
+
+    Parameters
+    ----------
+    ds: qpformat.file_formats.SeriesData
+        The QPI data set
+    load_kw: dict
+        Keyword arguments for :func:`qpformat.load_data` with
+        which the worker processes load `ds`
+    h5file: h5py.Group
+        Output group for the QPSeries
+    qpi_slice: tuple of (slice, slice)
+        Region of interest
+    time_interval: tuple of (float, float)
+        Only frames recorded within this interval are imported
+    t0: float
+        Initial time subtracted from the recording times
+    chunk_size: int
+        Number of frames loaded by a worker at once
+    start: int
+        Index of the first frame of `ds` to import; the number of
+        processed frames of `ds` and the length of the series are
+        stored in the "import checkpoint" attribute of `h5file`.
+    count, max_count: multiprocessing.Value
+        Progress monitoring (incremented for every frame of `ds`)
+    """
+    num = len(ds)
+    if max_count is not None:
+        max_count.value += num
+    if count is not None:
+        count.value += start
+    loadkw = (load_kw["path"],
+              load_kw["bg_data"],
+              tuple(sorted(load_kw["meta_data"].items())))
+    has_bg = load_kw["bg_data"] is not None
+    per_frame_bg = has_bg_per_frame(load_kw["bg_data"])
+    jobs = ((loadkw, range(ia, min(ia + chunk_size, num)), qpi_slice,
+             time_interval, per_frame_bg)
+            for ia in range(start, num, chunk_size))
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=get_worker_count(),
+            mp_context=mp.get_context("spawn")) as pool, \
+            qpimage.QPSeries(h5file=h5file, h5mode="w") as qps:
+        for chunk in imap_ordered(load_qpi_chunk, jobs, pool):
+            for idx, frame in chunk:
+                if frame is None:
+                    # not part of the time interval
+                    pass
+                elif len(qps) == 0 and has_bg and not per_frame_bg:
+                    # initial image (with the background data for
+                    # all images)
+                    qpi = ds.get_qpimage(idx)[qpi_slice]
+                    if "time" in qpi:
+                        qpi["time"] = qpi["time"] - t0
+                    qps.add_qpimage(qpi)
+                else:
+                    pha, amp, bg, meta = frame
+                    if "time" in meta:
+                        meta["time"] = meta["time"] - t0
+                    qpi = qpimage.QPImage(data=(pha, amp),
+                                          which_data="phase,amplitude",
+                                          meta_data=meta,
+                                          proc_phase=False)
+                    if bg is not None:
+                        qpi.set_bg_data(bg_data=bg,
+                                        which_data="phase,amplitude",
+                                        proc_phase=False)
+                        qps.add_qpimage(qpi)
+                    elif has_bg:
+                        # hard-link the background data
+                        qps.add_qpimage(qpi, bg_from_idx=0)
+                    else:
+                        qps.add_qpimage(qpi)
+                h5file.attrs["import checkpoint"] = (idx + 1, len(qps))
+                if count is not None:
+                    count.value += 1
+            h5file.file.flush()
+
+
+def load_qpi_chunk(job):
+    """Load, crop and time-filter a range of QPI frames
+
+    Parameters
+    ----------
+    job: tuple
+        Data set arguments (see :func:`_load_dataset`), frame
+        indices, ROI slice, time interval, and whether each
+        frame has its own background (see :func:`has_bg_per_frame`)
+
+    Returns
+    -------
+    chunk: list of tuples (idx, frame)
+        For each index, `frame` is either None (frame not in the
+        time interval) or a tuple of raw phase, raw amplitude,
+        background phase and amplitude (None if the data set
+        has a single background image), and meta data.
+    """
+    loadkw, indices, qpi_slice, (ta, tb), per_frame_bg = job
+    ds = _load_dataset(*loadkw)
+    chunk = []
+    for idx in indices:
+        ti = ds.get_time(idx)
+        if ti < ta or ti > tb:
+            frame = None
+        else:
+            if per_frame_bg:
+                qpi = ds.get_qpimage(idx)[qpi_slice]
+                bg = (qpi.bg_pha, qpi.bg_amp)
+            else:
+                qpi = ds.get_qpimage_raw(idx)[qpi_slice]
+                bg = None
+            meta = dict(qpi.meta)
+            if "identifier" in qpi:
+                meta["identifier"] = qpi["identifier"]
+            frame = (qpi.raw_pha, qpi.raw_amp, bg, meta)
+        chunk.append((idx, frame))
+    return chunk
+
+
+def prepare_staging(path_staging, import_key):
+    """Return the path of the staging file of an import
+
+    The staging file "{import_key}.h5.partial" is located in the
+    directory `path_staging`, i.e. an interrupted import can be
+    continued in a new session. An existing staging file that
+    cannot be opened is removed, as well as staging files of
+    other imports that were not modified for
+    :const:`STAGING_MAX_AGE` seconds.
+    """
+    path_staging = pathlib.Path(path_staging)
+    path_stage = path_staging / "{}.h5.partial".format(import_key)
+    for pp in path_staging.glob("*.h5.partial"):
+        if pp == path_stage:
+            try:
+                with h5py.File(pp, "r") as h5:
+                    stale = h5.attrs.get("import key") != import_key
+            except OSError:
+                stale = True
+        else:
+            stale = time.time() - pp.stat().st_mtime > STAGING_MAX_AGE
+        if stale:
+            pp.unlink()
+    return path_stage
+
+
+def truncate_series(h5file, size):
+    """Remove all but the first `size` images of a QPSeries/FLSeries
+
+    This removes images that were written after the last
+    checkpoint of an interrupted import.
+    """
+    for key in list(h5file.keys()):
+        if int(key.rsplit("_", 1)[1]) >= size:
+            del h5file[key]
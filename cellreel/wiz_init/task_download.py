@@ -1,46 +1,93 @@
+import concurrent.futures
+import functools
 import hashlib
+import http.client
 import json
 import multiprocessing as mp
+import os
 import pathlib
 import pkg_resources
-import time
+import urllib.error
 import urllib.request
 
-from PyQt5 import QtCore, QtWidgets
-
-
-class DownloadThread(QtCore.QThread):
-    def __init__(self, data, path, count, max_count, *args, **kwargs):
-        super(DownloadThread, self).__init__(*args, **kwargs)
-        self.data = data
-        self.path = path
-        self.count = count
-        self.max_count = max_count
-
-    def run(self, init=True):
-        if init:
-            with self.max_count.get_lock():
-                self.max_count.value += self.data["size"]
-                self.max_count.value += self.data["size"] // 50
-        download(url=self.data["urls"][0],
-                 path=self.path,
-                 total_size=self.data["size"],
-                 count=self.count)
-
-        if verify_checksum(path=self.path, sha256sum=self.data["sha256"]):
-            with self.count.get_lock():
-                self.count.value += self.data["size"] // 50
-        else:
-            self.path.unlink()
-            with self.count.get_lock():
-                self.count.value -= self.data["size"]
-            self.run(retry=True)
+from PyQt5 import QtWidgets
+
+from .. import cache
+from ..parallel import TaskThread, imap_ordered, wait_for_threads
+
+
+#: Maximum size of the dataset cache [B]
+CACHE_SIZE = 20 * 1024**3
+
+
+class DownloadThread(TaskThread):
+    def __init__(self, data, path, count, max_count, retries=3,
+                 use_cache=True, *args, **kwargs):
+        fkw = {"data": data,
+               "path": path,
+               "count": count,
+               "max_count": max_count,
+               "retries": retries,
+               "use_cache": use_cache}
+        super(DownloadThread, self).__init__(func=download_file, fkw=fkw,
+                                             *args, **kwargs)
+
 
+def download_file(data, path, count, max_count, retries=3, use_cache=True):
+    """Download and verify a file of a dataset
 
-def download(url, path, resume=True, chunk_size=65536, total_size=None,
-             count=None, max_count=None):
+    Parameters
+    ----------
+    data: dict
+        File entry of a dataset in "online_data.json"
+    path: pathlib.Path
+        Download file name
+    count, max_count: multiprocessing.Value
+        Progress monitoring (see :func:`download`)
+    retries: int
+        Number of downloads attempted if the checksum does not match
+    use_cache: bool
+        Link the file from the "datasets" cache if available and
+        add it to the cache after verification
+    """
+    with max_count.get_lock():
+        max_count.value += data["size"]
+    if use_cache:
+        dl_cache = cache.get_cache("datasets", max_size=CACHE_SIZE)
+        if link_from_cache(dl_cache, data, path):
+            with count.get_lock():
+                count.value += data["size"]
+            return
+    for _ in range(retries):
+        sha256sum = download(url=data["urls"][0],
+                             path=path,
+                             total_size=data["size"],
+                             count=count)
+        if sha256sum == data["sha256"]:
+            break
+        # start over
+        path.unlink()
+        with count.get_lock():
+            count.value -= data["size"]
+    else:
+        raise ValueError("Checksum mismatch for '{}'!".format(
+            data["urls"][0]))
+    if use_cache:
+        # only verified files are cached
+        dl_cache.put(data["sha256"], path)
+
+
+def download(url, path, resume=True, total_size=None, num_connections=4,
+             block_size=4*1024**2, chunk_size=65536, count=None,
+             max_count=None):
     """Download a file (supports resuming)
 
+    The file is downloaded in blocks of `block_size` bytes using
+    up to `num_connections` concurrent HTTP range requests. The
+    blocks are written and hashed in order as soon as they are
+    available, i.e. no additional pass is required for computing
+    the checksum.
+
     Parameters
     ----------
     url: str
@@ -49,24 +96,54 @@ def download(url, path, resume=True, chunk_size=65536, total_size=None,
         Download file name
     resume: bool
         Whether to resume a previous download or start anew
-    chunk_size: int
-        Download chunk size in bytes
     total_size: int
         The total size of the file to download; If None, the
         file size is obtained from the url info
+    num_connections: int
+        Maximum number of concurrent range requests; If the server
+        does not support range requests, the file is streamed over
+        a single connection (see :func:`download_unranged`).
+    block_size: int
+        Size of the range requests in bytes
+    chunk_size: int
+        Download chunk size in bytes
     count, max_count: multiprocessing.Value
         Can be used for tracking the download progress from an external
-        thread or process
+        thread or process (use 64-bit values, e.g. `mp.Value('Q')`)
+
+    Returns
+    -------
+    sha256sum: str
+        SHA-256 sum of the downloaded file
+
+    Notes
+    -----
+    Since the blocks are written in order, the size of an incomplete
+    file (rounded down to a multiple of `block_size`, i.e. without a
+    partially written block) is the position from where the download
+    is resumed. When resuming, the existing part of the file is hashed
+    first. Note that the content of the existing part is not verified;
+    a corrupt partial file is only detected by comparing the returned
+    checksum after the download (see :func:`download_file`, which then
+    starts the download anew). Use `resume=False` to ignore a partial
+    file.
     """
     path = pathlib.Path(path)
-    if path.exists():
+    if resume and path.exists():
         cur_size = path.stat().st_size
     else:
         cur_size = 0
 
+    meta = get_url_info(url)
     if total_size is None:
-        meta = urllib.request.urlopen(url).info()
         total_size = int(meta.get("Content-Length"))
+    ranged = meta.get("Accept-Ranges") == "bytes"
+    if not ranged or cur_size > total_size:
+        cur_size = 0
+    elif cur_size < total_size and cur_size % block_size:
+        # the last block was not written completely
+        cur_size -= cur_size % block_size
+        os.truncate(path, cur_size)
 
     if max_count is not None:
         with max_count.get_lock():
@@ -76,35 +153,141 @@ def download(url, path, resume=True, chunk_size=65536, total_size=None,
         with count.get_lock():
             count.value += cur_size
 
-    # check whether we already have the whole file
-    if cur_size < total_size:
+    hasher = hashlib.sha256()
+    if cur_size:
+        hash_file(path, hasher=hasher, chunk_size=chunk_size)
+
+    if ranged:
+        spans = [(start, min(start + block_size, total_size))
+                 for start in range(cur_size, total_size, block_size)]
+        fetch = functools.partial(download_range,
+                                  url=url,
+                                  chunk_size=chunk_size,
+                                  count=count)
+        with path.open("ab" if cur_size else "wb") as fd, \
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=num_connections) as pool:
+            for data in imap_ordered(fetch, spans, pool,
+                                     prefetch=2*num_connections):
+                fd.write(data)
+                hasher.update(data)
+    else:
+        with path.open("wb") as fd:
+            hasher = download_unranged(url=url,
+                                       fd=fd,
+                                       chunk_size=chunk_size,
+                                       count=count)
+
+    assert path.stat().st_size == total_size, path
+    return hasher.hexdigest()
+
+
+def download_range(span, url, chunk_size=65536, count=None, retries=3):
+    """Download a byte range of a file with an HTTP range request
+
+    Parameters
+    ----------
+    span: tuple of int
+        Start and stop byte position (stop is exclusive)
+    url: str
+        URL to download
+    chunk_size: int
+        Download chunk size in bytes
+    count: multiprocessing.Value
+        Incremented by the number of bytes downloaded
+    retries: int
+        Number of attempts for an interrupted range request
+
+    Returns
+    -------
+    data: bytes
+        The downloaded data
+    """
+    start, stop = span
+    for ii in range(retries):
         req = urllib.request.Request(url)
-        if resume and path.exists():
-            req.add_header('Range', "bytes={}-".format(cur_size))
-            mode = "ab"
+        req.add_header("Range", "bytes={}-{}".format(start, stop - 1))
+        buffers = []
+        read_size = 0
+        try:
+            with urllib.request.urlopen(req) as up:
+                if up.status != 206:
+                    raise ValueError("Server ignored range request for "
+                                     + "'{}'!".format(url))
+                while read_size < stop - start:
+                    buffer = up.read(min(chunk_size,
+                                         stop - start - read_size))
+                    if not buffer:
+                        raise urllib.error.URLError("Incomplete read")
+                    buffers.append(buffer)
+                    read_size += len(buffer)
+                    if count is not None:
+                        with count.get_lock():
+                            count.value += len(buffer)
+        except (OSError, http.client.HTTPException):
+            if count is not None:
+                with count.get_lock():
+                    count.value -= read_size
+            if ii == retries - 1:
+                raise
         else:
-            cur_size = 0
-            mode = "wb"
+            return b"".join(buffers)
 
-        up = urllib.request.urlopen(req)
-        meta = up.info()
-        remaining_size = int(meta.get("Content-Length"))
 
-        read_size = 0
-        with path.open(mode) as fd:
-            while read_size < remaining_size:
-                buffer = up.read(chunk_size)
-                fd.write(buffer)
-                fd.flush()
-                read_size += len(buffer)
-                if count is not None:
-                    with count.get_lock():
-                        count.value += len(buffer)
+def download_unranged(url, fd, chunk_size=65536, count=None, retries=3):
+    """Stream an entire file to `fd` without range requests
 
-    assert path.stat().st_size == total_size, path
+    This is used for servers that do not support range requests.
+    The data are written and hashed chunk by chunk, i.e. the file
+    is never held in memory.
+
+    Parameters
+    ----------
+    url: str
+        URL to download
+    fd: file object
+        Binary file opened for writing; it is truncated when
+        the download is started over.
+    chunk_size: int
+        Download chunk size in bytes
+    count: multiprocessing.Value
+        Incremented by the number of bytes downloaded
+    retries: int
+        Number of attempts for an interrupted download
+
+    Returns
+    -------
+    hasher: hashlib.sha256
+        SHA-256 hasher updated with the downloaded data
+    """
+    for ii in range(retries):
+        fd.seek(0)
+        fd.truncate()
+        hasher = hashlib.sha256()
+        read_size = 0
+        try:
+            with urllib.request.urlopen(url) as up:
+                while True:
+                    buffer = up.read(chunk_size)
+                    if not buffer:
+                        break
+                    fd.write(buffer)
+                    hasher.update(buffer)
+                    read_size += len(buffer)
+                    if count is not None:
+                        with count.get_lock():
+                            count.value += len(buffer)
+        except (OSError, http.client.HTTPException):
+            if count is not None:
+                with count.get_lock():
+                    count.value -= read_size
+            if ii == retries - 1:
+                raise
+        else:
+            return hasher
 
 
-def download_dataset_qt5(key, path, progressbar=None):
+def download_dataset_qt5(key, path, progressbar=None, use_cache=True):
     """Qt5 Convenience function for downloading a dataset
 
     Parameters
@@ -117,18 +300,23 @@ def download_dataset_qt5(key, path, progressbar=None):
     progressbar: PyQt5.QtWidgets.QProgressBar
         Optional progressbar where to display download progress;
         If not given, a `QProgressDialog` is displayed.
+    use_cache: bool
+        Link previously downloaded files from the machine-wide
+        "datasets" cache (see :mod:`cellreel.cache`) instead of
+        downloading them; downloaded files are added to the cache.
 
     Notes
     -----
     If a dataset consists of multiple files, they are all downloaded
     at once. If the download is interrupted (e.g. due to program crash)
     and this function is called again with the same `key` and `path`
-    arguments, then all downloads are resumed.
+    arguments, then all downloads are resumed. Download errors (e.g.
+    a checksum mismatch) are raised after all downloads finished.
     """
     path = pathlib.Path(path)
     data = get_available_datasets()[key]
-    count = mp.Value('I', 0, lock=True)
-    max_count = mp.Value('I', 0, lock=True)
+    count = mp.Value('Q', 0, lock=True)
+    max_count = mp.Value('Q', 0, lock=True)
 
     if progressbar is None:
         bar = QtWidgets.QProgressDialog("Downloading '{}'...".format(key),
@@ -138,7 +326,7 @@ def download_dataset_qt5(key, path, progressbar=None):
         bar.setCancelButton(None)
         bar.setMinimumDuration(0)
         bar.setAutoClose(True)
-        bar.setWindowTitle("Simulation")
+        bar.setWindowTitle("Download")
     else:
         bar = progressbar
 
@@ -147,21 +335,15 @@ def download_dataset_qt5(key, path, progressbar=None):
         dlthread = DownloadThread(data=dt,
                                   path=path/dt["name"],
                                   count=count,
-                                  max_count=max_count)
+                                  max_count=max_count,
+                                  use_cache=use_cache)
         dlthread.start()
         threads.append(dlthread)
 
-    # Show a progress until computation is done
-    while count.value == 0 or count.value < max_count.value:
-        time.sleep(.05)
-        wa_fact = 1000000  # work-around factor (supported max of ProgressBar)
-        bar.setValue(count.value // wa_fact)
-        bar.setMaximum(max_count.value // wa_fact)
-        QtCore.QCoreApplication.instance().processEvents()
-
-    # make sure the thread finishes
-    for thr in threads:
-        thr.wait()
+    # Show a progress until computation is done (in per mille,
+    # because QProgressBar only supports 32-bit integers)
+    wait_for_threads(threads, bar=bar, count=count, max_count=max_count,
+                     per_mille=True)
 
 
 def get_available_datasets():
@@ -183,6 +365,65 @@ def get_dataset_size(key):
     return size
 
 
+def get_url_info(url):
+    """Return the HTTP headers of a URL without downloading it"""
+    try:
+        with urllib.request.urlopen(
+                urllib.request.Request(url, method="HEAD")) as up:
+            return up.info()
+    except urllib.error.HTTPError:
+        # server does not allow HEAD requests
+        with urllib.request.urlopen(url) as up:
+            return up.info()
+
+
+def hash_file(path, hasher=None, chunk_size=65536, count=None):
+    """Update a SHA-256 hasher with the content of a file
+
+    Returns
+    -------
+    hasher: hashlib.sha256
+        The updated `hasher` (a new one if `hasher` is None)
+    """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with pathlib.Path(path).open("rb") as fd:
+        while True:
+            buffer = fd.read(chunk_size)
+            if len(buffer) == 0:
+                break
+            hasher.update(buffer)
+            if count is not None:
+                count.value += len(buffer)
+    return hasher
+
+
+def link_from_cache(dl_cache, data, path):
+    """Link a dataset file from the dataset cache to `path`
+
+    Parameters
+    ----------
+    dl_cache: cellreel.cache.FileCache
+        Dataset cache with the SHA-256 sums as keys
+    data: dict
+        File entry of a dataset in "online_data.json"
+    path: pathlib.Path
+        Destination; an existing file is replaced
+
+    Returns
+    -------
+    success: bool
+        False if the file is not in the cache
+    """
+    cpath = dl_cache.get_path(data["sha256"])
+    if not cpath.exists() or cpath.stat().st_size != data["size"]:
+        return False
+    path = pathlib.Path(path)
+    if path.exists():
+        path.unlink()
+    return dl_cache.link(data["sha256"], path)
+
+
 def verify_checksum(path, sha256sum, chunk_size=65536,
                     count=None, max_count=None):
     """Verify the checksum of a file
@@ -207,18 +448,8 @@ def verify_checksum(path, sha256sum, chunk_size=65536,
     path = pathlib.Path(path)
     if max_count is not None:
         max_count.value += path.stat().st_size
-
-    with path.open("rb") as fd:
-        hasher = hashlib.sha256()
-        while True:
-            buffer = fd.read(chunk_size)
-            hasher.update(buffer)
-            if count is not None:
-                count.value += len(buffer)
-            if len(buffer) == 0:
-                break
-
-        newsum = hasher.hexdigest()
+    hasher = hash_file(path, chunk_size=chunk_size, count=count)
+    newsum = hasher.hexdigest()
     if sha256sum != newsum:
         return False
     else:
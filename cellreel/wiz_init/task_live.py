@@ -0,0 +1,270 @@
+"""Incremental import of data that are still being recorded"""
+import pathlib
+import threading
+import traceback
+
+import flimage
+import h5py
+import numpy as np
+from PyQt5 import QtCore
+import qpformat
+import qpimage
+
+from . import coloc
+from .formats import flformat
+from .._version import version
+
+
+class LiveThread(QtCore.QThread):
+    #: Emitted with the traceback if :func:`LiveImport.poll` fails
+    error = QtCore.pyqtSignal(str)
+
+    def __init__(self, live, *args, **kwargs):
+        super(LiveThread, self).__init__(*args, **kwargs)
+        self.live = live
+        self.result = None
+
+    def run(self):
+        try:
+            self.result = self.live.poll()
+        except LiveImportError as e:
+            self.error.emit(str(e))
+        except BaseException:
+            self.error.emit(traceback.format_exc())
+
+
+class LiveImportError(Exception):
+    """Raised by :func:`LiveImport.poll` for files that cannot be imported"""
+    pass
+
+
+class LiveImport(object):
+    def __init__(self, path_sino, path_qpi, path_qpi_bg, path_fl, wavelength,
+                 pixel_size, medium_index, slice_qpi, bgkw_qpi, colockw):
+        """Append frames to a sinogram while they are being recorded
+
+        Parameters
+        ----------
+        path_sino: pathlib.Path
+            Output HDF5 file (created if it does not exist)
+        path_qpi: pathlib.Path
+            One of the QPI data files; all files with the same
+            suffix in the same folder are imported.
+        path_qpi_bg: pathlib.Path
+            Path to quantitative phase background data
+        path_fl: pathlib.Path or None
+            One of the fluorescence data files (same as for
+            `path_qpi`)
+        wavelength, pixel_size, medium_index, slice_qpi, bgkw_qpi,
+        colockw:
+            Import parameters (see :func:`.task_convert.convert`)
+
+        Notes
+        -----
+        The imported file names are stored in the "live index"
+        group of `path_sino`. A live import can thus be resumed
+        with a new instance of this class. The recording time of
+        the first QPI frame defines the time origin; fluorescence
+        frames recorded before are ignored.
+
+        `path_sino` is only opened for writing while :attr:`lock`
+        is held. Readers in other threads must hold :attr:`lock`
+        while they access `path_sino`.
+        """
+        self.path_sino = pathlib.Path(path_sino)
+        self.path_qpi_bg = path_qpi_bg
+        self.meta_qpi = {"wavelength": wavelength,
+                         "pixel size": pixel_size,
+                         "medium index": medium_index}
+        self.pixel_size = pixel_size
+        self.slice_qpi = slice_qpi
+        self.bgkw_qpi = bgkw_qpi
+        self.colockw = colockw
+        #: watched (folder, glob pattern) for each series
+        self.sources = {"qpseries": get_source(path_qpi)}
+        if path_fl:
+            self.sources["flseries"] = get_source(path_fl)
+            if self.sources["flseries"] == self.sources["qpseries"]:
+                raise ValueError("QPI and fluorescence files must differ in "
+                                 "location or file extension!")
+        #: file sizes from the previous poll
+        self.sizes = {}
+        #: files that could not be imported {path: (size, error)}
+        self.failed = {}
+        #: serializes access to `path_sino`
+        self.lock = threading.Lock()
+
+    def get_new_files(self, name, imported, stable_only=True):
+        """Return the data files of a series that were not imported yet
+
+        Parameters
+        ----------
+        name: str
+            Series name ("qpseries" or "flseries")
+        imported: list of str
+            Names of the files already imported
+        stable_only: bool
+            Only return files whose size did not change since
+            the previous call (i.e. files that are not being
+            written anymore).
+
+        Files that could not be imported are only returned again
+        if their size changed (see :func:`LiveImport.poll`).
+        """
+        directory, pattern = self.sources[name]
+        exclude = set(imported)
+        if self.path_qpi_bg:
+            exclude.add(pathlib.Path(self.path_qpi_bg).name)
+        new = []
+        for path in sorted(directory.glob(pattern)):
+            if path.name in exclude or not path.is_file():
+                continue
+            size = path.stat().st_size
+            if path in self.failed and self.failed[path][0] == size:
+                continue
+            if size and (not stable_only or self.sizes.get(path) == size):
+                new.append(path)
+            self.sizes[path] = size
+        return new
+
+    def poll(self, stable_only=True):
+        """Import all new frames
+
+        Parameters
+        ----------
+        stable_only: bool
+            Only import files that are not being written anymore
+            (see :func:`LiveImport.get_new_files`); set this to
+            False when the acquisition is finished.
+
+        Returns
+        -------
+        num_qpi, num_fli: int
+            Number of imported QPI and fluorescence frames
+
+        Raises
+        ------
+        LiveImportError
+            If new files could not be imported (after all other
+            files were imported). These files are recorded in
+            :attr:`LiveImport.failed` and only retried if their
+            size changes.
+        """
+        num_qpi = 0
+        num_fli = 0
+        errors = []
+        with self.lock, h5py.File(self.path_sino, mode="a") as h5:
+            h5.attrs["CellReel version"] = version
+            h5.attrs["live acquisition"] = True
+            index = h5.require_group("live index")
+            for name in ["qpseries", "flseries"]:
+                if name not in self.sources:
+                    continue
+                imported = [fn.decode() if isinstance(fn, bytes) else fn
+                            for fn in index[name][:]] if name in index else []
+                for path in self.get_new_files(name, imported, stable_only):
+                    if name == "flseries" and "live t0" not in h5.attrs:
+                        # wait for the first QPI frame
+                        break
+                    try:
+                        if name == "qpseries":
+                            num_qpi += self.append_qpi(h5, path)
+                        else:
+                            num_fli += self.append_fli(h5, path)
+                    except (Exception,
+                            # (derived from BaseException)
+                            qpformat.file_formats.BadFileFormatError) as e:
+                        # The file is not being written anymore, i.e.
+                        # the import parameters or the file are invalid.
+                        msg = "{}: {}".format(e.__class__.__name__, e)
+                        self.failed[path] = (self.sizes[path], msg)
+                        errors.append("'{}' - {}".format(path.name, msg))
+                        continue
+                    self.failed.pop(path, None)
+                    append_index(index, name, path.name)
+        if errors:
+            raise LiveImportError("Could not import {} file(s):\n{}".format(
+                len(errors), "\n".join(errors)))
+        return num_qpi, num_fli
+
+    def append_fli(self, h5, path):
+        """Append the frames of a fluorescence file to `h5`"""
+        ds = flformat.load_data(path=path)
+        t0 = h5.attrs["live t0"]
+        qpi_shape = tuple(h5.attrs["live qpi shape"])
+        flis = []
+        for idx in range(len(ds)):
+            fli = ds.get_flimage(idx)
+            ti = get_frame_time(fli.meta, path)
+            if ti < t0:
+                continue
+            flw = coloc.warp_fl(fl=fli.fl,
+                                output_shape=qpi_shape,
+                                **self.colockw)
+            meta_data = fli.meta.copy()
+            meta_data["pixel size"] = self.pixel_size
+            meta_data["time"] = ti - t0
+            flis.append(flimage.FLImage(data=flw[self.slice_qpi],
+                                        meta_data=meta_data))
+        if flis:
+            with flimage.FLSeries(h5file=h5.require_group("flseries")) as fls:
+                for fli in flis:
+                    fls.add_flimage(fli)
+        return len(flis)
+
+    def append_qpi(self, h5, path):
+        """Append the background-corrected frames of a QPI file to `h5`"""
+        ds = qpformat.load_data(path=path,
+                                bg_data=self.path_qpi_bg,
+                                meta_data=self.meta_qpi)
+        qpis = []
+        for idx in range(len(ds)):
+            qpi = ds.get_qpimage(idx)
+            if "live t0" not in h5.attrs:
+                h5.attrs["live t0"] = get_frame_time(qpi.meta, path)
+                h5.attrs["live qpi shape"] = qpi.shape
+            qpi = qpi[self.slice_qpi]
+            qpi["time"] = get_frame_time(qpi.meta, path) - h5.attrs["live t0"]
+            qpi.compute_bg(which_data=["phase", "amplitude"], **self.bgkw_qpi)
+            qpis.append(qpi)
+        if qpis:
+            with qpimage.QPSeries(h5file=h5.require_group("qpseries")) as qps:
+                for qpi in qpis:
+                    qps.add_qpimage(qpi)
+        return len(qpis)
+
+    def stop(self):
+        """Mark the live acquisition as finished"""
+        with self.lock, h5py.File(self.path_sino, mode="a") as h5:
+            h5.attrs["live acquisition"] = False
+
+
+def append_index(group, name, filename):
+    """Append a file name to the resizable dataset `name` of `group`"""
+    if name not in group:
+        group.create_dataset(name,
+                             shape=(0,),
+                             maxshape=(None,),
+                             chunks=(256,),
+                             dtype=h5py.string_dtype())
+    ds = group[name]
+    ds.resize((ds.shape[0] + 1,))
+    ds[-1] = filename
+
+
+def get_frame_time(meta, path):
+    """Return the recording time of a frame
+
+    If the meta data do not define the time, the modification
+    time of the data file is used.
+    """
+    if "time" in meta and np.isfinite(meta["time"]):
+        return meta["time"]
+    else:
+        return pathlib.Path(path).stat().st_mtime
+
+
+def get_source(path):
+    """Return the folder and glob pattern of the files to import"""
+    path = pathlib.Path(path)
+    return path.parent, "*" + path.suffix
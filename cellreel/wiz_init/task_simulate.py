@@ -1,28 +1,27 @@
+import concurrent.futures
+import functools
 import multiprocessing as mp
-import time
 
 import cellsino
+import flimage
+import h5py
 import numpy as np
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtWidgets
+import qpimage
 
+from .. import cache
+from ..parallel import get_worker_count, imap_ordered, run_in_thread
 
-class SinoThread(QtCore.QThread):
-    def __init__(self, sino, qpskw, flskw, *args, **kwargs):
-        super(SinoThread, self).__init__(*args, **kwargs)
-        self.sino = sino
-        self.qpskw = qpskw
-        self.flskw = flskw
 
-    def run(self):
-        self.sino.compute(**self.qpskw)
-        if self.flskw:
-            self.sino.compute(**self.flskw)
+#: Maximum size of the cache for simulated sinograms [B]
+CACHE_SIZE = 10 * 1024**3
 
 
 def simulate(path, phantom, angles, duration=3, displacement=0, axis_roll=0,
              fluorescence=True, fl_frame_rate_mult=1, fl_offsets=(0, 0),
              fl_bleach_decay=0, fl_background=0, wavelength=550e-9,
-             pixel_size=0.08e-6, grid_size=(250, 250)):
+             pixel_size=0.08e-6, grid_size=(250, 250), block_size=8,
+             use_cache=True):
     """Simulate a fluorescence and refractive index tomography
 
     Uses :mod:`cellsino` for computing the actual sinograms.
@@ -65,15 +64,97 @@ def simulate(path, phantom, angles, duration=3, displacement=0, axis_roll=0,
         Detector pixel size [m]
     grid_size: tuple of int
         Output grid size [px]
+    block_size: int
+        Number of angles computed at once by a worker process
+        (see :func:`compute_sinograms`)
+    use_cache: bool
+        Reuse the sinogram of a previous simulation with the same
+        parameters and :mod:`cellsino` version; the sinogram is
+        stored in the "simulations" cache (see :mod:`cellreel.cache`)
+        in the user cache directory.
     """
-    sino = cellsino.Sinogram(phantom=phantom,
+    sinokw = {"phantom": phantom,
+              "wavelength": wavelength,
+              "pixel_size": pixel_size,
+              "grid_size": tuple(grid_size)}
+
+    computekw = get_compute_kwargs(
+        angles=angles,
+        duration=duration,
+        displacement=displacement,
+        axis_roll=axis_roll,
+        fluorescence=fluorescence,
+        fl_frame_rate_mult=fl_frame_rate_mult,
+        fl_offsets=fl_offsets,
+        fl_bleach_decay=fl_bleach_decay,
+        fl_background=fl_background)
+
+    count = mp.Value('I', 0, lock=True)
+    max_count = mp.Value('I', sum([kw["angles"].size for kw in computekw]),
+                         lock=True)
+
+    path_sino = path / "sinogram.h5"
+    if use_cache:
+        sim_cache = cache.get_cache("simulations", max_size=CACHE_SIZE)
+        key = get_cache_key(sinokw, computekw)
+        if sim_cache.link(key, path_sino):
+            return
+
+    bar = QtWidgets.QProgressDialog("Generating sinogram data...",
+                                    "This button does nothing",
+                                    count.value,
+                                    max_count.value)
+    bar.setCancelButton(None)
+    bar.setMinimumDuration(0)
+    bar.setAutoClose(True)
+    bar.setWindowTitle("Simulation")
+
+    # Show a progress until computation is done
+    run_in_thread(func=compute_sinograms,
+                  fkw={"path": path_sino,
+                       "sinokw": sinokw,
+                       "computekw": computekw,
+                       "block_size": block_size,
+                       "count": count,
+                       },
+                  bar=bar,
+                  count=count,
+                  max_count=max_count)
+
+    if use_cache:
+        sim_cache.put(key, path_sino)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_sinogram(phantom, wavelength, pixel_size, grid_size):
+    """Create a sinogram simulator once per worker process"""
+    return cellsino.Sinogram(phantom=phantom,
                              wavelength=wavelength,
                              pixel_size=pixel_size,
                              grid_size=grid_size)
 
-    count = mp.Value('I', 0, lock=True)
-    max_count = mp.Value('I', angles.size, lock=True)
 
+def get_cache_key(sinokw, computekw):
+    """Return the key of a simulated sinogram in the simulation cache"""
+    return cache.hash_parameters(sinokw=sinokw,
+                                 computekw=computekw,
+                                 version=cellsino.__version__)
+
+
+def get_compute_kwargs(angles, duration=3, displacement=0, axis_roll=0,
+                       fluorescence=True, fl_frame_rate_mult=1,
+                       fl_offsets=(0, 0), fl_bleach_decay=0,
+                       fl_background=0):
+    """Return the keyword arguments for :func:`compute_sinograms`
+
+    See :func:`simulate` for a description of the parameters.
+
+    Returns
+    -------
+    computekw: list of dict
+        Keyword arguments for :func:`cellsino.Sinogram.compute`
+        for the field and (optionally) the fluorescence sinogram
+    """
     # In CellReel, we have a slightly different definition of the
     # default rotation axis:
     qpskw = {"angles": -angles,
@@ -81,9 +162,8 @@ def simulate(path, phantom, angles, duration=3, displacement=0, axis_roll=0,
              "displacements": displacement,
              "times": duration,
              "mode": "field",
-             "path": path / "sinogram.h5",
-             "count": count,
              }
+    computekw = [qpskw]
 
     if fluorescence:
         # compute times for fluorescence sinogram images
@@ -104,32 +184,125 @@ def simulate(path, phantom, angles, duration=3, displacement=0, axis_roll=0,
                  "mode": "fluorescence",
                  "bleach_decay": fl_bleach_decay,
                  "fluorescence_background": fl_background,
-                 "path": path / "sinogram.h5",
-                 "count": count,
                  }
-        # increment max progress bar
-        max_count.value += fl_angles.size
-    else:
-        flskw = {}
+        computekw.append(flskw)
+    return computekw
 
-    bar = QtWidgets.QProgressDialog("Generating sinogram data...",
-                                    "This button does nothing",
-                                    count.value,
-                                    max_count.value)
-    bar.setCancelButton(None)
-    bar.setMinimumDuration(0)
-    bar.setAutoClose(True)
-    bar.setWindowTitle("Simulation")
 
-    sinothread = SinoThread(sino=sino, qpskw=qpskw, flskw=flskw)
-    sinothread.start()
+def get_displacements(displacements, size):
+    """Return the lateral displacement of each frame [px]
 
-    # Show a progress until computation is done
-    while count.value == 0 or count.value < max_count.value:
-        time.sleep(.05)
-        bar.setValue(count.value)
-        bar.setMaximum(max_count.value)
-        QtCore.QCoreApplication.instance().processEvents()
-
-    # make sure the thread finishes
-    sinothread.wait()
+    Parameters
+    ----------
+    displacements: float, 2d ndarray of shape (size, 2), or None
+        A float is the standard deviation of normally-distributed
+        displacements which are drawn exactly like in
+        :func:`cellsino.Sinogram.compute`.
+    size: int
+        Number of frames
+    """
+    if displacements is None:
+        displacements = np.zeros((size, 2))
+    elif isinstance(displacements, float):
+        rs = np.random.RandomState(47)  # same seed as cellsino
+        displacements = rs.normal(scale=displacements, size=(size, 2))
+    return displacements
+
+
+def compute_block(job):
+    """Compute a block of sinogram frames
+
+    Parameters
+    ----------
+    job: tuple of (dict, dict)
+        Keyword arguments for :func:`_get_sinogram` and for
+        :func:`cellsino.Sinogram.compute` (without `path`)
+
+    Returns
+    -------
+    data: 3d ndarray
+        Complex fields or fluorescence images
+    """
+    sinokw, computekw = job
+    sino = _get_sinogram(**sinokw)
+    return sino.compute(**computekw)
+
+
+def compute_sinograms(path, sinokw, computekw, block_size=8, count=None):
+    """Compute sinograms on a process pool and write them to `path`
+
+    This is equivalent to calling :func:`cellsino.Sinogram.compute`
+    with `path` for each item in `computekw`. The angles are
+    split into blocks of `block_size` that are computed by worker
+    processes (see :func:`compute_block`). The blocks of all
+    sinograms are computed concurrently and written in order
+    by the calling thread.
+
+    Parameters
+    ----------
+    path: pathlib.Path
+        Output HDF5 file
+    sinokw: dict
+        Keyword arguments for :class:`cellsino.Sinogram`
+    computekw: list of dict
+        Keyword arguments for :func:`cellsino.Sinogram.compute`;
+        "mode" must be either "field" or "fluorescence".
+    block_size: int
+        Number of angles computed at once by a worker
+    count: multiprocessing.Value
+        Progress monitoring (incremented for every frame)
+    """
+    sino = _get_sinogram(**sinokw)
+    jobs = []
+    for kw in computekw:
+        angles = kw["angles"]
+        times = kw.get("times", 3.0)
+        if isinstance(times, (int, float)):
+            times = np.linspace(0, times, angles.shape[0], endpoint=False)
+        # random displacements must be drawn before splitting
+        disp = get_displacements(kw.get("displacements"), angles.shape[0])
+        for ia in range(0, angles.shape[0], block_size):
+            bkw = dict(kw)
+            bkw["angles"] = angles[ia:ia+block_size]
+            bkw["times"] = times[ia:ia+block_size]
+            bkw["displacements"] = disp[ia:ia+block_size]
+            jobs.append((ia / angles.shape[0], bkw["mode"],
+                         times[ia:ia+block_size], (sinokw, bkw)))
+    # interleave the blocks of the sinograms (stable sort by position)
+    jobs.sort(key=lambda x: x[0])
+    modes = (job[1] for job in jobs)
+    times = (job[2] for job in jobs)
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=get_worker_count(),
+            mp_context=mp.get_context("spawn")) as pool, \
+            h5py.File(path, "a") as h5:
+        results = imap_ordered(compute_block, (job[3] for job in jobs),
+                               pool)
+        for mode, tblock, data in zip(modes, times, results):
+            if mode == "field":
+                with qpimage.QPSeries(
+                        h5file=h5.require_group("qpseries")) as qps:
+                    for field, ti in zip(data, tblock):
+                        qpi = qpimage.QPImage(
+                            data=field,
+                            which_data="field",
+                            meta_data={
+                                "wavelength": sino.wavelength,
+                                "pixel size": sino.pixel_size,
+                                "medium index": sino.phantom.medium_index,
+                                "time": ti,
+                            })
+                        qps.add_qpimage(qpi)
+                        if count is not None:
+                            count.value += 1
+            else:
+                with flimage.FLSeries(
+                        h5file=h5.require_group("flseries")) as fls:
+                    for fl, ti in zip(data, tblock):
+                        fli = flimage.FLImage(
+                            data=fl,
+                            meta_data={"pixel size": sino.pixel_size,
+                                       "time": ti})
+                        fls.add_flimage(fli)
+                        if count is not None:
+                            count.value += 1
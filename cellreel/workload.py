@@ -0,0 +1,177 @@
+"""Headless generation of synthetic sessions with known ground truth
+
+The sessions are simulated with :mod:`cellsino` (see
+:mod:`cellreel.wiz_init.task_simulate`) and can be opened in
+CellReel or used for measuring how the pipeline stages scale
+with the size of the input data.
+"""
+import json
+import pathlib
+
+import numpy as np
+
+from . import cache
+from .sino import rot
+from .wiz_init import task_simulate
+
+
+#: name of the ground truth file in a generated session
+GROUND_TRUTH_NAME = "workload.json"
+
+#: name of the rotation state written to "rotations.txt"
+ROTATION_NAME = "ground truth"
+
+
+def generate_session(path, num_frames=100, grid_size=(64, 64),
+                     angle_coverage=2*np.pi, duration=3, displacement=0.,
+                     axis_roll=0, fluorescence=True, fl_frame_rate_mult=1,
+                     fl_offsets=(0, 0), fl_bleach_decay=0, fl_background=0,
+                     phantom="simple cell", wavelength=550e-9,
+                     pixel_size=0.08e-6, propagator="rytov", block_size=8,
+                     use_cache=True):
+    """Simulate a session without user interaction
+
+    Parameters
+    ----------
+    path: str or pathlib.Path
+        Session directory (created if it does not exist); the
+        files "sinogram.h5", "rotations.txt", and "workload.json"
+        (ground truth) are written.
+    num_frames: int
+        Number of phase/amplitude frames
+    grid_size: tuple of int
+        Frame size [px]
+    angle_coverage: float
+        Angular range covered by the uniform rotation [rad]
+    displacement: float
+        Standard deviation of the lateral displacement noise [px]
+    propagator: str
+        Propagator for the field computation (see
+        :data:`cellsino.propagators.available`); "projection"
+        is much faster than "rytov".
+    use_cache: bool
+        Reuse the sinogram of a previous simulation with the same
+        parameters (see :func:`.task_simulate.simulate`)
+
+    For all other parameters, see :func:`.task_simulate.simulate`.
+
+    Returns
+    -------
+    truth: dict
+        Ground truth of the simulation (see :func:`get_ground_truth`)
+    """
+    path = pathlib.Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    angles = np.linspace(0, angle_coverage, num_frames, endpoint=False)
+    sinokw = {"phantom": phantom,
+              "wavelength": wavelength,
+              "pixel_size": pixel_size,
+              "grid_size": tuple(grid_size)}
+    computekw = task_simulate.get_compute_kwargs(
+        angles=angles,
+        duration=duration,
+        axis_roll=axis_roll,
+        fluorescence=fluorescence,
+        fl_frame_rate_mult=fl_frame_rate_mult,
+        fl_offsets=fl_offsets,
+        fl_bleach_decay=fl_bleach_decay,
+        fl_background=fl_background)
+    for kw in computekw:
+        # draw the displacements here to know them exactly
+        kw["displacements"] = task_simulate.get_displacements(
+            float(displacement), kw["angles"].size)
+        kw["propagator"] = propagator
+
+    path_sino = path / "sinogram.h5"
+    if path_sino.exists():
+        path_sino.unlink()
+    if use_cache:
+        sim_cache = cache.get_cache("simulations",
+                                    max_size=task_simulate.CACHE_SIZE)
+        key = task_simulate.get_cache_key(sinokw, computekw)
+    if not use_cache or not sim_cache.link(key, path_sino):
+        task_simulate.compute_sinograms(path=path_sino,
+                                        sinokw=sinokw,
+                                        computekw=computekw,
+                                        block_size=block_size)
+        if use_cache:
+            sim_cache.put(key, path_sino)
+
+    truth = get_ground_truth(computekw=computekw,
+                             duration=duration,
+                             angle_coverage=angle_coverage,
+                             axis_roll=axis_roll)
+    save_rotation_state(path, truth)
+    with (path / GROUND_TRUTH_NAME).open("w") as fd:
+        json.dump(truth, fd, indent=2)
+    return truth
+
+
+def get_ground_truth(computekw, duration, angle_coverage, axis_roll):
+    """Return the ground truth of a simulation
+
+    Parameters
+    ----------
+    computekw: list of dict
+        Simulation keyword arguments (see
+        :func:`.task_simulate.get_compute_kwargs`) with the
+        displacements given as arrays
+    duration: float
+        Duration of the phase/amplitude acquisition [s]
+    angle_coverage: float
+        Angular range covered during `duration` [rad]
+    axis_roll: float
+        Lateral rotation of the rotational axis [rad]
+
+    Returns
+    -------
+    truth: dict
+        With the keys "start" and "end" (interval of one full
+        rotation [s]) and "roll" [°], in CellReel convention, and
+        for each imaging modality ("phase" and "fluorescence")
+        the "times" [s], "angles" [rad], and "shifts" [px] of
+        all frames.
+    """
+    truth = {"start": 0.,
+             "end": duration * 2 * np.pi / angle_coverage,
+             "roll": float(np.rad2deg(axis_roll)),
+             }
+    for kw in computekw:
+        size = kw["angles"].size
+        times = kw["times"]
+        if isinstance(times, (int, float)):
+            times = np.linspace(0, times, size, endpoint=False)
+        name = "phase" if kw["mode"] == "field" else "fluorescence"
+        truth[name] = {
+            "times": np.asarray(times, dtype=float).tolist(),
+            # (the sign of the angles is inverted for cellsino)
+            "angles": (-kw["angles"]).tolist(),
+            "shifts": np.asarray(kw["displacements"]).tolist(),
+        }
+    return truth
+
+
+def load_ground_truth(path):
+    """Load the ground truth of a generated session"""
+    with (pathlib.Path(path) / GROUND_TRUTH_NAME).open() as fd:
+        truth = json.load(fd)
+    for name in ["phase", "fluorescence"]:
+        if name in truth:
+            for key in truth[name]:
+                truth[name][key] = np.array(truth[name][key])
+    return truth
+
+
+def save_rotation_state(path, truth):
+    """Write the true rotation parameters to "rotations.txt"
+
+    Existing rotation states of the session are kept.
+    """
+    states = rot.load_rotation_states(path)
+    p = rot.get_default_rotation_params()
+    p["Start"] = truth["start"]
+    p["End"] = truth["end"]
+    p["Roll"] = truth["roll"]
+    p["Spacing"] = "2PI uniform"
+    states[ROTATION_NAME] = p.saveState()
+    rot.save_rotation_states(path, states)
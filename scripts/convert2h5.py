@@ -1,47 +1,247 @@
-"""Convert original data to the HDF5 format (flseries/qpseries)"""
+"""Convert original data to the HDF5 format (flseries/qpseries)
+
+The meta data hints stored by CellReel (see
+:mod:`cellreel.wiz_init.meta_hints`) are used for each dataset.
+
+Examples
+--------
+Convert a single measurement::
+
+    python convert2h5.py /data/cell1/phase.zip
+
+Convert all measurements in a folder with four worker processes::
+
+    python convert2h5.py --jobs 4 "/data/2019-*/phase.zip"
+"""
+import argparse
+import concurrent.futures
+import glob
+import json
+import logging
+import multiprocessing as mp
 import pathlib
-import sys
+import time
+import traceback
 
+import cellreel.parallel
 import cellreel.wiz_init
 import qpformat
 
 
-if __name__ == "__main__":
-    path_in = pathlib.Path(sys.argv[-1])
-    path_out = path_in.parent.with_suffix(".converted")
-    path_out.mkdir(exist_ok=True)
+#: file in each output directory that identifies the converted input
+STATE_NAME = "convert2h5.json"
 
-    hints = cellreel.wiz_init.meta_hints.load_hints(path_in)
 
-    # QPI
-    meta_qpi = {"pixel size": hints["pixel size"]*1e-6,
-                "wavelength": hints["wavelength"]*1e-9,
-                "medium index": hints["medium index"],
-                }
+def convert_dataset(path_in, path_out, force=False):
+    """Convert a single dataset
 
-    # reference
-    if "path_reference_qpi" in hints:
-        refqpi = qpformat.load_data(hints["path_reference_qpi"],
-                                    meta_data=meta_qpi,
-                                    ).get_qpimage()
-        refqpi.copy(path_out / "reference_qpi.h5")
+    Parameters
+    ----------
+    path_in: pathlib.Path
+        QPI data with meta data hints
+    path_out: pathlib.Path
+        Output directory
+    force: bool
+        Convert the dataset even if the output directory already
+        contains the converted data of the same input
 
-    # main data
-    ds_qpi = qpformat.load_data(path_in,
-                                bg_data=hints["path_qpi_bg"],
-                                meta_data=meta_qpi,
-                                )
-    ds_qpi.saveh5(h5file=path_out / "sinogram_qpi.h5")
+    Returns
+    -------
+    summary: dict
+        Throughput summary
+    """
+    tstart = time.perf_counter()
+    path_out.mkdir(parents=True, exist_ok=True)
+    logger = get_logger(path_in, path_out / "convert2h5.log")
+    summary = {"path": str(path_in),
+               "status": "converted",
+               "frames": 0,
+               "size [MB]": 0,
+               }
+    try:
+        hints = cellreel.wiz_init.meta_hints.load_hints(path_in)
 
-    # FL
-    if "path_reference_fli" in hints:
-        meta_fli = {"pixel size": hints["pixel size fl"]*1e-6}
+        # QPI
+        meta_qpi = {"pixel size": hints["pixel size"]*1e-6,
+                    "wavelength": hints["wavelength"]*1e-9,
+                    "medium index": hints["medium index"],
+                    }
+        ds_qpi = qpformat.load_data(path_in,
+                                    bg_data=hints.get("path_qpi_bg"),
+                                    meta_data=meta_qpi,
+                                    )
+        inputs = [path_in, hints.get("path_qpi_bg"),
+                  hints.get("path_reference_qpi")]
+        identifiers = [ds_qpi.identifier]
+        # FL
+        if "path_reference_fli" in hints:
+            meta_fli = {"pixel size": hints["pixel size fl"]*1e-6}
+            ds_fli = cellreel.wiz_init.flformat.load_data(
+                hints["path_fl"], meta_data=meta_fli)
+            inputs += [hints["path_fl"], hints["path_reference_fli"]]
+            identifiers.append(ds_fli.identifier)
+        else:
+            ds_fli = None
+        summary["frames"] = len(ds_qpi) + (len(ds_fli) if ds_fli else 0)
+        summary["size [MB]"] = sum(get_size(pp)
+                                   for pp in inputs if pp) / 1024**2
 
+        state = {"identifier": ":".join(identifiers)}
+        path_state = path_out / STATE_NAME
+        if not force and path_state.exists():
+            with path_state.open() as fd:
+                if json.load(fd) == state:
+                    logger.info("Output is up to date, skipping")
+                    summary["status"] = "skipped"
+                    return summary
+        # invalidate any previous output
+        if path_state.exists():
+            path_state.unlink()
+
+        logger.info("Converting QPI data")
         # reference
-        reffli = cellreel.wiz_init.flformat.load_data(
-            hints["path_reference_fli"], meta_data=meta_fli).get_flimage()
-        reffli.copy(path_out / "reference_fli.h5")
+        if "path_reference_qpi" in hints:
+            refqpi = qpformat.load_data(hints["path_reference_qpi"],
+                                        meta_data=meta_qpi,
+                                        ).get_qpimage()
+            refqpi.copy(path_out / "reference_qpi.h5")
+
+        # main data
+        ds_qpi.saveh5(h5file=path_out / "sinogram_qpi.h5")
+
+        if ds_fli is not None:
+            logger.info("Converting fluorescence data")
+            # reference
+            reffli = cellreel.wiz_init.flformat.load_data(
+                hints["path_reference_fli"],
+                meta_data=meta_fli).get_flimage()
+            reffli.copy(path_out / "reference_fli.h5")
+            ds_fli.saveh5(h5file=path_out / "sinogram_fli.h5")
+
+        with path_state.open("w") as fd:
+            json.dump(state, fd)
+        logger.info("Done")
+    except Exception:
+        logger.error(traceback.format_exc())
+        summary["status"] = "failed"
+    finally:
+        summary["time [s]"] = time.perf_counter() - tstart
+        for handler in logger.handlers[:]:
+            handler.close()
+            logger.removeHandler(handler)
+    return summary
+
+
+def get_logger(path_in, path_log):
+    """Return a logger that writes to the log file of a dataset"""
+    logger = logging.getLogger("convert2h5.{}".format(path_in))
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(str(path_log))
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    return logger
+
 
-        ds_fli = cellreel.wiz_init.flformat.load_data(hints["path_fl"],
-                                                      meta_data=meta_fli)
-        ds_fli.saveh5(h5file=path_out / "sinogram_fli.h5")
+def get_size(path):
+    """Return the size of a file or of all files in a directory [B]"""
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return sum(pp.stat().st_size for pp in path.rglob("*")
+                   if pp.is_file())
+    else:
+        return path.stat().st_size
+
+
+def get_output_path(path_in, path_out=None):
+    """Return the output directory of a dataset
+
+    If `path_out` is not given, the output is stored next to
+    the input directory, e.g. "/data/cell1/phase.zip" is
+    converted to "/data/cell1.converted/phase/".
+    """
+    path_in = pathlib.Path(path_in)
+    if path_out is None:
+        return path_in.parent.with_suffix(".converted") / path_in.stem
+    else:
+        return pathlib.Path(path_out) / path_in.parent.name / path_in.stem
+
+
+def expand_paths(patterns):
+    """Expand glob patterns and return a sorted list of unique paths
+
+    Paths in output directories (see :func:`get_output_path`)
+    are ignored.
+    """
+    paths = set()
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths.update(glob.glob(pattern, recursive=True))
+        else:
+            paths.add(pattern)
+    paths = [pathlib.Path(pp).resolve() for pp in paths]
+    return sorted(pp for pp in paths
+                  if not any(pa.suffix == ".converted" for pa in pp.parents))
+
+
+def format_summary(summaries):
+    """Return the throughput summary as tab-separated values"""
+    lines = ["\t".join(["path", "status", "frames", "size [MB]", "time [s]",
+                        "frames/s", "MB/s"])]
+    for sm in summaries:
+        tt = max(sm["time [s]"], 1e-9)
+        lines.append("{}\t{}\t{}\t{:.1f}\t{:.1f}\t{:.2f}\t{:.2f}".format(
+            sm["path"], sm["status"], sm["frames"], sm["size [MB]"],
+            sm["time [s]"], sm["frames"] / tt, sm["size [MB]"] / tt))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Convert QPI and fluorescence measurements to HDF5 "
+                    "using the meta data hints stored by CellReel.")
+    parser.add_argument("paths", nargs="+",
+                        help="QPI data paths or glob patterns")
+    parser.add_argument("-o", "--output",
+                        help="output directory (default: next to the "
+                             "measurement directory with the suffix "
+                             "'.converted')")
+    parser.add_argument("-j", "--jobs", type=int,
+                        default=cellreel.parallel.get_worker_count(),
+                        help="number of datasets converted in parallel")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="convert datasets even if the output is up "
+                             "to date")
+    parser.add_argument("-s", "--summary",
+                        help="write the throughput summary to this file")
+    args = parser.parse_args(args)
+
+    paths = expand_paths(args.paths)
+    tstart = time.perf_counter()
+    summaries = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.jobs,
+            mp_context=mp.get_context("spawn")) as pool:
+        futures = [pool.submit(convert_dataset,
+                               path_in=pp,
+                               path_out=get_output_path(pp, args.output),
+                               force=args.force)
+                   for pp in paths]
+        for ii, fut in enumerate(concurrent.futures.as_completed(futures)):
+            sm = fut.result()
+            summaries.append(sm)
+            print("[{}/{}] {}: {} ({:.1f} s)".format(
+                ii + 1, len(paths), sm["path"], sm["status"],
+                sm["time [s]"]))
+    summaries.sort(key=lambda x: x["path"])
+    text = format_summary(summaries)
+    print(text)
+    print("Total: {} datasets in {:.1f} s".format(
+        len(summaries), time.perf_counter() - tstart))
+    if args.summary:
+        pathlib.Path(args.summary).write_text(text + "\n")
+    return summaries
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Generate synthetic CellReel sessions for performance testing
+
+One session is generated for every combination of the given
+frame counts, grid sizes, fluorescence frame rate multipliers,
+and displacement noise levels. Each session contains the ground
+truth in "workload.json" (see :mod:`cellreel.workload`).
+
+Examples
+--------
+Generate sessions with 100, 200, and 400 frames::
+
+    python generate_workload.py /data/workload --frames 100 200 400
+
+Generate sessions with different grid sizes using the fast
+projection propagator::
+
+    python generate_workload.py /data/workload --grid 64 128 256 \\
+        --propagator projection
+"""
+import argparse
+import itertools
+import pathlib
+import time
+
+import cellreel.workload
+
+
+def get_session_name(frames, grid, fl_mult, displacement):
+    """Return the directory name of a generated session"""
+    return "frames{}_grid{}_flmult{:g}_disp{:g}".format(
+        frames, grid, fl_mult, displacement)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic sessions with known ground truth.")
+    parser.add_argument("output", help="output directory")
+    parser.add_argument("--frames", type=int, nargs="+", default=[100],
+                        help="number of phase/amplitude frames")
+    parser.add_argument("--grid", type=int, nargs="+", default=[64],
+                        help="frame size [px]")
+    parser.add_argument("--fl-mult", type=float, nargs="+", default=[1.],
+                        help="fluorescence frame rate multiplier; 0 "
+                             "disables fluorescence")
+    parser.add_argument("--displacement", type=float, nargs="+",
+                        default=[0.],
+                        help="standard deviation of the lateral "
+                             "displacement noise [px]")
+    parser.add_argument("--duration", type=float, default=3,
+                        help="acquisition duration [s]")
+    parser.add_argument("--propagator", default="rytov",
+                        help="propagator for the field computation")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not reuse previously simulated sinograms")
+    args = parser.parse_args(args)
+
+    output = pathlib.Path(args.output)
+    paths = []
+    for frames, grid, fl_mult, disp in itertools.product(
+            args.frames, args.grid, args.fl_mult, args.displacement):
+        path = output / get_session_name(frames, grid, fl_mult, disp)
+        tstart = time.perf_counter()
+        cellreel.workload.generate_session(
+            path=path,
+            num_frames=frames,
+            grid_size=(grid, grid),
+            duration=args.duration,
+            displacement=disp,
+            fluorescence=fl_mult > 0,
+            fl_frame_rate_mult=fl_mult or 1,
+            propagator=args.propagator,
+            use_cache=not args.no_cache)
+        print("{} ({:.1f} s)".format(path, time.perf_counter() - tstart))
+        paths.append(path)
+    return paths
+
+
+if __name__ == "__main__":
+    main()
@@ -35,9 +35,10 @@ setup(
         "pyqt5",
         "pyqtgraph==0.12.1",  # visualization
         "qpformat>=0.10.8",  # loading QPI data
-        "qpimage>=0.5.2",  # QPI data management
+        "qpimage>=0.6.0",  # QPI data management
         "radontea>=0.4.1",  # OPT reconstruction
         "scikit-image>=0.11.0",  # series alignment
+        "scipy>=1.6.0",  # image transforms
         "tifffile",  # loading single fluorescence images
         ],
     python_requires='>=3.6, <4',
@@ -2,6 +2,12 @@ import shutil
 import tempfile
 import time
 
+import flimage
+import h5py
+import numpy as np
+import pytest
+import qpimage
+
 TMPDIR = tempfile.mkdtemp(prefix=time.strftime(
     "cellreel_test_%H.%M_"))
 
@@ -20,3 +26,29 @@ def pytest_unconfigure(config):
     called before test process is exited.
     """
     shutil.rmtree(TMPDIR, ignore_errors=True)
+
+
+@pytest.fixture
+def sinogram(tmp_path):
+    """Path to a small raw sinogram with phase and fluorescence data"""
+    path = tmp_path / "sinogram.h5"
+    num = 10
+    shape = (32, 32)
+    rng = np.random.RandomState(42)
+    with h5py.File(path, "w") as h5:
+        with qpimage.QPSeries(h5file=h5.require_group("qpseries")) as qps:
+            for ii in range(num):
+                qpi = qpimage.QPImage(
+                    data=(rng.rand(*shape), 1 + .1*rng.rand(*shape)),
+                    which_data="phase,amplitude",
+                    meta_data={"time": ii*.1,
+                               "wavelength": 550e-9,
+                               "pixel size": .1e-6,
+                               "medium index": 1.335})
+                qps.add_qpimage(qpi)
+        with flimage.FLSeries(h5file=h5.require_group("flseries")) as fls:
+            for ii in range(2*num):
+                fls.add_flimage(flimage.FLImage(
+                    data=rng.rand(*shape),
+                    meta_data={"time": ii*.05}))
+    return path
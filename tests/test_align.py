@@ -0,0 +1,122 @@
+"""alignment tests"""
+import h5py
+import numpy as np
+import pytest
+
+from cellreel.sino.shift import ShiftedStack
+from cellreel.sino.sino_view import SinoView
+from cellreel.wiz_align import task_align
+
+
+def test_run_transform_error(qtbot, tmp_path, sinogram, monkeypatch):
+    """Errors in the transform thread are raised in the GUI thread"""
+    def transform(**kwargs):
+        raise ValueError("worker failed")
+
+    monkeypatch.setattr(task_align, "transform", transform)
+    sv = SinoView(sinogram).load()
+    with h5py.File(tmp_path / "out.h5", "w") as h5:
+        with pytest.raises(ValueError, match="worker failed"):
+            task_align.run_transform(data=sv,
+                                     times=sv.get_times("phase"),
+                                     shiftx=np.zeros(10),
+                                     shifty=np.zeros(10),
+                                     h5out=h5)
+
+
+def test_shift_images_fourier_spline():
+    """Fourier and spline resampling agree for smooth images"""
+    xx, yy = np.mgrid[:64, :64]
+    images = np.zeros((3, 64, 64), dtype=np.float32)
+    for ii, (cx, cy) in enumerate([(30, 32), (33.5, 31), (32, 29.25)]):
+        images[ii] = np.exp(-((xx - cx)**2 + (yy - cy)**2) / 50)
+    shifts = np.array([[2, -2], [-1.5, 1], [0.25, 2.75]])
+
+    spline = task_align.shift_images(images, shifts, method="spline")
+    fourier = task_align.shift_images(images, shifts, method="fourier")
+    assert spline.dtype == images.dtype
+    assert fourier.dtype == images.dtype
+    assert np.allclose(spline, fourier, atol=1e-3)
+    # integer shifts are exact
+    assert np.allclose(fourier[0], np.roll(images[0], (2, -2), axis=(0, 1)),
+                       atol=1e-6)
+
+
+def test_shift_images_cval():
+    """The background value is preserved at the image border"""
+    images = np.ones((2, 16, 16))
+    shifts = np.array([[3, 0], [0, -3.5]])
+    for method in ["spline", "fourier"]:
+        out = task_align.shift_images(images, shifts, method=method, cval=1)
+        assert np.allclose(out, 1)
+
+
+def test_shifted_stack():
+    images = np.random.rand(5, 16, 16)
+    shifts = np.random.rand(5, 2) * 4 - 2
+    stack = ShiftedStack(images, shifts, cache_size=2)
+    ref = task_align.shift_images(images, shifts)
+    assert np.allclose(stack[3], ref[3])
+    assert np.allclose(stack[-1], ref[-1])
+    assert np.allclose(stack[1:4], ref[1:4])
+    assert np.allclose(stack[2, 3:5], ref[2, 3:5])
+    assert len(stack._cache) == 2
+    # display levels do not resample the entire stack
+    stack.level_frames = 3
+    assert stack.max() == ref[[0, 2, 4]].max()
+    assert stack.min() == ref[[0, 2, 4]].min()
+    assert stack._full is None
+    assert np.allclose(np.asarray(stack), ref)
+    assert stack.max() == ref.max()
+
+
+def test_virtual_alignment(tmp_path, sinogram):
+    sv = SinoView(sinogram).load()
+    shiftx = np.linspace(-2, 2, 10)
+    shifty = np.linspace(1, 0, 10)
+    kw = {"data": sv,
+          "times": sv.get_times("phase"),
+          "shiftx": shiftx,
+          "shifty": shifty,
+          "shift_method": "spline"}
+    with h5py.File(tmp_path / "sinogram_1.h5", "w") as h5:
+        task_align.transform(h5out=h5, **kw)
+    with h5py.File(tmp_path / "sinogram_2.h5", "w") as h5:
+        task_align.write_virtual(h5out=h5, **kw)
+    sv1 = SinoView(tmp_path / "sinogram_1.h5").load()
+    sv2 = SinoView(tmp_path / "sinogram_2.h5").load()
+    assert not sv1.is_virtual()
+    assert sv2.is_virtual()
+    assert np.allclose(sv1.pha, np.asarray(sv2.pha), atol=1e-6)
+    assert np.allclose(sv1.amp, np.asarray(sv2.amp), atol=1e-6)
+    assert np.allclose(sv1.fl, np.asarray(sv2.fl), atol=1e-6)
+    assert np.allclose(sv1.get_times("fluorescence"),
+                       sv2.get_times("fluorescence"))
+    # the virtual sinogram is small
+    assert (tmp_path / "sinogram_2.h5").stat().st_size < 50000
+
+
+def test_preview_shifts():
+    # a disk that moves through the image
+    xx, yy = np.mgrid[:200, :200]
+    image_data = np.zeros((20, 200, 200))
+    for ii in range(20):
+        image_data[ii] = ((xx - 90 - ii)**2 + (yy - 100)**2) < 30**2
+    method = "Center of mass (threshold image)"
+    preproc_kw = {"thresh": .5}
+    shiftx, shifty = task_align.compute_shifts(method=method,
+                                               image_data=image_data,
+                                               preproc_kw=preproc_kw)
+    indices, px, py = task_align.preview_shifts(method=method,
+                                                preproc_kw=preproc_kw,
+                                                image_data=image_data,
+                                                num_frames=5,
+                                                max_size=100)
+    assert np.all(indices == [0, 4, 9, 14, 19])
+    assert np.allclose(px, shiftx[indices], atol=1)
+    assert np.allclose(py, shifty[indices], atol=1)
+    # failed alignment
+    _, px, py = task_align.preview_shifts(method=method,
+                                          preproc_kw={"thresh": 2.},
+                                          image_data=image_data)
+    assert np.all(np.isnan(px))
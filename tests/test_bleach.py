@@ -0,0 +1,127 @@
+"""bleach correction tests"""
+import pickle
+
+import flimage
+import h5py
+import numpy as np
+import pytest
+from skimage.restoration import denoise_tv_chambolle
+
+from cellreel.sino.sino_view import SinoView, get_broken_links
+from cellreel.tab_sino import get_sinograms
+from cellreel.wiz_flcorr import task_bleach
+
+
+def test_bleach_correction_flimage(tmp_path):
+    """The streaming correction must match flimage's implementation"""
+    rng = np.random.RandomState(47)
+    times = np.linspace(0, 10, 20)
+    xx, yy = np.mgrid[:40, :40]
+    blob = np.exp(-((xx - 20)**2 + (yy - 20)**2) / 50)
+    fl = np.array([10 * blob * np.exp(-tt / 5) + 2 + .1*rng.rand(40, 40)
+                   for tt in times])
+    meta = [{"time": tt} for tt in times]
+    flsin = flimage.FLSeries(flimage_list=[
+        flimage.FLImage(data=fl[ii], meta_data=meta[ii])
+        for ii in range(len(times))])
+
+    with h5py.File(tmp_path / "ref.h5", "w") as h5:
+        ref = flsin.bleach_correction(h5out=h5.require_group("flseries"),
+                                      border_px=5)
+        ref_fl = np.array([fli.fl for fli in
+                           flimage.FLSeries(h5file=h5["flseries"])])
+
+    with h5py.File(tmp_path / "out.h5", "w") as h5:
+        res = task_bleach.compute_bleach_correction(
+            fl=fl, meta_fli=meta, times=times,
+            h5out=h5.require_group("flseries"),
+            border_px=5, denoise=False, chunk_size=7)
+        res_fl = np.array([fli.fl for fli in
+                           flimage.FLSeries(h5file=h5["flseries"])])
+
+    for a, b in zip(ref, res):
+        assert np.allclose(a, b)
+    assert np.allclose(ref_fl, res_fl, atol=1e-5)
+
+
+def test_bleach_correction_denoise_parallel(tmp_path):
+    """Frames denoised in a process pool are written in order"""
+    rng = np.random.RandomState(47)
+    times = np.linspace(0, 10, 13)
+    fl = 2 + rng.rand(13, 30, 30) * np.exp(-times / 5).reshape(-1, 1, 1)
+    meta = [{"time": tt} for tt in times]
+    with h5py.File(tmp_path / "out.h5", "w") as h5:
+        bg, _, decay, _ = task_bleach.compute_bleach_correction(
+            fl=fl, meta_fli=meta, times=times,
+            h5out=h5.require_group("flseries"),
+            h5denoised=h5.require_group("denoised"),
+            border_px=5, denoise=True, denoise_chunk_size=3)
+        res_fl = np.array([fli.fl for fli in
+                           flimage.FLSeries(h5file=h5["flseries"])])
+        res_dn = np.array([fli.fl for fli in
+                           flimage.FLSeries(h5file=h5["denoised"])])
+        res_times = [fli["time"] for fli in
+                     flimage.FLSeries(h5file=h5["flseries"])]
+    ref_dn = np.array([denoise_tv_chambolle(im, weight=2) for im in fl])
+    ref_fl = (ref_dn - bg) * (decay[0] / decay).reshape(-1, 1, 1)
+    assert np.allclose(res_times, times)
+    assert np.allclose(res_dn, ref_dn, atol=1e-5)
+    assert np.allclose(res_fl, ref_fl, atol=1e-5)
+
+
+def test_bleach_correction_link_qpi(qtbot, sinogram):
+    """Unchanged QPI data are linked instead of copied"""
+    sv = SinoView(sinogram).load()
+    path_out = sinogram.parent / "sinogram_1.h5"
+    task_bleach.bleach_correction(denoise=False, border_px=5, data=sv,
+                                  name="bleach", path_out=path_out)
+    with h5py.File(path_out, "r") as h5:
+        link = h5.get("qpseries", getlink=True)
+        assert isinstance(link, h5py.ExternalLink)
+        assert link.filename == "sinogram.h5"
+    svb = SinoView(path_out).load()
+    assert np.all(svb.pha == sv.pha)
+    assert np.all(svb.amp == sv.amp)
+    assert list(get_sinograms(sinogram.parent)) == ["Raw Sinogram", "bleach"]
+    # derived sinograms without parent data are ignored
+    sinogram.rename(sinogram.parent / "other.h5")
+    assert get_broken_links(path_out) == ["qpseries"]
+    missing = {}
+    with pytest.warns(UserWarning, match="qpseries"):
+        assert list(get_sinograms(sinogram.parent, missing=missing)) \
+            == ["Raw Sinogram"]
+    assert missing == {path_out: ["sinogram.h5"]}
+
+
+def test_bleach_correction_error(qtbot, sinogram, monkeypatch):
+    """Errors of the correction are raised in the GUI thread"""
+    def compute_bleach_correction(**kwargs):
+        raise ValueError("fit failed")
+
+    monkeypatch.setattr(task_bleach, "compute_bleach_correction",
+                        compute_bleach_correction)
+    sv = SinoView(sinogram).load()
+    with pytest.raises(ValueError, match="fit failed"):
+        task_bleach.bleach_correction(denoise=False, border_px=5, data=sv,
+                                      name="bleach",
+                                      path_out=sinogram.parent / "bleach.h5")
+
+
+def test_bleach_correction_denoise_error(qtbot, sinogram, monkeypatch):
+    """Errors in the denoising process pool do not block the wizard"""
+    def denoise_chunk(job):
+        raise ValueError("denoising failed")
+
+    sv = SinoView(sinogram).load()
+    path_out = sinogram.parent / "bleach.h5"
+    # `int` fails in the worker process
+    monkeypatch.setattr(task_bleach, "denoise_chunk", int)
+    with pytest.raises(TypeError, match="int"):
+        task_bleach.bleach_correction(denoise=True, border_px=5, data=sv,
+                                      name="bleach", path_out=path_out)
+    # local functions cannot be sent to the worker processes
+    monkeypatch.setattr(task_bleach, "denoise_chunk", denoise_chunk)
+    with pytest.raises((AttributeError, pickle.PicklingError),
+                       match="pickle"):
+        task_bleach.bleach_correction(denoise=True, border_px=5, data=sv,
+                                      name="bleach", path_out=path_out)
@@ -0,0 +1,67 @@
+"""file cache tests"""
+import os
+import stat
+import time
+
+import numpy as np
+
+from cellreel import cache
+
+
+def test_hash_parameters():
+    """Keys do not depend on the order of keyword arguments"""
+    k1 = cache.hash_parameters(a=np.arange(3), b={"c": 1, "d": "e"})
+    k2 = cache.hash_parameters(b={"d": "e", "c": 1}, a=[0, 1, 2])
+    k3 = cache.hash_parameters(a=np.arange(4), b={"c": 1, "d": "e"})
+    assert k1 == k2
+    assert k1 != k3
+
+
+def test_link_evict(tmp_path):
+    """Cached files are linked into sessions and evicted by size"""
+    fc = cache.FileCache(tmp_path / "cache", max_size=250)
+    for ii, key in enumerate(["a", "b", "c"]):
+        src = tmp_path / "{}.dat".format(key)
+        src.write_bytes(b"0" * 100)
+        fc.put(key, src)
+        # session files remain writable
+        assert src.stat().st_mode & stat.S_IWUSR
+        # distinct access times
+        fc.set_access_times({key: ii})
+    # "a" is the least recently used entry
+    assert "a" not in fc
+    assert "b" in fc and "c" in fc
+    # access "b" and add "d"
+    assert fc.link("b", tmp_path / "session_b.dat")
+    assert (tmp_path / "session_b.dat").read_bytes() == b"0" * 100
+    assert (tmp_path / "session_b.dat").stat().st_mode & stat.S_IWUSR
+    time.sleep(.01)
+    (tmp_path / "d.dat").write_bytes(b"1" * 100)
+    fc.put("d", tmp_path / "d.dat")
+    assert "c" not in fc
+    assert "b" in fc and "d" in fc
+    assert not fc.link("a", tmp_path / "session_a.dat")
+
+
+def test_access_times(tmp_path):
+    """Accessing an entry does not modify linked session files"""
+    fc = cache.FileCache(tmp_path / "cache", max_size=250)
+    src = tmp_path / "session_a.dat"
+    src.write_bytes(b"0" * 100)
+    fc.put("a", src)
+    os.utime(src, (100, 100))
+    key = cache.get_file_key(src)
+    assert fc.link("a", tmp_path / "session_b.dat")
+    assert fc.get("a") == fc.get_path("a")
+    assert src.stat().st_mtime == 100
+    assert cache.get_file_key(src) == key
+    assert fc.get_access_times()["a"] > 100
+    # entries without access time are ranked by modification time
+    (tmp_path / "cache" / cache.ACCESS_INDEX).write_text("no json")
+    (tmp_path / "b.dat").write_bytes(b"1" * 100)
+    fc.put("b", tmp_path / "b.dat")
+    (tmp_path / "c.dat").write_bytes(b"2" * 100)
+    fc.put("c", tmp_path / "c.dat")
+    assert "a" not in fc
+    assert "b" in fc and "c" in fc
+    assert sorted(fc.get_access_times()) == ["b", "c"]
@@ -0,0 +1,22 @@
+"""colocalization tests"""
+import numpy as np
+from skimage.transform import warp
+
+from cellreel.wiz_init import coloc
+
+
+def test_warp_fl_affine():
+    """The affine fast path matches the original skimage warp"""
+    rng = np.random.RandomState(42)
+    kw = {"p_qp": (30.5, 40.2),
+          "p_fl": (50.1, 60.7),
+          "res_qp": .139,
+          "res_fl": .091}
+    for fl in [rng.rand(120, 100),
+               (rng.rand(120, 100) * 4000).astype(np.uint16)]:
+        ref = warp(image=fl,
+                   inverse_map=coloc.transform_function,
+                   map_args=kw,
+                   output_shape=(90, 80))
+        flc = coloc.warp_fl(fl=fl, output_shape=(90, 80), **kw)
+        assert np.allclose(ref, flc)
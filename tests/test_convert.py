@@ -0,0 +1,247 @@
+"""data import tests"""
+import os
+import pathlib
+import time
+
+import h5py
+import numpy as np
+import pytest
+import qpformat
+import qpimage
+
+from cellreel.wiz_init import task_convert
+
+
+def test_import_qpi(tmp_path, sinogram):
+    """Parallel import matches qpformat's `saveh5`"""
+    with h5py.File(sinogram, "r") as h5, \
+            qpimage.QPSeries(h5file=h5["qpseries"], h5mode="r") as qps:
+        # background data
+        with qps[0].copy(h5file=tmp_path / "bg.h5"):
+            pass
+    path_qpi = tmp_path / "qpseries.h5"
+    with h5py.File(sinogram, "r") as h5, h5py.File(path_qpi, "w") as h5q:
+        h5.copy("qpseries", h5q, name="qpseries")
+    load_kw = {"path": path_qpi,
+               "bg_data": tmp_path / "bg.h5",
+               "meta_data": {}}
+    ds = qpformat.load_data(**load_kw)
+    assert not task_convert.has_bg_per_frame(load_kw["bg_data"])
+    assert task_convert.has_bg_per_frame(path_qpi)
+    assert not task_convert.has_bg_per_frame(None)
+    kw = {"qpi_slice": (slice(2, 20), slice(5, 25)),
+          "time_interval": (0, 1)}
+    with h5py.File(tmp_path / "ref.h5", "w") as h5:
+        ds.saveh5(h5file=h5.require_group("qpseries"), **kw)
+    with h5py.File(tmp_path / "out.h5", "w") as h5:
+        task_convert.import_qpi(ds=ds, load_kw=load_kw,
+                                h5file=h5.require_group("qpseries"),
+                                chunk_size=3, **kw)
+    with h5py.File(tmp_path / "ref.h5", "r") as h5r, \
+            h5py.File(tmp_path / "out.h5", "r") as h5o:
+        ref = qpimage.QPSeries(h5file=h5r["qpseries"], h5mode="r")
+        out = qpimage.QPSeries(h5file=h5o["qpseries"], h5mode="r")
+        assert len(ref) == len(out) == 10
+        for qr, qo in zip(ref, out):
+            assert qr["time"] == qo["time"]
+            assert qr["identifier"] == qo["identifier"]
+            assert np.allclose(qr.pha, qo.pha)
+            assert np.allclose(qr.amp, qo.amp)
+            assert np.allclose(qr.bg_pha, qo.bg_pha)
+
+
+@pytest.mark.parametrize("fit_profile,fit_offset", [("tilt", "mean"),
+                                                    ("poly2o", "fit"),
+                                                    ("offset", "mode")])
+def test_correct_bg_batch(sinogram, fit_profile, fit_offset):
+    """Batch background correction matches qpimage's `compute_bg`"""
+    bgkw = {"fit_profile": fit_profile,
+            "fit_offset": fit_offset,
+            "border_px": 5}
+    with h5py.File(sinogram, "a") as h5:
+        h5.copy("qpseries", h5, name="reference")
+        with qpimage.QPSeries(h5file=h5["reference"]) as qps:
+            for qpi in qps:
+                qpi.compute_bg(which_data=["phase", "amplitude"], **bgkw)
+        task_convert.correct_bg(h5file=h5["qpseries"], bgkw=bgkw,
+                                batch_size=3)
+        ref = qpimage.QPSeries(h5file=h5["reference"])
+        out = qpimage.QPSeries(h5file=h5["qpseries"])
+        for qr, qo in zip(ref, out):
+            assert np.allclose(qr["time"], qo["time"])
+            assert np.allclose(qr.pha, qo.pha, atol=1e-5)
+            assert np.allclose(qr.amp, qo.amp, atol=1e-5)
+
+
+def test_set_bg_fit(sinogram):
+    """Fitted backgrounds are set via qpimage's image data classes"""
+    assert task_convert.bg_batch.can_batch({"border_px": 3})
+    with h5py.File(sinogram, "a") as h5:
+        qpi = qpimage.QPSeries(h5file=h5["qpseries"])[0]
+        ref = qpi.copy()
+        ref.compute_bg(which_data=["phase", "amplitude"], border_px=3)
+        bg_pha = ref.bg_pha - qpi.bg_pha
+        bg_amp = ref.bg_amp / qpi.bg_amp
+        task_convert.bg_batch.set_bg_fit(qpi, bg_pha=bg_pha, bg_amp=bg_amp,
+                                         attrs={"border_px": 3})
+        assert np.allclose(qpi.pha, ref.pha, atol=1e-6)
+        assert np.allclose(qpi.amp, ref.amp, atol=1e-6)
+        assert qpi.h5["phase/bg_data/fit"].attrs["border_px"] == 3
+        task_convert.bg_batch.set_bg_fit(qpi, bg_pha=None, bg_amp=None)
+        assert np.allclose(qpi.bg_pha, 0)
+        assert np.allclose(qpi.bg_amp, 1)
+
+
+def test_import_qpi_resume(tmp_path, sinogram):
+    """Interrupted imports continue from the last checkpoint"""
+    path_qpi = tmp_path / "qpseries.h5"
+    with h5py.File(sinogram, "r") as h5, h5py.File(path_qpi, "w") as h5q:
+        h5.copy("qpseries", h5q, name="qpseries")
+    load_kw = {"path": path_qpi,
+               "bg_data": None,
+               "meta_data": {}}
+    ds = qpformat.load_data(**load_kw)
+    kw = {"ds": ds,
+          "load_kw": load_kw,
+          "qpi_slice": (slice(2, 20), slice(5, 25)),
+          "time_interval": (0, 1),
+          "t0": .3,
+          "chunk_size": 3}
+    with h5py.File(tmp_path / "out.h5", "w") as h5:
+        h5.copy(h5.require_group("qpseries"), h5, name="reference")
+        task_convert.import_qpi(h5file=h5["reference"], **kw)
+        task_convert.import_qpi(h5file=h5["qpseries"], **kw)
+        assert tuple(h5["qpseries"].attrs["import checkpoint"]) == (10, 10)
+        # simulate an interruption at frame 5 (after writing frame 6)
+        h5["qpseries"].attrs["import checkpoint"] = (5, 5)
+        task_convert.truncate_series(h5["qpseries"], 7)
+        start, size = h5["qpseries"].attrs["import checkpoint"]
+        task_convert.truncate_series(h5["qpseries"], size)
+        task_convert.import_qpi(h5file=h5["qpseries"], start=start, **kw)
+        # background correction
+        bgkw = {"fit_profile": "tilt", "border_px": 3}
+        task_convert.correct_bg(h5file=h5["reference"], bgkw=bgkw)
+        task_convert.correct_bg(h5file=h5["qpseries"], bgkw=bgkw)
+        # frames after the checkpoint are processed again
+        h5["qpseries"].attrs["bg checkpoint"] = 4
+        task_convert.correct_bg(h5file=h5["qpseries"], bgkw=bgkw, start=4)
+        ref = qpimage.QPSeries(h5file=h5["reference"])
+        out = qpimage.QPSeries(h5file=h5["qpseries"])
+        assert len(ref) == len(out) == 10
+        for ii, (qr, qo) in enumerate(zip(ref, out)):
+            assert qr["identifier"] == qo["identifier"]
+            assert np.allclose(qr["time"], qo["time"])
+            assert np.isclose(qo["time"], ds.get_time(ii) - .3)
+            assert np.allclose(qr.pha, qo.pha)
+            assert np.allclose(qr.amp, qo.amp)
+
+
+def test_prepare_staging(tmp_path):
+    """Corrupt and old staging files of other imports are removed"""
+    path_stage = task_convert.prepare_staging(tmp_path, "a")
+    assert path_stage == tmp_path / "a.h5.partial"
+    with h5py.File(path_stage, "w") as h5:
+        h5.attrs["import key"] = "a"
+    assert task_convert.prepare_staging(tmp_path, "a").exists()
+    # interrupted imports with other parameters are kept for a while
+    assert task_convert.prepare_staging(tmp_path, "b") != path_stage
+    assert path_stage.exists()
+    age = task_convert.STAGING_MAX_AGE + 10
+    os.utime(path_stage, (time.time() - age, time.time() - age))
+    task_convert.prepare_staging(tmp_path, "b")
+    assert not path_stage.exists()
+    # corrupt staging file
+    path_stage.write_bytes(b"no hdf5")
+    assert not task_convert.prepare_staging(tmp_path, "a").exists()
+
+
+def test_finish_staging(tmp_path, monkeypatch):
+    """Staging files are copied if they cannot be renamed"""
+    def replace(src, dst):
+        if pathlib.Path(src).parent != pathlib.Path(dst).parent:
+            raise OSError(18, "Invalid cross-device link")
+        os_replace(src, dst)
+
+    os_replace = os.replace
+    monkeypatch.setattr(task_convert.os, "replace", replace)
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "session").mkdir()
+    path_stage = tmp_path / "cache" / "a.h5.partial"
+    path_stage.write_bytes(b"sinogram")
+    (tmp_path / "session" / "sinogram.h5").write_bytes(b"old")
+    task_convert.finish_staging(path_stage, tmp_path / "session"
+                                / "sinogram.h5")
+    assert not path_stage.exists()
+    assert (tmp_path / "session" / "sinogram.h5").read_bytes() == b"sinogram"
+    assert sorted(pp.name for pp in (tmp_path / "session").iterdir()) \
+        == ["sinogram.h5"]
+
+
+def get_convert_kwargs(tmp_path, sinogram):
+    """Keyword arguments for `convert` with a copy of `sinogram`"""
+    path_qpi = tmp_path / "qpseries.h5"
+    with h5py.File(sinogram, "r") as h5, h5py.File(path_qpi, "w") as h5q:
+        h5.copy("qpseries", h5q, name="qpseries")
+    return {"path_qpi": path_qpi,
+            "path_qpi_bg": None,
+            "path_fl": None,
+            "wavelength": 550e-9,
+            "pixel_size": .1e-6,
+            "medium_index": 1.335,
+            "slice_qpi": (slice(0, -1), slice(0, -1)),
+            "interval_qpi": (0, 9),
+            "bgkw_qpi": {"border_px": 3},
+            "colockw": {}}
+
+
+def test_convert_resume(qtbot, tmp_path, sinogram, monkeypatch):
+    """An interrupted import is continued in a new session"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    kw = get_convert_kwargs(tmp_path, sinogram)
+    import_qpi = task_convert.import_qpi
+    correct_bg = task_convert.correct_bg
+    calls = []
+
+    def correct_bg_fail(**kwargs):
+        raise OSError("interrupted")
+
+    def import_qpi_count(**kwargs):
+        calls.append(kwargs["start"])
+        return import_qpi(**kwargs)
+
+    monkeypatch.setattr(task_convert, "import_qpi", import_qpi_count)
+    monkeypatch.setattr(task_convert, "correct_bg", correct_bg_fail)
+    (tmp_path / "session1").mkdir()
+    with pytest.raises(OSError, match="interrupted"):
+        task_convert.convert(path_out=tmp_path / "session1", **kw)
+    assert calls == [0]
+    assert not list((tmp_path / "session1").iterdir())
+    # the QPI data are not imported again
+    monkeypatch.setattr(task_convert, "correct_bg", correct_bg)
+    (tmp_path / "session2").mkdir()
+    task_convert.convert(path_out=tmp_path / "session2", **kw)
+    assert calls == [0]
+    assert not list(task_convert.get_staging_dir().iterdir())
+    with h5py.File(tmp_path / "session2" / "sinogram.h5", "r") as h5:
+        assert "import key" not in h5.attrs
+        qps = qpimage.QPSeries(h5file=h5["qpseries"], h5mode="r")
+        assert len(qps) == 10
+        assert "fit" in qps[0].h5["phase/bg_data"]
+
+
+@pytest.mark.parametrize("func,error", [
+    ("import_qpi", OSError("worker failed")),
+    ("correct_bg", np.linalg.LinAlgError("Singular matrix")),
+    ])
+def test_convert_error(qtbot, tmp_path, sinogram, monkeypatch, func, error):
+    """Errors of the import steps are raised in the GUI thread"""
+    def failing_step(**kwargs):
+        raise error
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(task_convert, func, failing_step)
+    (tmp_path / "session").mkdir()
+    with pytest.raises(type(error), match=str(error)):
+        task_convert.convert(path_out=tmp_path / "session",
+                             **get_convert_kwargs(tmp_path, sinogram))
+    assert not (tmp_path / "session" / "sinogram.h5").exists()
@@ -0,0 +1,75 @@
+"""batch converter script tests"""
+import importlib.util
+import json
+import pathlib
+
+import h5py
+import qpimage
+
+from cellreel.wiz_init import meta_hints
+
+path_script = pathlib.Path(__file__).parents[1] / "scripts" / "convert2h5.py"
+spec = importlib.util.spec_from_file_location("convert2h5", path_script)
+convert2h5 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(convert2h5)
+
+
+def make_dataset(path, sinogram):
+    """Create a QPI measurement with background data and meta data hints"""
+    path.mkdir()
+    path_qpi = path / "phase.h5"
+    with h5py.File(sinogram, "r") as h5, h5py.File(path_qpi, "w") as h5q:
+        h5.copy("qpseries", h5q, name="qpseries")
+        with qpimage.QPSeries(h5file=h5["qpseries"], h5mode="r") as qps:
+            (path / "bg").mkdir()
+            with qps[0].copy(h5file=path / "bg" / "bg.h5"):
+                pass
+    meta_hints.save_hints(path_qpi, {"pixel size": .1,
+                                     "wavelength": 550,
+                                     "medium index": 1.335,
+                                     "path_qpi_bg": path / "bg" / "bg.h5"})
+    return path_qpi
+
+
+def test_convert_dataset(tmp_path, sinogram):
+    """Up-to-date outputs are skipped unless `force` is set"""
+    path_qpi = make_dataset(tmp_path / "cell1", sinogram)
+    path_out = convert2h5.get_output_path(path_qpi)
+    assert path_out == tmp_path / "cell1.converted" / "phase"
+    assert (convert2h5.get_output_path(path_qpi, tmp_path / "out")
+            == tmp_path / "out" / "cell1" / "phase")
+
+    sm = convert2h5.convert_dataset(path_qpi, path_out)
+    assert sm["status"] == "converted"
+    assert sm["frames"] == 10
+    size = (path_qpi.stat().st_size
+            + (tmp_path / "cell1" / "bg" / "bg.h5").stat().st_size)
+    assert abs(sm["size [MB]"] - size / 1024**2) < 1e-9
+    assert (path_out / "sinogram_qpi.h5").exists()
+    with (path_out / convert2h5.STATE_NAME).open() as fd:
+        assert "identifier" in json.load(fd)
+
+    assert convert2h5.convert_dataset(path_qpi, path_out)["status"] \
+        == "skipped"
+    assert convert2h5.convert_dataset(path_qpi, path_out,
+                                      force=True)["status"] == "converted"
+
+
+def test_expand_paths(tmp_path, sinogram):
+    """Output directories are not converted again"""
+    path_qpi = make_dataset(tmp_path / "cell1", sinogram)
+    convert2h5.convert_dataset(path_qpi, convert2h5.get_output_path(path_qpi))
+    assert (tmp_path / "cell1.converted" / "phase"
+            / "sinogram_qpi.h5").exists()
+    pattern = tmp_path / "cell1*" / "**" / "*.h5"
+    paths = convert2h5.expand_paths([str(pattern), str(path_qpi)])
+    assert paths == sorted([path_qpi.resolve(),
+                            (tmp_path / "cell1" / "bg" / "bg.h5").resolve()])
+
+
+def test_get_size(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.txt").write_bytes(b"0" * 10)
+    (tmp_path / "sub" / "b.txt").write_bytes(b"0" * 5)
+    assert convert2h5.get_size(tmp_path / "a.txt") == 10
+    assert convert2h5.get_size(tmp_path) == 15
@@ -0,0 +1,189 @@
+"""dataset download tests"""
+import functools
+import hashlib
+import http.server
+import multiprocessing as mp
+import os
+import threading
+
+import pytest
+
+from cellreel.wiz_init import task_download
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files with support for single HTTP range requests"""
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        rng = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if rng is None or not os.path.isfile(path):
+            return super(RangeRequestHandler, self).do_GET()
+        size = os.path.getsize(path)
+        start, stop = rng.split("=")[1].split("-")
+        start = int(start)
+        stop = int(stop) + 1 if stop else size
+        with open(path, "rb") as fd:
+            fd.seek(start)
+            data = fd.read(stop - start)
+        self.send_response(206)
+        self.send_header("Content-Range",
+                         "bytes {}-{}/{}".format(start, stop - 1, size))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super(RangeRequestHandler, self).end_headers()
+
+
+@pytest.fixture
+def server(tmp_path):
+    """Local HTTP server for the directory "served" in `tmp_path`"""
+    (tmp_path / "served").mkdir()
+    handler = functools.partial(RangeRequestHandler,
+                                directory=str(tmp_path / "served"))
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_ranges(tmp_path, server):
+    """Concurrent range requests with resume and streamed checksum"""
+    data = os.urandom(1000003)
+    (tmp_path / "served" / "data.bin").write_bytes(data)
+    url = server + "/data.bin"
+    path = tmp_path / "data.bin"
+    # partial download from a previous session (the incomplete
+    # last block is downloaded again)
+    path.write_bytes(data[:123456] + b"torn write")
+    count = mp.Value('Q', 0, lock=True)
+    max_count = mp.Value('Q', 0, lock=True)
+    sha256sum = task_download.download(url=url,
+                                       path=path,
+                                       num_connections=3,
+                                       block_size=100000,
+                                       count=count,
+                                       max_count=max_count)
+    assert sha256sum == hashlib.sha256(data).hexdigest()
+    assert path.read_bytes() == data
+    assert count.value == max_count.value == len(data)
+    assert task_download.verify_checksum(path, sha256sum)
+    # start anew
+    sha256sum2 = task_download.download(url=url,
+                                        path=path,
+                                        resume=False,
+                                        block_size=300000)
+    assert sha256sum2 == sha256sum
+    # 64-bit progress counters
+    count.value += 5 * 1024**3
+    assert count.value == 5 * 1024**3 + len(data)
+
+
+def test_download_cache(tmp_path, server, monkeypatch):
+    """Downloaded files are linked from the machine-wide cache"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    data = os.urandom(54321)
+    (tmp_path / "served" / "data.bin").write_bytes(data)
+    dt = {"name": "data.bin",
+          "sha256": hashlib.sha256(data).hexdigest(),
+          "urls": [server + "/data.bin"],
+          "size": len(data)}
+    for name in ["session1", "session2"]:
+        (tmp_path / name).mkdir()
+        count = mp.Value('Q', 0, lock=True)
+        max_count = mp.Value('Q', 0, lock=True)
+        thread = task_download.DownloadThread(data=dt,
+                                              path=tmp_path / name / "a.bin",
+                                              count=count,
+                                              max_count=max_count)
+        thread.run()
+        assert count.value == max_count.value == len(data)
+        if name == "session1":
+            # the second download must not access the server
+            (tmp_path / "served" / "data.bin").unlink()
+    assert (tmp_path / "session2" / "a.bin").read_bytes() == data
+    assert os.path.samefile(tmp_path / "session1" / "a.bin",
+                            tmp_path / "session2" / "a.bin")
+
+
+class NoRangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files without support for HTTP range requests"""
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server_no_range(tmp_path):
+    """Local HTTP server without range support for "served" in `tmp_path`"""
+    (tmp_path / "served").mkdir(exist_ok=True)
+    handler = functools.partial(NoRangeRequestHandler,
+                                directory=str(tmp_path / "served"))
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{}".format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_single_connection(tmp_path, server):
+    """Range requests are used with a single connection"""
+    data = os.urandom(1000003)
+    (tmp_path / "served" / "data.bin").write_bytes(data)
+    path = tmp_path / "data.bin"
+    sha256sum = task_download.download(url=server + "/data.bin",
+                                       path=path,
+                                       num_connections=1,
+                                       block_size=100000)
+    assert sha256sum == hashlib.sha256(data).hexdigest()
+    assert path.read_bytes() == data
+
+
+def test_download_no_range(tmp_path, server_no_range, monkeypatch):
+    """Files are streamed if the server does not support range requests"""
+    def download_range(*args, **kwargs):
+        raise AssertionError("range request")
+
+    monkeypatch.setattr(task_download, "download_range", download_range)
+    data = os.urandom(1000003)
+    (tmp_path / "served" / "data.bin").write_bytes(data)
+    path = tmp_path / "data.bin"
+    # partial download cannot be resumed
+    path.write_bytes(data[:123456])
+    count = mp.Value('Q', 0, lock=True)
+    max_count = mp.Value('Q', 0, lock=True)
+    sha256sum = task_download.download(url=server_no_range + "/data.bin",
+                                       path=path,
+                                       num_connections=3,
+                                       block_size=100000,
+                                       chunk_size=4096,
+                                       count=count,
+                                       max_count=max_count)
+    assert sha256sum == hashlib.sha256(data).hexdigest()
+    assert path.read_bytes() == data
+    assert count.value == max_count.value == len(data)
+
+
+def test_download_dataset_checksum(qtbot, tmp_path, server, monkeypatch):
+    """A checksum mismatch is raised in the GUI thread"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    data = os.urandom(54321)
+    (tmp_path / "served" / "data.bin").write_bytes(data)
+    dt = {"name": "data.bin",
+          "sha256": hashlib.sha256(b"other data").hexdigest(),
+          "urls": [server + "/data.bin"],
+          "size": len(data)}
+    monkeypatch.setattr(task_download, "get_available_datasets",
+                        lambda: {"bad": {"data": [dt]}})
+    (tmp_path / "dl").mkdir()
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        task_download.download_dataset_qt5(key="bad", path=tmp_path / "dl")
+    # the corrupt file is not kept
+    assert not (tmp_path / "dl" / "data.bin").exists()
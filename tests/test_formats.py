@@ -0,0 +1,143 @@
+"""custom data format tests"""
+import os
+import zipfile
+
+import h5py
+import imageio
+import numpy as np
+import qpformat
+
+from cellreel.wiz_init.formats import flformat, qpi_custom
+
+
+def test_load_file_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    path = tmp_path / "SID 1 12_00_01.12345.tif_phase"
+    path.write_text("# comment line\n"
+                    "\n"
+                    "1,5\t2\t-3,25\n"
+                    "4\t5,0\t6e-3\n")
+    ref = np.array([[4, 5, 6e-3], [1.5, 2, -3.25]])
+    assert np.allclose(qpi_custom.load_file(path), ref)
+    path_cache = qpi_custom.get_cache_path(path)
+    assert not path_cache.exists()
+    assert np.allclose(qpi_custom.load_file(path, cache=True), ref)
+    assert path_cache.exists()
+    assert path_cache.parent == tmp_path / "cache" / "CellReel" / "guck-txt"
+    # the cache is used
+    path_cache.unlink()
+    np.save(path_cache, np.zeros((2, 3)))
+    assert np.all(qpi_custom.load_file(path, cache=True) == 0)
+    # modified files are parsed again
+    stat = path_cache.stat()
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert qpi_custom.get_cache_path(path) != path_cache
+    assert np.allclose(qpi_custom.load_file(path, cache=True), ref)
+
+
+def test_load_guck_folder_twice(tmp_path, monkeypatch):
+    """Cached txt data do not end up in the measurement folder"""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(qpi_custom.SingleGuck, "cache", True)
+    path = tmp_path / "data"
+    path.mkdir()
+    rng = np.random.RandomState(42)
+    for ii in range(3):
+        for suffix in ["phase", "intensity"]:
+            data = .3 * rng.rand(10, 12)
+            text = "\n".join("\t".join("{:.6f}".format(v) for v in row)
+                             for row in data)
+            name = "SID 1 12_00_{:02d}.00000.tif_{}".format(ii, suffix)
+            (path / name).write_text(text)
+    names = sorted(pp.name for pp in path.iterdir())
+    meta_data = {"wavelength": 500e-9}
+    ds1 = qpformat.load_data(path, meta_data=meta_data)
+    qpi1 = ds1.get_qpimage(1)
+    assert sorted(pp.name for pp in path.iterdir()) == names
+    path_cache = tmp_path / "cache" / "CellReel" / "guck-txt"
+    assert len(list(path_cache.glob("*.npy"))) == 2
+    ds2 = qpformat.load_data(path, meta_data=meta_data)
+    assert len(ds2) == 3
+    assert np.allclose(ds2.get_qpimage(1).pha, qpi1.pha)
+
+
+def test_series_zip_guck(tmp_path):
+    rng = np.random.RandomState(42)
+    names = ["SID 1 12_00_{:02d}.{:05d}.tif_phase".format(ii, 10*ii)
+             for ii in range(6)]
+    with zipfile.ZipFile(tmp_path / "series.zip", "w") as zf:
+        for name in names:
+            for suffix in ["phase", "intensity"]:
+                data = .3 * rng.rand(10, 12)
+                text = "\n".join("\t".join("{:.6f}".format(v) for v in row)
+                                 for row in data).replace(".", ",")
+                zf.writestr(name[:-5] + suffix, text)
+    with zipfile.ZipFile(tmp_path / "series.zip") as zf:
+        zf.extractall(tmp_path)
+    meta_data = {"wavelength": 500e-9}
+    ds = qpi_custom.SeriesZipGuck(tmp_path / "series.zip",
+                                  meta_data=meta_data)
+    assert len(ds) == 6
+    # in-order access (read ahead) and random access
+    for idx in [0, 1, 2, 5, 3, 4]:
+        qpi = ds.get_qpimage_raw(idx)
+        ref = qpi_custom.SingleGuck(tmp_path / names[idx],
+                                    meta_data=meta_data).get_qpimage_raw()
+        assert np.allclose(qpi.pha, ref.pha)
+        assert np.allclose(qpi.amp, ref.amp)
+        assert np.isclose(qpi["time"], 12*60*60 + idx + idx*1e-4)
+    ds.close()
+
+
+def test_series_avi_iter(tmp_path, monkeypatch):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    path = tmp_path / "fl.avi"
+    rng = np.random.RandomState(42)
+    with imageio.get_writer(path, fps=10, codec="rawvideo",
+                            macro_block_size=1) as writer:
+        for ii in range(30):
+            writer.append_data((rng.rand(32, 48) * 255).astype(np.uint8))
+    with (tmp_path / "flframetiming.txt").open("w") as fd:
+        for ii in range(30):
+            fd.write("1200{:06.3f}\n".format(ii / 10))
+    ds = flformat.load_data(path)
+    ds.seek_step = 10
+    assert len(ds) == 30
+    indices = [0, 3, 4, 17, 29]
+    flis = list(ds.iter_flimages(indices))
+    assert len(flis) == 5
+    for idx, fli in zip(indices, flis):
+        assert np.all(fli.fl == ds.get_flimage(idx).fl)
+        assert np.isclose(fli["time"], 12*60*60 + idx / 10)
+        assert fli["identifier"] == ds.get_identifier(idx)
+    # seek index is persisted in the user cache directory
+    assert ds.path_seek_index.exists()
+    assert ds.path_seek_index.parent == (tmp_path / "cache" / "CellReel"
+                                         / "seekindex")
+    assert not list(tmp_path.glob("*.json"))
+    assert ds.seek_index == [0, 17, 29]
+    assert flformat.load_data(path).seek_index == [0, 17, 29]
+    # unusable cache directory
+    (tmp_path / "no_cache").touch()
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "no_cache"))
+    ds2 = flformat.load_data(path)
+    ds2.seek_step = 10
+    assert ds2.seek_index == [0]
+    ds2._add_seek_point(20)
+    assert ds2.seek_index == [0, 20]
+
+
+def test_series_h5(tmp_path, sinogram):
+    with h5py.File(sinogram, "r") as h5, \
+            h5py.File(tmp_path / "fl.h5", "w") as h5fl:
+        for key in h5["flseries"]:
+            h5.copy(h5["flseries"][key], h5fl)
+    ds = flformat.load_data(tmp_path / "fl.h5")
+    assert isinstance(ds, flformat.SeriesH5)
+    assert len(ds) == 20
+    assert np.allclose(ds.get_times(), np.arange(20) * .05)
+    assert ds.get_time(3) == ds.get_times()[3]
+    flis = list(ds.iter_flimages([2, 5, 6]))
+    for idx, fli in zip([2, 5, 6], flis):
+        assert np.all(fli.fl == ds.get_flimage(idx).fl)
+    ds.close()
@@ -0,0 +1,156 @@
+"""live acquisition tests"""
+import flimage
+import h5py
+import numpy as np
+import pytest
+import qpimage
+
+from cellreel.sino.sino_view import SinoView
+from cellreel.wiz_init import task_live
+
+
+def write_frames(path, start, stop):
+    """Write single-frame QPI and fluorescence files"""
+    rng = np.random.RandomState(start)
+    for ii in range(start, stop):
+        meta_data = {"time": 10 + ii*.1,
+                     "wavelength": 550e-9,
+                     "pixel size": .1e-6,
+                     "medium index": 1.335}
+        with qpimage.QPImage(data=(rng.rand(32, 32),
+                                   1 + .1*rng.rand(32, 32)),
+                             which_data="phase,amplitude",
+                             meta_data=meta_data,
+                             h5file=path / "qpi" / "{:04d}.h5".format(ii)):
+            pass
+        with flimage.FLImage(data=rng.rand(32, 32),
+                             meta_data={"time": 10 + ii*.1},
+                             h5file=path / "fli" / "{:04d}.h5".format(ii)):
+            pass
+
+
+def test_live_import(tmp_path):
+    """Frames are appended to the sinogram as they are recorded"""
+    (tmp_path / "qpi").mkdir()
+    (tmp_path / "fli").mkdir()
+    write_frames(tmp_path, 0, 3)
+    kw = {"path_sino": tmp_path / "sinogram.h5",
+          "path_qpi": tmp_path / "qpi" / "0000.h5",
+          "path_qpi_bg": None,
+          "path_fl": tmp_path / "fli" / "0000.h5",
+          "wavelength": 550e-9,
+          "pixel_size": .1e-6,
+          "medium_index": 1.335,
+          "slice_qpi": (slice(2, 30), slice(2, 30)),
+          "bgkw_qpi": {"fit_profile": "tilt", "border_px": 3},
+          "colockw": {"p_qp": (16, 16), "p_fl": (16, 16),
+                      "res_qp": .1, "res_fl": .1},
+          }
+    live = task_live.LiveImport(**kw)
+    assert live.poll(stable_only=False) == (3, 3)
+    sv = SinoView(path=kw["path_sino"]).load()
+    assert sv.is_live()
+    assert sv.pha.shape == (3, 28, 28)
+
+    write_frames(tmp_path, 3, 5)
+    # files are imported when their size did not change since last poll
+    assert live.poll() == (0, 0)
+    assert live.poll() == (2, 2)
+    assert sv.update() == 4
+    assert sv.pha.shape == sv.amp.shape == sv.fl.shape == (5, 28, 28)
+    assert np.allclose(sv.get_times("phase"), np.arange(5) * .1)
+
+    # resumed import skips the files already imported
+    live2 = task_live.LiveImport(**kw)
+    assert live2.poll(stable_only=False) == (0, 0)
+    live2.stop()
+    ref = SinoView(path=kw["path_sino"]).load()
+    assert not ref.is_live()
+    assert np.allclose(ref.pha, sv.pha)
+    assert np.allclose(ref.fl, sv.fl)
+    with h5py.File(kw["path_sino"], "r") as h5:
+        assert len(h5["live index/qpseries"]) == 5
+
+
+def test_live_thread_error(qtbot, tmp_path):
+    """Import errors are reported by the live thread"""
+    (tmp_path / "qpi").mkdir()
+    live = task_live.LiveImport(path_sino=tmp_path / "missing" / "sino.h5",
+                                path_qpi=tmp_path / "qpi" / "0000.h5",
+                                path_qpi_bg=None,
+                                path_fl=None,
+                                wavelength=550e-9,
+                                pixel_size=.1e-6,
+                                medium_index=1.335,
+                                slice_qpi=(slice(None), slice(None)),
+                                bgkw_qpi={},
+                                colockw={})
+    thread = task_live.LiveThread(live)
+    with qtbot.waitSignal(thread.error, timeout=5000) as blocker:
+        thread.start()
+    thread.wait()
+    assert "missing" in blocker.args[0]
+    assert thread.result is None
+    # the lock is released
+    assert live.lock.acquire(blocking=False)
+
+
+def test_live_import_failed_files(tmp_path):
+    """Files that cannot be imported are reported once"""
+    (tmp_path / "qpi").mkdir()
+    (tmp_path / "fli").mkdir()
+    write_frames(tmp_path, 0, 2)
+    (tmp_path / "qpi" / "0002.h5").write_bytes(b"not an hdf5 file")
+    live = task_live.LiveImport(path_sino=tmp_path / "sinogram.h5",
+                                path_qpi=tmp_path / "qpi" / "0000.h5",
+                                path_qpi_bg=None,
+                                path_fl=None,
+                                wavelength=550e-9,
+                                pixel_size=.1e-6,
+                                medium_index=1.335,
+                                slice_qpi=(slice(None), slice(None)),
+                                bgkw_qpi={"fit_profile": "tilt",
+                                          "border_px": 3},
+                                colockw={})
+    # files that are still growing are not imported
+    assert live.poll() == (0, 0)
+    with pytest.raises(task_live.LiveImportError, match="0002.h5"):
+        live.poll()
+    assert list(live.failed) == [tmp_path / "qpi" / "0002.h5"]
+    # the other files were imported and the failed file is not retried
+    assert live.poll() == (0, 0)
+    sv = SinoView(path=tmp_path / "sinogram.h5").load()
+    assert sv.pha.shape == (2, 32, 32)
+    # unless it changes
+    (tmp_path / "qpi" / "0002.h5").unlink()
+    write_frames(tmp_path, 2, 3)
+    assert live.poll() == (0, 0)
+    assert live.poll() == (1, 0)
+    assert not live.failed
+
+
+def test_live_import_empty_file(tmp_path, monkeypatch):
+    """Files without frames do not create an empty QPSeries"""
+    class EmptySeries(object):
+        def __len__(self):
+            return 0
+
+    (tmp_path / "qpi").mkdir()
+    (tmp_path / "fli").mkdir()
+    write_frames(tmp_path, 0, 1)
+    monkeypatch.setattr(task_live.qpformat, "load_data",
+                        lambda **kwargs: EmptySeries())
+    live = task_live.LiveImport(path_sino=tmp_path / "sinogram.h5",
+                                path_qpi=tmp_path / "qpi" / "0000.h5",
+                                path_qpi_bg=None,
+                                path_fl=None,
+                                wavelength=550e-9,
+                                pixel_size=.1e-6,
+                                medium_index=1.335,
+                                slice_qpi=(slice(None), slice(None)),
+                                bgkw_qpi={},
+                                colockw={})
+    assert live.poll(stable_only=False) == (0, 0)
+    with h5py.File(tmp_path / "sinogram.h5", "r") as h5:
+        assert "qpseries" not in h5
+        assert len(h5["live index/qpseries"]) == 1
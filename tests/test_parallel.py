@@ -0,0 +1,72 @@
+"""parallel helper tests"""
+import concurrent.futures
+import multiprocessing as mp
+import time
+
+import pytest
+from PyQt5 import QtWidgets
+
+from cellreel import parallel
+
+
+def count_up(count, max_count, fail=False):
+    max_count.value = 5
+    if fail:
+        raise ValueError("No rotation detected!")
+    for _ in range(5):
+        with count.get_lock():
+            count.value += 1
+    return {"period": 2.5}
+
+
+def test_run_in_thread(qtbot):
+    """Results and errors of the thread are returned in the GUI thread"""
+    count = mp.Value('I', 0, lock=True)
+    max_count = mp.Value('I', 0, lock=True)
+    bar = QtWidgets.QProgressDialog("Testing...", "", 0, 0)
+    bar.setAutoClose(False)
+    fkw = {"count": count, "max_count": max_count}
+    res = parallel.run_in_thread(func=count_up, fkw=fkw, bar=bar,
+                                 count=count, max_count=max_count)
+    assert res == {"period": 2.5}
+    # the counter never reaches its maximum
+    count.value = 0
+    max_count.value = 0
+    with pytest.raises(ValueError, match="No rotation detected"):
+        parallel.run_in_thread(func=count_up, fkw=dict(fkw, fail=True),
+                               bar=bar, count=count, max_count=max_count)
+    assert bar.wasCanceled()
+
+
+def test_wait_for_threads(qtbot):
+    """All threads are awaited before an error is raised"""
+    def fail():
+        raise OSError("download failed")
+
+    threads = [parallel.TaskThread(func=fail, fkw={}),
+               parallel.TaskThread(func=lambda: 42, fkw={})]
+    for thr in threads:
+        thr.start()
+    with pytest.raises(OSError, match="download failed"):
+        parallel.wait_for_threads(threads)
+    assert not any([thr.isRunning() for thr in threads])
+    assert threads[1].result == 42
+
+
+def test_imap_ordered_cancel():
+    """Pending items are cancelled when an item fails"""
+    done = []
+
+    def func(item):
+        if item == 0:
+            raise ValueError("item failed")
+        time.sleep(.1)
+        done.append(item)
+        return item
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        results = parallel.imap_ordered(func, range(10), pool, prefetch=4)
+        with pytest.raises(ValueError, match="item failed"):
+            list(results)
+    # items 1 to 3 were submitted, but at most item 1 was started
+    assert len(done) <= 1
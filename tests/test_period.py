@@ -0,0 +1,28 @@
+"""rotation period detection tests"""
+import numpy as np
+
+from cellreel.sino import period
+from cellreel.sino.sino_view import SinoView
+from cellreel import workload
+
+
+def test_estimate_rotation(tmp_path):
+    """The period of a simulated sinogram is detected"""
+    workload.generate_session(path=tmp_path,
+                              num_frames=60,
+                              grid_size=(32, 32),
+                              angle_coverage=2*np.pi*2.4,
+                              duration=6,
+                              displacement=1.,
+                              fluorescence=False,
+                              propagator="projection",
+                              use_cache=False)
+    sv = SinoView(path=tmp_path / "sinogram.h5").load()
+    est = period.estimate_rotation(sv)
+    # one rotation takes 2.5 s (multiples of the period are ignored)
+    assert np.isclose(est["period"], 2.5, atol=.1)
+    assert np.isclose(est["end"] - est["start"], 2.5, atol=.1)
+    assert est["similarity"] > .99
+    state = period.suggest_rotation_state(sv, roll=3)
+    assert state["children"]["Roll"]["value"] == 3
+    assert state["children"]["Start"]["value"] == est["start"]
@@ -0,0 +1,55 @@
+"""axis roll detection tests"""
+import numpy as np
+import pytest
+
+from cellreel.sino import roll
+from cellreel.sino.sino_view import SinoView
+from cellreel import workload
+
+
+def test_estimate_roll(tmp_path):
+    """The axis roll of a simulated sinogram is detected"""
+    truth = workload.generate_session(path=tmp_path,
+                                      num_frames=40,
+                                      grid_size=(32, 32),
+                                      angle_coverage=2*np.pi*1.2,
+                                      duration=3.6,
+                                      displacement=1.,
+                                      axis_roll=np.deg2rad(25),
+                                      fluorescence=False,
+                                      propagator="projection",
+                                      use_cache=False)
+    sv = SinoView(path=tmp_path / "sinogram.h5").load()
+    est = roll.estimate_roll(sv, t_start=truth["start"], t_end=truth["end"])
+    assert np.isclose(est["roll"], 25, atol=2)
+    assert est["confidence"] > .5
+
+
+def test_get_mirror_pairs():
+    """Frames are paired with the frame half a rotation later"""
+    times = np.arange(30) * .1
+    idx_a, idx_b = roll.get_mirror_pairs(times, t_start=.5, t_end=2.5,
+                                         num_pairs=4)
+    assert np.all(times[idx_a] >= .5)
+    assert np.allclose(times[idx_b] - times[idx_a], 1)
+
+
+def test_estimate_roll_thread(qtbot, tmp_path):
+    """Errors of the threaded estimation reach the GUI thread"""
+    from cellreel import tab_sino
+
+    workload.generate_session(path=tmp_path,
+                              num_frames=10,
+                              grid_size=(16, 16),
+                              angle_coverage=2*np.pi,
+                              duration=1,
+                              fluorescence=False,
+                              propagator="projection",
+                              use_cache=False)
+    sv = SinoView(path=tmp_path / "sinogram.h5").load()
+    bar = tab_sino.get_busy_dialog("Estimating axis roll...",
+                                   "Axis Roll Detection")
+    with pytest.raises(ValueError, match="does not cover half a rotation"):
+        tab_sino.run_in_thread(func=roll.estimate_roll,
+                               fkw={"sv": sv, "t_start": 0, "t_end": 3},
+                               bar=bar)
@@ -0,0 +1,94 @@
+"""rotation identification tests"""
+import json
+import warnings
+
+import numpy as np
+from scipy.optimize import approx_fprime
+
+from cellreel.sino import rot
+from cellreel.sino.sino_view import SinoView
+
+
+def test_fit_skewed_periodic():
+    """The fit recovers the model parameters, also when warm-started"""
+    params = {"f": 1/3, "x0": .3, "y0": 50, "a": 20,
+              "b0": .2, "b1": -.1, "c0": .5, "c1": 1}
+    x = np.linspace(0, 3, 40, endpoint=False)
+    y = rot.skewed_periodic_model(params, x)
+    func, fit = rot.fit_skewed_periodic(x, y, period=3, num_skw=2, y0=50)
+    assert np.allclose(func(x), y, atol=1e-6)
+    assert np.isclose(fit["a"], 20)
+    # warm start with an additional skewing coefficient
+    func2, fit2 = rot.fit_skewed_periodic(x, y + 1, period=3, num_skw=3,
+                                          y0=50, p0=fit)
+    assert np.allclose(func2(x), y + 1, atol=1e-6)
+    assert "b2" in fit2
+
+
+def test_skewed_periodic_jacobian():
+    """The analytic Jacobian matches finite differences"""
+    pars = np.array([.3, 50, 20, .2, -.1, .5, 1.])
+    x = np.linspace(0, 3, 10)
+    jac = rot._skewed_periodic_jacobian(pars, 1/3, x, None)
+    for ii in range(x.size):
+        num = approx_fprime(
+            pars,
+            lambda p: rot._skewed_periodic_residual(p, 1/3, x, 0)[ii],
+            1e-8)
+        assert np.allclose(jac[ii], num, atol=1e-5)
+
+
+def test_compute_angles_from_spacing(sinogram):
+    """Spacing angles are computed for several modalities at once"""
+    sv = SinoView(path=sinogram).load()
+    t = np.linspace(0, .9, 7)
+    points = np.array([16 + 8*np.sin(2*np.pi*t/.9), t]).T
+    rot.save_spacing_state(path=sinogram.parent,
+                           name="user",
+                           points=points.tolist(),
+                           period=.9,
+                           num_skw=1,
+                           y0=16,
+                           t0=0,
+                           t_start=0,
+                           t_end=.85,
+                           user_slice=16,
+                           user_mode="phase")
+    angles = rot.compute_angles_from_spacing(path=sinogram.parent,
+                                             spacing="user",
+                                             sv=sv,
+                                             mode=["phase", "fluorescence"])
+    assert len(angles) == 2
+    assert angles[0].size == 9
+    assert angles[1].size == 17
+    ref = rot.compute_angles_from_spacing(path=sinogram.parent,
+                                          spacing="user",
+                                          sv=sv,
+                                          mode="fluorescence")
+    assert np.allclose(ref, angles[1])
+    # one rotation
+    assert np.all(np.diff(angles[0]) > 0)
+    assert angles[0][-1] - angles[0][0] < 2*np.pi
+    assert rot._fit_spacing.cache_info().hits >= 1
+    # the cached fit parameters cannot be modified by callers
+    spacing_json = json.dumps(rot.load_spacing_states(sinogram.parent)["user"],
+                              sort_keys=True)
+    func, params = rot.fit_spacing(spacing_json)
+    ref = func(np.linspace(0, .9, 5))
+    params["a"] = 0
+    func2, params2 = rot.fit_spacing(spacing_json)
+    assert params2["a"] != 0
+    assert np.allclose(func2(np.linspace(0, .9, 5)), ref)
+
+
+def test_angle_project_2pi():
+    """Values beyond the amplitude do not produce NaNs or warnings"""
+    x = np.linspace(0, 2*np.pi, 50, endpoint=False)
+    signal = np.roll(3 + 2*np.cos(x), 7)
+    angles = rot.angle_project_2pi(signal, offset=3, amplitude=2)
+    assert np.allclose(np.diff(angles), x[1])
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        angles = rot.angle_project_2pi(signal, offset=3, amplitude=1.8)
+    assert np.all(np.isfinite(angles))
+    assert np.all(np.diff(angles) >= 0)
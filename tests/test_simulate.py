@@ -0,0 +1,69 @@
+"""sinogram simulation tests"""
+import cellsino
+import flimage
+import h5py
+import numpy as np
+import pytest
+import qpimage
+
+from cellreel.wiz_init import task_simulate
+
+
+def test_compute_sinograms(tmp_path):
+    """Block-wise simulation matches cellsino's `compute`"""
+    sinokw = {"phantom": "simple cell",
+              "wavelength": 550e-9,
+              "pixel_size": .5e-6,
+              "grid_size": (32, 32)}
+    angles = np.linspace(0, np.pi, 7, endpoint=False)
+    fl_times = np.linspace(-.1, 1, 10, endpoint=False)
+    computekw = [{"angles": angles,
+                  "displacements": .5,
+                  "times": 1.,
+                  "mode": "field",
+                  # (the default "rytov" propagator is much slower)
+                  "propagator": "projection"},
+                 {"angles": fl_times * np.pi,
+                  "displacements": .5,
+                  "times": fl_times,
+                  "mode": "fluorescence",
+                  "bleach_decay": .1,
+                  "fluorescence_background": .2},
+                 ]
+    sino = cellsino.Sinogram(**sinokw)
+    for kw in computekw:
+        sino.compute(path=tmp_path / "ref.h5", **kw)
+    task_simulate.compute_sinograms(path=tmp_path / "out.h5",
+                                    sinokw=sinokw,
+                                    computekw=computekw,
+                                    block_size=3)
+    with h5py.File(tmp_path / "ref.h5", "r") as h5r, \
+            h5py.File(tmp_path / "out.h5", "r") as h5o:
+        ref = qpimage.QPSeries(h5file=h5r["qpseries"], h5mode="r")
+        out = qpimage.QPSeries(h5file=h5o["qpseries"], h5mode="r")
+        assert len(ref) == len(out) == 7
+        for qr, qo in zip(ref, out):
+            assert qr.meta == qo.meta
+            assert np.allclose(qr.pha, qo.pha)
+            assert np.allclose(qr.amp, qo.amp)
+        ref = flimage.FLSeries(h5file=h5r["flseries"], h5mode="r")
+        out = flimage.FLSeries(h5file=h5o["flseries"], h5mode="r")
+        assert len(ref) == len(out) == 10
+        for fr, fo in zip(ref, out):
+            assert fr.meta == fo.meta
+            assert np.allclose(fr.fl, fo.fl)
+
+
+def test_simulate_error(qtbot, tmp_path, monkeypatch):
+    """A failing simulation is reported in the GUI thread"""
+    def compute_sinograms(**kwargs):
+        raise RuntimeError("worker crashed")
+
+    monkeypatch.setattr(task_simulate, "compute_sinograms", compute_sinograms)
+    with pytest.raises(RuntimeError, match="worker crashed"):
+        task_simulate.simulate(path=tmp_path,
+                               phantom="simple cell",
+                               angles=np.linspace(0, np.pi, 4),
+                               fluorescence=False,
+                               grid_size=(16, 16),
+                               use_cache=False)
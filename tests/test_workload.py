@@ -0,0 +1,36 @@
+"""synthetic workload tests"""
+import numpy as np
+
+from cellreel.sino import rot
+from cellreel.sino.sino_view import SinoView
+from cellreel import workload
+
+
+def test_generate_session(tmp_path):
+    """Sessions contain the simulated sinogram and its ground truth"""
+    truth = workload.generate_session(path=tmp_path,
+                                      num_frames=6,
+                                      grid_size=(24, 24),
+                                      angle_coverage=np.pi,
+                                      duration=2,
+                                      displacement=.5,
+                                      axis_roll=np.deg2rad(10),
+                                      fl_frame_rate_mult=1.5,
+                                      propagator="projection",
+                                      use_cache=False)
+    sv = SinoView(path=tmp_path / "sinogram.h5").load()
+    assert sv.pha.shape == (6, 24, 24)
+    assert sv.fl.shape == (9, 24, 24)
+    assert np.allclose(sv.get_times("phase"), np.arange(6) / 3)
+
+    loaded = workload.load_ground_truth(tmp_path)
+    assert np.allclose(loaded["phase"]["angles"], np.arange(6) * np.pi / 6)
+    assert np.allclose(loaded["phase"]["shifts"], truth["phase"]["shifts"])
+    assert loaded["phase"]["shifts"].shape == (6, 2)
+    assert loaded["fluorescence"]["shifts"].shape == (9, 2)
+    assert np.allclose(loaded["fluorescence"]["times"],
+                       sv.get_times("fluorescence"))
+
+    state = rot.load_rotation_states(tmp_path)[workload.ROTATION_NAME]
+    assert state["children"]["End"]["value"] == 4
+    assert np.isclose(state["children"]["Roll"]["value"], 10)